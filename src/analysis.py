@@ -1,43 +1,54 @@
 import db
+import genotypes
 
 
-def variants_summary(file_hash):
+def variants_summary(file_hash, info_filters=None):
+    info_query, info_params = db.info_filter(info_filters)
     query = """
     SELECT chrom, gene_hgnc, count(*) AS count
-    FROM variants
+    FROM variants v
     WHERE file_hash = ?
+    {info_filter}
     GROUP BY 1, 2
     ORDER BY 1 ASC, 3 DESC
-    """
-    return db.read_query(query, (file_hash,))
+    """.format(info_filter=info_query)
+    return db.read_query(query, [file_hash] + info_params)
 
 
-def effects_by_impact_summary_for_gene(file_hash, gene_hgnc, biotypes=None):
+def effects_by_impact_summary_for_gene(file_hash, gene_set_id, gene_hgnc, biotypes=None, info_filters=None):
+    biotypes_query = ''
     if biotypes:
+        biotypes_query = 'AND transcript_biotype IN ({})'.format(','.join(['?'] * len(biotypes)))
+    params = [file_hash, gene_set_id, gene_hgnc] + (biotypes or [])
+
+    if not info_filters:
         query = """
-        SELECT impact, effect, count(*) AS count
-        FROM variants v
-        JOIN annotations a ON v.file_hash = a.file_hash AND v.gene_hgnc = a.gene_hgnc AND v.gene_variation = a.gene_variation
-        WHERE v.file_hash = ?
-          AND a.gene_hgnc = ?
-          AND effect NOT IN ('intergenic_region')
-          AND transcript_biotype IN ({biotypes})
-        GROUP BY 1, 2
-        ORDER BY 1 ASC, 3 DESC
-        """.format(biotypes=','.join(['?'] * len(biotypes)))
-        return db.read_query(query, [file_hash, gene_hgnc] + biotypes)
-    else:
-        query = """
-        SELECT impact, effect, count(*) AS count
-        FROM variants v
-        JOIN annotations a ON v.file_hash = a.file_hash AND v.gene_hgnc = a.gene_hgnc AND v.gene_variation = a.gene_variation
-        WHERE v.file_hash = ?
-          AND a.gene_hgnc = ?
-          AND effect NOT IN ('intergenic_region')
+        SELECT impact, effect, CAST(sum(count) AS UBIGINT) AS count
+        FROM gene_effects
+        WHERE file_hash = ?
+          AND gene_set_id = ?
+          AND gene_hgnc = ?
+          {biotypes_filter}
         GROUP BY 1, 2
         ORDER BY 1 ASC, 3 DESC
-        """
-        return db.read_query(query, (file_hash, gene_hgnc))
+        """.format(biotypes_filter=biotypes_query)
+        return db.read_query(query, params)
+
+    # every annotation has a variant, so only the annotations of the gene are scanned
+    info_query, info_params = db.info_filter(info_filters, alias='a')
+    query = """
+    SELECT impact, effect, count(*) AS count
+    FROM annotations a
+    WHERE a.file_hash = ?
+      AND a.gene_set_id = ?
+      AND a.gene_hgnc = ?
+      AND effect NOT IN ('intergenic_region')
+      {biotypes_filter}
+    {info_filter}
+    GROUP BY 1, 2
+    ORDER BY 1 ASC, 3 DESC
+    """.format(biotypes_filter=biotypes_query, info_filter=info_query)
+    return db.read_query(query, params + info_params)
 
 
 def transcripts_overview(file_hash):
@@ -52,7 +63,18 @@ def transcripts_overview(file_hash):
     return db.read_query(query, (file_hash,))
 
 
-def impact_summary(file_hash):
+def impact_summary(file_hash, gene_set_id, info_filters=None):
+    if not info_filters:
+        query = """
+        SELECT chrom, gene_hgnc, variants, high_impact, moderate_impact, low_impact, modifiers
+        FROM gene_summaries
+        WHERE file_hash = ?
+          AND gene_set_id = ?
+        ORDER BY 1 ASC, 2 ASC, 3 DESC, 4 DESC, 5 DESC, 6 DESC
+        """
+        return db.read_query(query, (file_hash, gene_set_id))
+
+    info_query, info_params = db.info_filter(info_filters)
     query = """
     SELECT
     chrom,
@@ -63,66 +85,89 @@ def impact_summary(file_hash):
     SUM(CASE impact WHEN 'LOW' THEN 1 ELSE 0 END) AS low_impact, 
     SUM(CASE impact WHEN 'MODIFIER' THEN 1 ELSE 0 END) AS modifiers
     FROM variants v
-    JOIN annotations a ON v.file_hash = a.file_hash AND v.gene_hgnc = a.gene_hgnc AND v.gene_variation = a.gene_variation
-    WHERE v.file_hash = ? AND effect NOT IN ('intergenic_region')
+    JOIN annotations a ON v.file_hash = a.file_hash AND v.gene_set_id = a.gene_set_id AND v.gene_hgnc = a.gene_hgnc AND v.gene_variation = a.gene_variation
+    WHERE v.file_hash = ? AND v.gene_set_id = ? AND effect NOT IN ('intergenic_region')
+    {info_filter}
     GROUP BY 1, 2
     ORDER BY 1 ASC, 2 ASC, 3 DESC, 4 DESC, 5 DESC, 6 DESC
-    """
-    return db.read_query(query, (file_hash,))
+    """.format(info_filter=info_query)
+    return db.read_query(query, [file_hash, gene_set_id] + info_params)
 
 
-def file_summary(file_hash):
+def file_summary(file_hash, gene_set_id):
+    # the totals of the files that are not processed yet are 0
     query = """
-    SELECT 
-        COUNT(DISTINCT gene_hgnc) AS genes,
-        COUNT(DISTINCT {g: gene_hgnc, v: gene_variation}) AS variations,
-        COUNT(*) AS effects
-    FROM annotations
+    SELECT
+        coalesce(max(genes), 0) AS genes,
+        coalesce(max(variations), 0) AS variations,
+        coalesce(max(effects), 0) AS effects
+    FROM file_summaries
     WHERE file_hash = ?
-      AND effect NOT IN ('intergenic_region')
+      AND gene_set_id = ?
     """
-    return db.read_query(query, (file_hash,))
+    return db.read_query(query, (file_hash, gene_set_id))
 
 
-def get_transcript_biotypes(file_hash, gene_hgnc):
+def __get_gene_effect_values(column, file_hash, gene_set_id, gene_hgnc):
     query = """
-    SELECT DISTINCT transcript_biotype
-    FROM annotations
+    SELECT DISTINCT {}
+    FROM gene_effects
     WHERE file_hash = ?
+      AND gene_set_id = ?
       AND gene_hgnc = ?
-      AND effect NOT IN ('intergenic_region')
-    """
-    return db.read_query(query, (file_hash, gene_hgnc))['transcript_biotype'].tolist()
+    """.format(column)
+    return db.read_query(query, (file_hash, gene_set_id, gene_hgnc))[column].tolist()
+
+
+def get_transcript_biotypes(file_hash, gene_set_id, gene_hgnc):
+    return __get_gene_effect_values('transcript_biotype', file_hash, gene_set_id, gene_hgnc)
 
 
-def get_effects(file_hash, gene_hgnc):
+def get_effects(file_hash, gene_set_id, gene_hgnc):
+    return __get_gene_effect_values('effect', file_hash, gene_set_id, gene_hgnc)
+
+
+def get_impacts(file_hash, gene_set_id, gene_hgnc):
+    return __get_gene_effect_values('impact', file_hash, gene_set_id, gene_hgnc)
+
+
+def get_feature_types(file_hash, gene_set_id, gene_hgnc):
     query = """
-    SELECT DISTINCT effect
+    SELECT DISTINCT feature_type
     FROM annotations
     WHERE file_hash = ?
+      AND gene_set_id = ?
       AND gene_hgnc = ?
       AND effect NOT IN ('intergenic_region')
     """
-    return db.read_query(query, (file_hash, gene_hgnc))['effect'].tolist()
+    return db.read_query(query, (file_hash, gene_set_id, gene_hgnc))['feature_type'].tolist()
 
 
-def get_impacts(file_hash, gene_hgnc):
+def get_numeric_info_fields(file_hash, gene_set_id, gene_hgnc):
+    """
+    Returns the INFO fields with numeric values of the variants of the gene,
+    with the range of their values, which can be used as info_filters.
+    """
     query = """
-    SELECT DISTINCT impact
-    FROM annotations
+    SELECT key, min(number_value) AS min_value, max(number_value) AS max_value
+    FROM info_values
     WHERE file_hash = ?
+      AND gene_set_id = ?
       AND gene_hgnc = ?
-      AND effect NOT IN ('intergenic_region')
+      AND number_value IS NOT NULL
+    GROUP BY key
+    ORDER BY key
     """
-    return db.read_query(query, (file_hash, gene_hgnc))['impact'].tolist()
+    return db.read_query(query, (file_hash, gene_set_id, gene_hgnc)).to_dict('records')
 
 
-def get_feature_types(file_hash, gene_hgnc):
-    query = """
-    SELECT DISTINCT feature_type
-    FROM annotations
-    WHERE file_hash = ?
-      AND gene_hgnc = ?
-      AND effect NOT IN ('intergenic_region')
+def get_genotypes(file_hash, gene_set_id, gene_hgnc, variations=None, samples=None):
+    """
+    Returns the Genotypes of the given variants (gene_variation ids or a slice of them)
+    and samples (names, indexes or a slice of indexes) of a gene, all of them by default.
+    Only the bytes of the range of the requested samples are read from the database.
     """
-    return db.read_query(query, (file_hash, gene_hgnc))['feature_type'].tolist()
+    sample_names = db.get_samples(file_hash, gene_set_id)
+    sample_indexes, first_sample, last_sample = genotypes.get_sample_range(sample_names, samples)
+    rows = db.get_genotypes(file_hash, gene_set_id, gene_hgnc, variations, first_sample, last_sample)
+    return genotypes.decode_genotypes(rows, sample_names, sample_indexes, first_sample, last_sample)
@@ -0,0 +1,202 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+from bgzf import open_vcf
+from config import CONFIG
+from db import get_cached_annotations
+from db import save_cached_annotations
+from db import touch_cached_annotations
+from db import get_cached_annotation_header
+from db import save_cached_annotation_header
+from db import update_annotation_cache_stats
+
+
+# Number of records that are looked up in (or saved to) the cache at once
+CACHE_CHUNK_SIZE = 100000
+
+# Written in place of the records that are not cached, until they are annotated by SnpEff
+MISSING_RECORD = b'\0\n'
+
+KEY_COLUMNS = ['chrom', 'pos', 'ref', 'alt']
+
+
+def __split_record(line):
+    return line.rstrip(b'\n').split(b'\t', 8)
+
+
+def __get_key(fields):
+    """
+    Returns the normalized key of a variant: the chromosome without the 'chr' prefix,
+    the position and the upper-case REF and ALT.
+    """
+    chrom = fields[0].decode('utf-8')
+    if chrom.startswith('chr'):
+        chrom = chrom[3:]
+    return chrom, int(fields[1]), fields[3].upper().decode('utf-8'), fields[4].upper().decode('utf-8')
+
+
+def __is_cacheable(fields):
+    # SnpEff replaces existing annotations, which can't be restored from the cache
+    return b'ANN=' not in fields[7]
+
+
+def __add_annotation(fields, annotation):
+    if annotation:
+        info = fields[7]
+        fields[7] = annotation if info in (b'', b'.') else info + b';' + annotation
+    return b'\t'.join(fields) + b'\n'
+
+
+def __get_added_info(original_fields, annotated_fields):
+    original_info = set(original_fields[7].split(b';'))
+    added = [field for field in annotated_fields[7].split(b';') if field not in original_info and field != b'.']
+    return b';'.join(added)
+
+
+def __write_cached_records(records, genome, snpeff_version, template, misses):
+    """
+    Writes the records whose annotation is cached (with the annotation added) to template,
+    and MISSING_RECORD to template and the record to misses for the others.
+    Returns the keys of the cached records.
+    """
+    records = [__split_record(line) for line in records]
+    keys = pd.DataFrame([__get_key(fields) for fields in records], columns=KEY_COLUMNS)
+    annotations = get_cached_annotations(genome, snpeff_version, keys)
+
+    hits = np.zeros(len(records), dtype=bool)
+    for i, (fields, annotation) in enumerate(zip(records, annotations)):
+        if annotation is not None and __is_cacheable(fields):
+            template.write(__add_annotation(fields, annotation.encode('utf-8')))
+            hits[i] = True
+        else:
+            template.write(MISSING_RECORD)
+            misses.write(b'\t'.join(fields) + b'\n')
+    return keys[hits]
+
+
+def __split_by_cache(vcf_file, genome, snpeff_version, template_file, misses_file):
+    """
+    Writes the cached records of the VCF to template_file and the others to the
+    misses_file VCF (see __write_cached_records). The last use time of the cached
+    annotations is updated at the end, so that the lookups don't wait for the writes.
+    Returns the header lines of the VCF and the numbers of cached and not cached records.
+    """
+    header_lines = []
+    records = 0
+    hit_keys = []
+    with open_vcf(vcf_file) as vcf, open(template_file, 'wb') as template, open(misses_file, 'wb') as misses:
+        chunk = []
+        for line in vcf:
+            if line.startswith(b'#'):
+                header_lines.append(line)
+                misses.write(line)
+                continue
+
+            chunk.append(line)
+            if len(chunk) == CACHE_CHUNK_SIZE:
+                hit_keys.append(__write_cached_records(chunk, genome, snpeff_version, template, misses))
+                records += len(chunk)
+                chunk = []
+
+        if chunk:
+            hit_keys.append(__write_cached_records(chunk, genome, snpeff_version, template, misses))
+            records += len(chunk)
+
+    hit_keys = pd.concat(hit_keys) if hit_keys else pd.DataFrame(columns=KEY_COLUMNS)
+    touch_cached_annotations(genome, snpeff_version, hit_keys)
+    return header_lines, len(hit_keys), records - len(hit_keys)
+
+
+def __save_annotations(genome, snpeff_version, annotations):
+    annotations = pd.DataFrame(annotations, columns=KEY_COLUMNS + ['annotation'])
+    return save_cached_annotations(genome, snpeff_version, annotations, CONFIG.get('annotation_cache_max_entries'))
+
+
+def __merge_annotated_records(annotated_lines, header_lines, genome, snpeff_version, template_file, misses_file, stats):
+    """
+    Yields the header from annotated_lines and the records from template_file,
+    with the MISSING_RECORDs replaced by the next records from annotated_lines.
+    The annotations of the records from annotated_lines are saved to the cache.
+    """
+    snpeff_header = []
+    for line in annotated_lines:
+        snpeff_header.append(line)
+        if not line.startswith(b'##'):
+            break
+    yield from snpeff_header
+
+    added_header = [line for line in snpeff_header[:-1] if line not in header_lines]
+    save_cached_annotation_header(genome, snpeff_version, b''.join(added_header).decode('utf-8'))
+
+    new_annotations = []
+    with open(template_file, 'rb') as template, open(misses_file, 'rb') as misses:
+        originals = (line for line in misses if not line.startswith(b'#'))
+        for line in template:
+            if line != MISSING_RECORD:
+                yield line
+                continue
+
+            annotated = next(annotated_lines)
+            original_fields = __split_record(next(originals))
+            yield annotated
+
+            if __is_cacheable(original_fields):
+                added = __get_added_info(original_fields, __split_record(annotated))
+                new_annotations.append(__get_key(original_fields) + (added.decode('utf-8'),))
+
+            if len(new_annotations) == CACHE_CHUNK_SIZE:
+                stats['evictions'] += __save_annotations(genome, snpeff_version, new_annotations)
+                new_annotations = []
+
+    # let the annotation process finish
+    for _ in annotated_lines:
+        pass
+
+    if new_annotations:
+        stats['evictions'] += __save_annotations(genome, snpeff_version, new_annotations)
+
+
+def __with_cached_header(header_lines, cached_header):
+    """
+    Yields the header lines with the header lines added by SnpEff
+    inserted before the #CHROM line, the same way SnpEff does it.
+    """
+    yield from header_lines[:-1]
+    yield from cached_header.encode('utf-8').splitlines(keepends=True)
+    yield header_lines[-1]
+
+
+def annotate_with_cache(vcf_file, genome, snpeff_version, annotate, tmp_dir):
+    """
+    Yields the lines of the annotated VCF file. The annotations of the variants that were
+    annotated before (with the same genome and SnpEff version) are taken from the cache
+    and only the other records are annotated with the given function, which takes
+    a VCF file and returns the lines of the annotated VCF. The records keep their order
+    and the new annotations are saved to the cache.
+    """
+    # jobs of the same file (for different gene sets) can run at the same time
+    work_dir = tempfile.mkdtemp(prefix='cache_', dir=tmp_dir)
+    template_file = os.path.join(work_dir, 'cache_template')
+    misses_file = os.path.join(work_dir, 'cache_misses.vcf')
+    stats = {'evictions': 0}
+
+    try:
+        header_lines, hits, misses = __split_by_cache(vcf_file, genome, snpeff_version, template_file, misses_file)
+        cached_header = get_cached_annotation_header(genome, snpeff_version)
+        if misses == 0 and cached_header is not None and header_lines:
+            yield from __with_cached_header(header_lines, cached_header)
+            with open(template_file, 'rb') as template:
+                yield from template
+        else:
+            annotated_lines = iter(annotate(misses_file))
+            yield from __merge_annotated_records(
+                annotated_lines, header_lines, genome, snpeff_version, template_file, misses_file, stats)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    update_annotation_cache_stats(genome, snpeff_version, hits, misses, stats['evictions'])
+    print('Annotation cache: {} hits, {} misses ({:.1%} hit rate), {} evicted'.format(
+        hits, misses, hits / max(hits + misses, 1), stats['evictions']))
@@ -2,7 +2,9 @@ from flask import Flask
 from babel import dates
 
 from .main import main as main_blueprint
+from .main import scheduler
 
+import db
 from config import CONFIG
 
 
@@ -14,11 +16,35 @@ def create_app():
 
     app.register_blueprint(main_blueprint)
 
+    # the files processed before the checkpoints and the summaries were saved (only runs once)
+    db.save_missing_checkpoints()
+    db.save_missing_summaries()
+
+    # start the queued jobs, including the ones interrupted by a restart
+    scheduler.start()
+
     @app.template_filter()
     def format_datetime(value, format='medium'):
         format="HH:mm dd.MM.y"
         return dates.format_datetime(value, format)
 
+    @app.template_filter()
+    def format_duration(seconds):
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        if hours:
+            return '{}h {}m'.format(hours, minutes)
+        if minutes:
+            return '{}m {}s'.format(minutes, seconds)
+        return '{}s'.format(seconds)
+
+    @app.template_filter()
+    def format_stat(value, format='{:g}'):
+        # the statistics of variants without genotypes are missing (NaN)
+        if value is None or value != value:
+            return ''
+        return format.format(value)
+
     @app.template_filter()
     def normalize_chromosome(chrom):
         if chrom.startswith('chr'):
@@ -1,6 +1,7 @@
 import os
-import threading
 import json
+import base64
+import tempfile
 import functools
 from datetime import datetime
 from flask import Flask
@@ -12,6 +13,8 @@ from flask import redirect
 from flask import url_for
 from flask import Markup
 from flask import send_from_directory
+from flask import jsonify
+from flask import abort
 from werkzeug.utils import secure_filename
 import pandas as pd
 
@@ -19,7 +22,13 @@ import db
 import analysis
 import utils
 import proteins
-from tasks import parse
+import progress
+from config import CONFIG
+from jobs import JobScheduler
+from uploads import ChunkedUploads
+from uploads import UploadException
+from uploads import UploadOffsetException
+from uploads import get_upload_path
 from external import get_hgnc_info
 from external import get_protein_seq_from_transcript_id
 from external import get_protein_annotation_from_nextprot
@@ -30,18 +39,26 @@ from vcf_processing import validate_and_get_genome_reference
 
 main = Blueprint('main', __name__)
 
-GENES_FILE = 'data/genes.csv'
-
 UPLOAD_FOLDER = 'uploads'
 VCF_EXTENSIONS = {'vcf', 'vcf.gz'}
+VARIANTS_PAGE_SIZE = 100
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+scheduler = JobScheduler(CONFIG.get('max_running_jobs', 1), CONFIG.get('jobs_memory_gb'))
+uploads = ChunkedUploads(UPLOAD_FOLDER)
+
 
 @main.route("/")
 def files():
     files = db.get_files()
+    jobs = {(job['file_hash'], job['gene_set_id']): job for job in db.get_jobs()}
+    for file in files:
+        file['job'] = jobs.get((file['hash'], file['gene_set_id']))
+        file['progress'] = []
+        if file['job'] and file['job']['status'] == db.JOB_RUNNING:
+            file['progress'] = progress.get_progress(file['hash'], file['gene_set_id'])
     return render_template('files.html', files=files)
 
 
@@ -80,6 +97,48 @@ def upload_vcf_page():
     return render_template('upload_vcf.html', gene_sets=gene_sets)
 
 
+def __get_existing_file_message(vcf_sha, gene_set_id):
+    """
+    Returns the (category, message) to show if the file with the given hash is
+    already processed or queued for processing for the gene set, otherwise None.
+    """
+    existing_row = db.get_file(vcf_sha, gene_set_id)
+    if existing_row and existing_row['status'] == 'processed':
+        return 'info', Markup('File has already been uploaded and processed. <a href="/files/{}">Link to existing file</a>'.format(vcf_sha))
+
+    if db.get_active_job(vcf_sha, gene_set_id):
+        return 'info', Markup('File is already queued for processing.')
+
+    return None
+
+
+def __queue_uploaded_file(filename, path, vcf_sha, gene_set_id):
+    """
+    Validates the uploaded file and queues it for processing with the gene set.
+    Returns the id of the job (None if the file can't be processed) and the (category, message) to show.
+    """
+    try:
+        header = get_header_lines(path)
+        validate_vcf_version(header)
+        reference_genome = validate_and_get_genome_reference(header)
+    except VCFParsingException as e:
+        return None, ('danger', Markup('Cannot process the VCF file: {}').format(str(e)))
+
+    if db.get_file(vcf_sha, gene_set_id):
+        message = 'File was not fully processed before. It is queued to resume processing in the background.'
+    else:
+        db.save_file(filename, vcf_sha, path, reference_genome, gene_set_id, datetime.now())
+        message = 'File uploaded. It is queued for processing in the background. This may take a couple of minutes depending on the size of the file and the number of files before it.'
+
+    job_id = scheduler.submit(path, vcf_sha, gene_set_id)
+    return job_id, ('success', Markup(message + ' <a href="/jobs/{}">Job status</a>'.format(job_id)))
+
+
+def __message_json(status, message, **kwargs):
+    category, text = message
+    return jsonify(dict(kwargs, status=status, category=category, message=str(text)))
+
+
 @main.route('/files/new', methods=['POST'])
 @validate_file_upload
 def upload_vcf():
@@ -91,34 +150,92 @@ def upload_vcf():
 
     if file:
         filename = secure_filename(file.filename)
-        path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(path)
-
-        vcf_sha = utils.sha256sum(path)
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        fd, part_path = tempfile.mkstemp(suffix='.part', dir=app.config['UPLOAD_FOLDER'])
+        os.close(fd)
+        # the file is hashed while it's saved, so it's not read again
+        vcf_sha = utils.save_and_hash(file.stream, part_path)
+        path = get_upload_path(app.config['UPLOAD_FOLDER'], vcf_sha, filename)
+        os.replace(part_path, path)
         gene_set_id = request.form['gene_set']
 
-        existing_row = db.get_file(vcf_sha, gene_set_id)
-        if existing_row:
-            flash(Markup('File has already been uploaded and processed. <a href="/files/{}">Link to existing file</a>'.format(vcf_sha)), category='info')
-            return redirect(url_for('main.files'))
-
-        try:
-            header = get_header_lines(path)
-            validate_vcf_version(header)
-            reference_genome = validate_and_get_genome_reference(header)
-        except VCFParsingException as e:
-            flash('Cannot process the VCF file: ' + str(e), category='danger')
-            return redirect(url_for('main.files'))
-
-        db.save_file(filename, vcf_sha, path, reference_genome, gene_set_id, datetime.now())
+        message = __get_existing_file_message(vcf_sha, gene_set_id)
+        if message is None:
+            _, message = __queue_uploaded_file(filename, path, vcf_sha, gene_set_id)
+        category, text = message
+        flash(text, category=category)
+        return redirect(url_for('main.files'))
 
-        genes = db.get_genes_for_gene_set(gene_set_id)
-        utils.save_genes_to_file(genes, GENES_FILE)
 
-        th = threading.Thread(target=lambda: parse(path, GENES_FILE, gene_set_id))
-        th.start()
-        flash('File uploaded. Will start processing it in the background now. This may take a couple of minutes depending on the size of the file.', category='success')
-        return redirect(url_for('main.files'))
+@main.route('/uploads', methods=['POST'])
+def create_upload():
+    """
+    Starts a chunked upload. The body is JSON with the filename, size and gene_set
+    of the file and optionally its sha256. If a file with the given hash is already
+    processed, queued or stored on the server, no data has to be uploaded.
+    """
+    params = request.get_json()
+    filename = secure_filename(params.get('filename', ''))
+    gene_set_id = params.get('gene_set')
+    size = params.get('size')
+    vcf_sha = params.get('sha256')
+
+    if not is_vcf(filename) or not isinstance(size, int) or size < 0 or not gene_set_id:
+        return jsonify({'error': 'Please upload a VCF file.'}), 400
+
+    if vcf_sha:
+        message = __get_existing_file_message(vcf_sha, gene_set_id)
+        if message is not None:
+            return __message_json('exists', message)
+
+        known_file = db.get_file_by_hash(vcf_sha)
+        if known_file and os.path.exists(known_file['path']):
+            job_id, message = __queue_uploaded_file(filename, known_file['path'], vcf_sha, gene_set_id)
+            return __message_json('queued' if job_id else 'invalid', message, job_id=job_id)
+
+    upload_id = uploads.create(filename, size, gene_set_id, vcf_sha)
+    return jsonify({'status': 'uploading', 'upload_id': upload_id, 'offset': 0}), 201
+
+
+@main.route('/uploads/<upload_id>', methods=['GET'])
+def show_upload(upload_id):
+    try:
+        return jsonify({'upload_id': upload_id, 'offset': uploads.get_offset(upload_id)})
+    except UploadException as e:
+        return jsonify({'error': str(e)}), 404
+
+
+@main.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """
+    Appends the body of the request to the upload. The offset parameter is the position
+    of the chunk in the file. If it's not where the received data ends, responds with
+    409 and the offset from which the upload should continue.
+    """
+    offset = request.args.get('offset', type=int)
+    try:
+        return jsonify({'offset': uploads.append(upload_id, offset, request.stream)})
+    except UploadOffsetException as e:
+        return jsonify({'error': str(e), 'offset': e.offset}), 409
+    except UploadException as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@main.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    try:
+        path, vcf_sha, upload = uploads.complete(upload_id)
+    except UploadOffsetException as e:
+        return jsonify({'error': str(e), 'offset': e.offset}), 409
+    except UploadException as e:
+        return jsonify({'error': str(e)}), 400
+
+    message = __get_existing_file_message(vcf_sha, upload['gene_set_id'])
+    if message is not None:
+        return __message_json('exists', message)
+
+    job_id, message = __queue_uploaded_file(upload['filename'], path, vcf_sha, upload['gene_set_id'])
+    return __message_json('queued' if job_id else 'invalid', message, job_id=job_id)
 
 
 @main.route('/files/<sha>/<gene_set_id>')    
@@ -126,8 +243,8 @@ def file_summary(sha, gene_set_id):
     selected_chromosomes = request.args.getlist('chromosomes')
     file = db.get_file(sha, gene_set_id)
     gene_set = db.get_gene_set_by_id(file['gene_set_id'])
-    file_summary = analysis.file_summary(sha).to_dict('records')[0]
-    impact_summary = analysis.impact_summary(sha).to_dict('records')
+    file_summary = analysis.file_summary(sha, gene_set_id).to_dict('records')[0]
+    impact_summary = analysis.impact_summary(sha, gene_set_id).to_dict('records')
     chromosomes = list({row['chrom']: None for row in impact_summary})
 
     if selected_chromosomes:
@@ -143,8 +260,30 @@ def file_summary(sha, gene_set_id):
         selected_chromosomes=selected_chromosomes)
 
 
+@main.route('/files/<sha>/<gene_set_id>/progress')
+def file_progress(sha, gene_set_id):
+    stages = progress.get_progress(sha, gene_set_id)
+    for stage in stages:
+        for key in ('started_at', 'updated_at', 'finished_at'):
+            if stage[key] is not None:
+                stage[key] = stage[key].isoformat()
+    return jsonify(stages)
+
+
+@main.route('/stats/db')
+def db_stats():
+    # the time spent waiting for the database connection and lock, per db function
+    return jsonify(db.get_wait_stats())
+
+
 @main.route('/files/<sha>/<gene_set_id>/delete')
 def delete_file(sha, gene_set_id):
+    job = db.get_active_job(sha, gene_set_id)
+    if job and job['status'] == db.JOB_RUNNING:
+        scheduler.cancel(job['id'])
+        flash('The file is being processed. Cancelling it, try deleting it again in a moment.', category='info')
+        return redirect(url_for('main.files'))
+
     db.delete_file(sha, gene_set_id)
     flash('The file and all its information was deleted.', category='success')
     return redirect(url_for('main.files'))
@@ -159,6 +298,7 @@ def get_gene(sha, gene_set_id, gene_hgnc):
     selected_biotypes = request.args.getlist('biotypes')
     effects_summary = analysis.effects_by_impact_summary_for_gene(
         sha,
+        gene_set_id,
         gene_hgnc,
         biotypes=selected_biotypes
         ).to_dict('records')
@@ -172,7 +312,10 @@ def get_gene(sha, gene_set_id, gene_hgnc):
         row['order'] = ordering[row['impact'].lower()]
     effects_summary.sort(reverse=True, key=lambda row: row['order'])
 
-    transcript_biotypes = analysis.get_transcript_biotypes(sha, gene_hgnc)
+    transcript_biotypes = analysis.get_transcript_biotypes(sha, gene_set_id, gene_hgnc)
+    other_files = [
+        other for other in db.get_files_with_gene(gene_hgnc)
+        if other['hash'] != sha or str(other['gene_set_id']) != str(gene_set_id)]
 
     protein_annotation = get_protein_annotation_from_nextprot(hgnc_info['uniprot_ids'][0])
 
@@ -186,46 +329,139 @@ def get_gene(sha, gene_set_id, gene_hgnc):
         transcript_biotypes=transcript_biotypes,
         selected_biotypes=selected_biotypes,
         effects_summary=effects_summary,
+        other_files=other_files,
         protein_annotation=protein_annotation)
 
 
-@main.route('/files/<file_hash>/<gene_set_id>/<gene_hgnc>/variants')
-def get_gene_variants(file_hash, gene_set_id, gene_hgnc):
-    file = db.get_file(file_hash, gene_set_id)
-    gene_set = db.get_gene_set_by_id(gene_set_id)
-    hgnc_info = get_hgnc_info(gene_hgnc)
+def __to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def __get_info_filters(args):
+    """
+    Returns the (key, min_value, max_value) filters on numeric INFO fields
+    from the info_key, info_min and info_max request arguments.
+    """
+    keys = args.getlist('info_key')
+    min_values = args.getlist('info_min')
+    max_values = args.getlist('info_max')
+    filters = []
+    for i, key in enumerate(keys):
+        min_value = __to_float(min_values[i]) if i < len(min_values) else None
+        max_value = __to_float(max_values[i]) if i < len(max_values) else None
+        if key and (min_value is not None or max_value is not None):
+            filters.append((key, min_value, max_value))
+    return filters
+
+
+def __get_variant_filters(args):
+    """
+    Returns the filters of the variants (see db.get_variants) from the request arguments.
+    """
+    return {
+        'biotypes': args.getlist('biotypes'),
+        'effects': args.getlist('effects'),
+        'impacts': args.getlist('impacts'),
+        'feature_types': args.getlist('feature_types'),
+        'min_af': args.get('min_af', type=float),
+        'max_af': args.get('max_af', type=float),
+        'min_call_rate': args.get('min_call_rate', type=float),
+        'info_filters': __get_info_filters(args),
+        'rank': args.get('rank', type=int),
+        'min_prot_pos': args.get('min_prot_pos', type=int),
+        'max_prot_pos': args.get('max_prot_pos', type=int),
+        'max_distance': args.get('max_distance', type=int),
+    }
 
-    selected_biotypes = request.args.getlist('biotypes')
-    selected_effects = request.args.getlist('effects')
-    selected_impacts = request.args.getlist('impacts')
-    selected_feature_types = request.args.getlist('feature_types')
 
+def __get_variants_sort(args):
+    sort = args.get('sort')
+    if sort not in db.VARIANT_SORT_COLUMNS:
+        sort = 'start_pos'
+    return sort, args.get('order') == 'desc'
+
+
+def __encode_cursor(variant):
+    cursor = json.dumps([float(variant['sort_key']), int(variant['gene_variation'])])
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def __decode_cursor(cursor):
+    try:
+        sort_key, gene_variation = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(sort_key), int(gene_variation)
+    except (TypeError, ValueError):
+        abort(400)
+
+
+def __get_variants_page(file_hash, gene_set_id, gene_hgnc, args):
+    """
+    Returns a page of the variants of the gene matching the filters of the request
+    sorted as requested, starting after its cursor argument, and the cursor of the next
+    page (None for the last page).
+    """
+    sort, descending = __get_variants_sort(args)
+    cursor = args.get('cursor')
     variants_df = db.get_variants(
         file_hash,
         gene_set_id,
         gene_hgnc,
-        biotypes=selected_biotypes,
-        effects=selected_effects,
-        impacts=selected_impacts,
-        feature_types=selected_feature_types
-    )
+        **__get_variant_filters(args),
+        sort=sort,
+        descending=descending,
+        after=__decode_cursor(cursor) if cursor else None,
+        # one more variant tells whether there is a next page
+        limit=VARIANTS_PAGE_SIZE + 1)
+
+    next_cursor = None
+    if len(variants_df) > VARIANTS_PAGE_SIZE:
+        variants_df = variants_df.iloc[:VARIANTS_PAGE_SIZE]
+        next_cursor = __encode_cursor(variants_df.iloc[-1])
 
-    transcript_biotypes = analysis.get_transcript_biotypes(file_hash, gene_hgnc)
-    effects = analysis.get_effects(file_hash, gene_hgnc)
-    impacts = analysis.get_impacts(file_hash, gene_hgnc)
-    feature_types = analysis.get_feature_types(file_hash, gene_hgnc)
+    # the missing statistics (NaN) become null and the arrays lists
+    variants = json.loads(variants_df.drop(columns=['sort_key']).to_json(orient='records'))
+    return variants, next_cursor
+
+
+@main.route('/files/<file_hash>/<gene_set_id>/<gene_hgnc>/variants')
+def get_gene_variants(file_hash, gene_set_id, gene_hgnc):
+    file = db.get_file(file_hash, gene_set_id)
+    gene_set = db.get_gene_set_by_id(gene_set_id)
+    hgnc_info = get_hgnc_info(gene_hgnc)
+
+    filters = __get_variant_filters(request.args)
+    sort, descending = __get_variants_sort(request.args)
+    variants, next_cursor = __get_variants_page(file_hash, gene_set_id, gene_hgnc, request.args)
+
+    # the links of the table headers sort by the column, reversing the order of the current one
+    args = request.args.to_dict(flat=False)
+    args.pop('cursor', None)
+    sort_urls = {}
+    for column in db.VARIANT_SORT_COLUMNS:
+        order = 'desc' if column == sort and not descending else 'asc'
+        sort_urls[column] = url_for(
+            'main.get_gene_variants', file_hash=file_hash, gene_set_id=gene_set_id, gene_hgnc=gene_hgnc,
+            **dict(args, sort=column, order=order))
+    page_url = url_for(
+        'main.get_gene_variants_page', file_hash=file_hash, gene_set_id=gene_set_id, gene_hgnc=gene_hgnc, **args)
+
+    transcript_biotypes = analysis.get_transcript_biotypes(file_hash, gene_set_id, gene_hgnc)
+    effects = analysis.get_effects(file_hash, gene_set_id, gene_hgnc)
+    impacts = analysis.get_impacts(file_hash, gene_set_id, gene_hgnc)
+    feature_types = analysis.get_feature_types(file_hash, gene_set_id, gene_hgnc)
+    info_fields = analysis.get_numeric_info_fields(file_hash, gene_set_id, gene_hgnc)
 
     chromosome = db.get_chromosome_for_gene(gene_hgnc)
-    min_variant_pos = variants_df['start_pos'].min()
-    max_variant_pos = variants_df['end_pos'].max()
+    extent = db.get_variants_extent(file_hash, gene_set_id, gene_hgnc)
+    min_variant_pos = extent['start_pos'] or 0
+    max_variant_pos = extent['end_pos'] or 0
     distance = max_variant_pos - min_variant_pos
     start_pos = max(min_variant_pos - 0.1*distance, 0)
     end_pos = max_variant_pos + 0.1*distance
 
-    variants = variants_df.to_dict('records')
-
-    # info = pd.json_normalize(variants['info'].apply(lambda i: json.loads(i)), max_level=1)
-    # variants = pd.concat([variants.drop(['info'], axis=1), info], axis=1)
     return render_template(
         'variants.html',
         file=file,
@@ -233,19 +469,42 @@ def get_gene_variants(file_hash, gene_set_id, gene_hgnc):
         hgnc_info=hgnc_info,
         gene_hgnc=gene_hgnc,
         variants=variants,
+        next_cursor=next_cursor,
+        page_url=page_url,
+        sort_urls=sort_urls,
+        sort=sort,
+        descending=descending,
+        # all the variants of the gene, an upper bound of the filtered ones
+        variants_count=extent['count'],
+        filtered=any(value not in (None, []) for value in filters.values()),
         transcript_biotypes=transcript_biotypes,
-        selected_biotypes=selected_biotypes,
+        selected_biotypes=filters['biotypes'],
         effects=effects,
-        selected_effects=selected_effects,
+        selected_effects=filters['effects'],
         impacts=impacts,
-        selected_impacts=selected_impacts,
+        selected_impacts=filters['impacts'],
         feature_types=feature_types,
-        selected_feature_types=selected_feature_types,
+        selected_feature_types=filters['feature_types'],
+        min_af=filters['min_af'],
+        max_af=filters['max_af'],
+        min_call_rate=filters['min_call_rate'],
+        info_fields=info_fields,
+        info_filters=filters['info_filters'],
+        rank=filters['rank'],
+        min_prot_pos=filters['min_prot_pos'],
+        max_prot_pos=filters['max_prot_pos'],
+        max_distance=filters['max_distance'],
         chromosome=chromosome,
         start_pos=start_pos,
         end_pos=end_pos)
 
 
+@main.route('/files/<file_hash>/<gene_set_id>/<gene_hgnc>/variants.json')
+def get_gene_variants_page(file_hash, gene_set_id, gene_hgnc):
+    variants, next_cursor = __get_variants_page(file_hash, gene_set_id, gene_hgnc, request.args)
+    return jsonify({'variants': variants, 'next_cursor': next_cursor})
+
+
 @main.route('/files/<file_hash>/<gene_set_id>/<gene_hgnc>/variants/<variant_id>')
 def show_variant(file_hash, gene_set_id, gene_hgnc, variant_id):
     file = db.get_file(file_hash, gene_set_id)
@@ -377,6 +636,11 @@ def add_gene_to_gene_set(id):
 
     db.save_gene_set_member(name, gene_set['id'])
 
+    # load only the new gene for the files that were already processed with this gene set
+    for file in db.get_files():
+        if file['gene_set_id'] == gene_set['id'] and file['status'] == 'processed' and os.path.exists(file['path']):
+            scheduler.submit(file['path'], file['hash'], gene_set['id'])
+
     flash('The gene was added to the dataset', category='success')
     return redirect(url_for('main.show_gene_set', id=gene_set['id']))
 
@@ -388,6 +652,43 @@ def delete_gene_set_member(gene_set_id, member_id):
     return redirect(url_for('main.show_gene_set', id=gene_set_id))
 
 
+def __job_to_json(job):
+    return {
+        'id': int(job['id']),
+        'file_hash': job['file_hash'],
+        'gene_set_id': int(job['gene_set_id']),
+        'status': job['status'],
+        'queue_position': None if pd.isna(job['queue_position']) else int(job['queue_position']),
+        'error': None if pd.isna(job['error']) else job['error'],
+        'created_at': job['created_at'].isoformat(),
+        'started_at': None if pd.isna(job['started_at']) else job['started_at'].isoformat(),
+        'finished_at': None if pd.isna(job['finished_at']) else job['finished_at'].isoformat(),
+    }
+
+
+@main.route('/jobs')
+def list_jobs():
+    jobs = db.get_jobs()
+    return jsonify([__job_to_json(job) for job in jobs])
+
+
+@main.route('/jobs/<int:id>')
+def show_job(id):
+    job = db.get_job(id)
+    if not job:
+        abort(404)
+    return jsonify(__job_to_json(job))
+
+
+@main.route('/jobs/<int:id>/cancel')
+def cancel_job(id):
+    if scheduler.cancel(id):
+        flash('The processing of the file was cancelled. Upload it again to continue where it stopped.', category='success')
+    else:
+        flash('The job is not queued or running.', category='info')
+    return redirect(url_for('main.files'))
+
+
 @main.route('/gencode40')
 def get_gencode40():
     file_name = 'gencode.v40.annotation.sorted.gtf.gz'
@@ -0,0 +1,157 @@
+"""
+Benchmark of the queries of the gene pages. Loads the same genes for a growing number
+of files into a temporary database and measures the latency of the queries of the gene
+and variants pages after every step. As the rows of each gene of a file are stored
+together (see db.CLUSTER_KEYS), the latency should stay flat as the files are added.
+
+Run it from the root directory of the repository:
+
+    python src/benchmark.py --files 100 --step 20
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import hashlib
+import tempfile
+
+from datetime import datetime
+
+import yaml
+import numpy as np
+
+
+SAMPLES = ['S1', 'S2', 'S3', 'S4']
+EFFECTS = [
+    ('missense_variant', 'MODERATE'),
+    ('synonymous_variant', 'LOW'),
+    ('stop_gained', 'HIGH'),
+    ('intron_variant', 'MODIFIER'),
+]
+BIOTYPES = ['protein_coding', 'nonsense_mediated_decay', 'retained_intron']
+
+
+def __get_annotation(alt, gene, i, transcript):
+    effect, impact = EFFECTS[(i + transcript) % len(EFFECTS)]
+    return '|'.join([
+        alt, effect, impact, gene, 'ENSG_' + gene, 'transcript', 'ENST_{}_{}'.format(gene, transcript),
+        BIOTYPES[transcript % len(BIOTYPES)], '{}/10'.format(i % 10 + 1), 'c.{}A>G'.format(i), '',
+        '{}/3000'.format(i), '{}/2000'.format(i), '{}/600'.format(i // 3 + 1), '', ''])
+
+
+def write_gene_vcf(path, gene, gene_index, variants):
+    """
+    Writes an annotated VCF with the given number of variants of the gene,
+    each with an annotation per transcript and the genotypes of the SAMPLES.
+    """
+    rng = random.Random(gene_index)
+    with open(path, 'w') as vcf:
+        vcf.write('##fileformat=VCFv4.2\n')
+        vcf.write('##INFO=<ID=DP,Number=1,Type=Integer,Description="Depth">\n')
+        vcf.write('##INFO=<ID=ANN,Number=.,Type=String,Description="Functional annotations">\n')
+        vcf.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        vcf.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t' + '\t'.join(SAMPLES) + '\n')
+        for i in range(variants):
+            annotations = ','.join(__get_annotation('G', gene, i, transcript) for transcript in range(3))
+            gts = '\t'.join(rng.choice(['0/0', '0/1', '1/1', './.']) for _ in SAMPLES)
+            vcf.write('1\t{}\t.\tA\tG\t50\tPASS\tDP={};ANN={}\tGT\t{}\n'.format(
+                gene_index * 1000000 + i * 10 + 1, rng.randint(1, 100), annotations, gts))
+
+
+def load_file(db, parsed_genes, file_number, gene_set_id):
+    sha = hashlib.sha256(str(file_number).encode()).hexdigest()
+    db.save_file('file_{}.vcf'.format(file_number), sha, '', 'GRCh38', gene_set_id, datetime.now())
+    loader = db.GeneDataLoader(sha, gene_set_id)
+    for gene, chunk in parsed_genes.items():
+        loader.add_gene(gene)
+        loader.add(gene, *chunk)
+        loader.finish_gene(gene)
+    loader.flush()
+    db.publish_staging_database(sha, gene_set_id)
+    return sha
+
+
+def time_gene_pages(db, analysis, files, genes, gene_set_id, repeats):
+    """
+    Returns the latencies (in ms) of the queries of the gene and variants pages
+    of random genes of the given files.
+    """
+    latencies = []
+    for _ in range(repeats):
+        sha = random.choice(files)
+        gene = random.choice(genes)
+        started = time.perf_counter()
+        db.get_file(sha, gene_set_id)
+        db.get_chromosome_for_gene(gene)
+        db.get_files_with_gene(gene)
+        analysis.effects_by_impact_summary_for_gene(sha, gene_set_id, gene)
+        analysis.get_transcript_biotypes(sha, gene_set_id, gene)
+        db.get_variants(sha, gene_set_id, gene, limit=101)
+        db.get_variants_extent(sha, gene_set_id, gene)
+        analysis.get_effects(sha, gene_set_id, gene)
+        analysis.get_impacts(sha, gene_set_id, gene)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmark', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=100, help='number of files loaded in total')
+    parser.add_argument('--step', type=int, default=20, help='number of files loaded between the measurements')
+    parser.add_argument('--genes', type=int, default=20, help='number of genes per file')
+    parser.add_argument('--variants', type=int, default=6000, help='number of variants per gene')
+    parser.add_argument('--repeats', type=int, default=50, help='number of measured page loads per step')
+    parser.add_argument('--storage', choices=['duckdb', 'parquet'], help='storage of the data (by default the one of config.yml)')
+    args = parser.parse_args()
+
+    # the database and the staging files are created in the working directory
+    workdir = tempfile.mkdtemp(prefix='polymorpheus_benchmark_')
+    with open('config.yml') as ymlfile:
+        config = yaml.safe_load(ymlfile)
+    if args.storage:
+        config['storage'] = args.storage
+    with open(os.path.join(workdir, 'config.yml'), 'w') as ymlfile:
+        yaml.safe_dump(config, ymlfile)
+    os.chdir(workdir)
+
+    import db
+    import analysis
+    from vcf_processing import parse_vcf
+
+    try:
+        genes = ['GENE{}'.format(i) for i in range(args.genes)]
+        parsed_genes = {}
+        for i, gene in enumerate(genes):
+            path = os.path.join(workdir, gene + '.vcf')
+            write_gene_vcf(path, gene, i, args.variants)
+            parsed_genes[gene] = parse_vcf(path)
+
+        db.save_gene_set('benchmark', 'Genes of the benchmark', genes)
+        gene_set_id = db.get_gene_sets()[-1]['id']
+
+        print('{:>6} {:>12} {:>12} {:>12} {:>10}'.format('files', 'annotations', 'median (ms)', 'p95 (ms)', 'load (s)'))
+        files = []
+        while len(files) < args.files:
+            started = time.perf_counter()
+            for _ in range(min(args.step, args.files - len(files))):
+                files.append(load_file(db, parsed_genes, len(files), gene_set_id))
+            load_time = time.perf_counter() - started
+
+            latencies = time_gene_pages(db, analysis, files, genes, gene_set_id, args.repeats)
+            annotations = db.read_query('SELECT count(*) AS count FROM annotations', ())['count'][0]
+            print('{:>6} {:>12} {:>12.1f} {:>12.1f} {:>10.1f}'.format(
+                len(files), annotations, np.median(latencies), np.percentile(latencies, 95), load_time))
+            sys.stdout.flush()
+
+        started = time.perf_counter()
+        db.delete_file(files[0], gene_set_id)
+        print('deleting a file took {:.2f} s'.format(time.perf_counter() - started))
+    finally:
+        os.chdir('/')
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+import io
+import os
+import gzip
+import zlib
+import struct
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from config import CONFIG
+
+
+# Number of BGZF blocks (of at most 64 KB each) that are decompressed by one task
+BLOCKS_PER_BATCH = 64
+
+# Size of the buffer of the decompressed data that is split into lines
+READ_BUFFER_SIZE = 1024 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+GZIP_FEXTRA = 4
+
+# gzip header up to and including XLEN
+HEADER = struct.Struct('<2sBBIBBH')
+
+# CRC32 and ISIZE
+TRAILER = struct.Struct('<II')
+
+
+def __get_block_size(extra):
+    """
+    Returns the size of the BGZF block from the BC subfield of the extra field
+    of its gzip header, or None if the block is not a BGZF block.
+    """
+    i = 0
+    while i + 4 <= len(extra):
+        subfield_id = extra[i:i + 2]
+        subfield_len = struct.unpack('<H', extra[i + 2:i + 4])[0]
+        if subfield_id == b'BC' and subfield_len == 2:
+            return struct.unpack('<H', extra[i + 4:i + 6])[0] + 1
+        i += 4 + subfield_len
+    return None
+
+
+def __read_block(raw):
+    """
+    Returns the next BGZF block (with its header) from the file, or None at the end of the file.
+    """
+    header = raw.read(HEADER.size)
+    if not header:
+        return None
+
+    magic, _, flags, _, _, _, extra_len = HEADER.unpack(header)
+    if magic != GZIP_MAGIC or not flags & GZIP_FEXTRA:
+        raise ValueError('Not a BGZF block')
+
+    extra = raw.read(extra_len)
+    block_size = __get_block_size(extra)
+    if block_size is None:
+        raise ValueError('Not a BGZF block')
+
+    return header + extra + raw.read(block_size - len(header) - len(extra))
+
+
+def __decompress_block(block):
+    extra_len = HEADER.unpack_from(block)[-1]
+    crc, size = TRAILER.unpack_from(block, len(block) - TRAILER.size)
+    data = zlib.decompress(block[HEADER.size + extra_len:-TRAILER.size], -zlib.MAX_WBITS)
+    if len(data) != size or zlib.crc32(data) != crc:
+        raise ValueError('Corrupted BGZF block')
+    return data
+
+
+def __decompress_batch(blocks):
+    return b''.join([__decompress_block(block) for block in blocks])
+
+
+def __read_batches(raw):
+    batch = []
+    while block := __read_block(raw):
+        batch.append(block)
+        if len(batch) == BLOCKS_PER_BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def __decompress(raw, threads):
+    """
+    Yields the decompressed data of the BGZF file in order. The blocks are independent,
+    so batches of them are decompressed by a pool of threads (zlib releases the GIL),
+    while the next ones are read. At most 2 batches per thread are held in memory.
+    """
+    if threads <= 1:
+        for batch in __read_batches(raw):
+            yield __decompress_batch(batch)
+        return
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for batch in __read_batches(raw):
+            pending.append(executor.submit(__decompress_batch, batch))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+class BgzfReader(io.RawIOBase):
+    """
+    Read-only raw stream of the decompressed data of a BGZF file.
+    """
+
+    def __init__(self, raw, chunks):
+        self.raw = raw
+        self.chunks = chunks
+        self.chunk = b''
+        self.chunk_pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.chunk_pos == len(self.chunk):
+            self.chunk = next(self.chunks, None)
+            self.chunk_pos = 0
+            if self.chunk is None:
+                self.chunk = b''
+                return 0
+
+        n = min(len(buffer), len(self.chunk) - self.chunk_pos)
+        buffer[:n] = self.chunk[self.chunk_pos:self.chunk_pos + n]
+        self.chunk_pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.chunks.close()
+            self.raw.close()
+        super().close()
+
+
+def is_bgzf(raw):
+    """
+    Checks if the file opened in binary mode is BGZF-compressed
+    (blocked gzip, as written by bgzip and htslib), without moving its position.
+    """
+    position = raw.tell()
+    header = raw.read(HEADER.size)
+    try:
+        if len(header) < HEADER.size:
+            return False
+        magic, _, flags, _, _, _, extra_len = HEADER.unpack(header)
+        return magic == GZIP_MAGIC and bool(flags & GZIP_FEXTRA) and __get_block_size(raw.read(extra_len)) is not None
+    finally:
+        raw.seek(position)
+
+
+def open_compressed(raw, threads=None):
+    """
+    Returns a buffered binary stream of the decompressed data of the gzipped file
+    opened (in binary mode) as raw. BGZF files are decompressed by the given number
+    of threads (decompression_threads from the config by default).
+    """
+    if threads is None:
+        threads = CONFIG.get('decompression_threads', 1)
+
+    if not is_bgzf(raw):
+        return gzip.GzipFile(fileobj=raw)
+    return io.BufferedReader(BgzfReader(raw, __decompress(raw, threads)), READ_BUFFER_SIZE)
+
+
+def open_vcf(file, mode='rb', threads=None):
+    """
+    Opens the (plain, gzipped or BGZF-compressed) VCF file for reading
+    in binary ('rb') or text ('rt') mode.
+    """
+    if not file.endswith('.gz'):
+        return open(file, 'r' if mode == 'rt' else mode)
+
+    raw = open(file, 'rb')
+    if not is_bgzf(raw):
+        raw.close()
+        return gzip.open(file, mode)
+
+    # closing the stream closes raw
+    stream = open_compressed(raw, threads)
+    if mode == 'rt':
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    return stream
+
+
+def get_index_file(file):
+    """
+    Returns the path of the tabix (.tbi) or CSI (.csi) index of the BGZF-compressed file,
+    or None if it's not indexed.
+    """
+    if not file.endswith('.gz'):
+        return None
+    for extension in ('.tbi', '.csi'):
+        if os.path.exists(file + extension):
+            return file + extension
+    return None
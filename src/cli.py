@@ -1,6 +1,7 @@
 import argparse
 import sys
 
+import db
 import tasks
 
 parser = argparse.ArgumentParser(prog='gene_variants')
@@ -10,6 +11,11 @@ subparsers = parser.add_subparsers(dest='subcommand', help='sub-command help')
 cmd_parser = subparsers.add_parser('parse', help='parse a VCF file')
 cmd_parser.add_argument('vcf_file', type=str, help='path to the input VCF file')
 cmd_parser.add_argument('genes_file', type=str, help='path to a file that includes one gene of interest per line (as an HGNC)')
+cmd_parser.add_argument('--jobs', type=int, default=None, help='number of worker processes used for parsing the per-gene VCFs (default: ingestion_jobs from config.yml)')
+
+subparsers.add_parser('cache_stats', help='show the hit rate and size of the annotation cache')
+
+subparsers.add_parser('summaries', help='save the summaries of the processed files that don\'t have them')
 
 # # create the parser for the "b" command
 # parser_b = subparsers.add_parser('b', help='b help')
@@ -23,7 +29,13 @@ args = parser.parse_args()
 
 if args.subcommand == 'parse':
     # TODO: save and pass gene set properly
-    tasks.parse(args.vcf_file, args.genes_file, -1)
+    tasks.parse(args.vcf_file, args.genes_file, -1, jobs=args.jobs)
+elif args.subcommand == 'cache_stats':
+    for stats in db.get_annotation_cache_stats():
+        print('{genome} ({snpeff_version}): {entries} entries, {hits} hits, {misses} misses '
+              '({hit_rate:.1%} hit rate), {evictions} evicted'.format(**stats))
+elif args.subcommand == 'summaries':
+    print('Summarized {} files'.format(db.save_missing_summaries(force=True)))
 else:
     print('no can do')
     exit(1)
\ No newline at end of file
@@ -1,21 +1,363 @@
+import os
+import sys
+import time
+import uuid
+import shutil
+import atexit
 import duckdb
 import json
+import logging
+import threading
 
 import numpy as np
+import pyarrow as pa
 
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime
 from utils import sha256sum
+from config import CONFIG
 
-from rwmutex import RWLock
 
-
-__lock = RWLock()
+logger = logging.getLogger(__name__)
 
 DATABASE = 'db.duckdb'
 
 
-with __lock.write:
-	db = duckdb.connect(database=DATABASE, read_only=False)
+class ConnectionManager:
+	"""
+	Keeps one DuckDB handle open for the whole process and gives each thread its own
+	cursor on it, instead of connecting to the database for every call.
+	Reads don't take any lock: DuckDB's MVCC lets them run while data is being written
+	(e.g. during the ingestion of a file) and they see the last committed data.
+	Writes are serialized by a lock, because concurrent transactions changing the same
+	rows would fail. The time each call waited for its cursor and the lock is logged
+	(at debug level) and summed up per function (see get_wait_stats).
+	The handle is opened by the first call in the process, which passes it to on_connect
+	(if given), so importing this module doesn't touch the database.
+	"""
+
+	def __init__(self, database, on_connect=None):
+		self.database = database
+		self.on_connect = on_connect
+		self.handle = None
+		self.pid = None
+		self.handle_lock = threading.Lock()
+		self.write_lock = threading.Lock()
+		self.local = threading.local()
+		self.stats_lock = threading.Lock()
+		self.wait_stats = {}
+
+	def read(self):
+		"""
+		Returns a context manager with the cursor of the current thread for reading.
+		"""
+		return self.__connect(sys._getframe(1).f_code.co_name, None)
+
+	def write(self):
+		"""
+		Returns a context manager with the cursor of the current thread,
+		holding the write lock. An unfinished transaction is rolled back on errors.
+		"""
+		return self.__connect(sys._getframe(1).f_code.co_name, self.write_lock)
+
+	def get_wait_stats(self):
+		with self.stats_lock:
+			return [
+				{'function': name, 'calls': calls, 'total_wait': total, 'max_wait': longest}
+				for name, (calls, total, longest) in sorted(self.wait_stats.items())]
+
+	def close(self):
+		with self.handle_lock:
+			if self.handle is not None and self.pid == os.getpid():
+				self.handle.close()
+			self.handle = None
+
+	@contextmanager
+	def __connect(self, name, lock):
+		started = time.perf_counter()
+		if lock is not None:
+			lock.acquire()
+		try:
+			cursor = self.__get_cursor()
+			self.__report_wait(name, time.perf_counter() - started)
+			try:
+				yield cursor
+			except BaseException:
+				self.__rollback(cursor)
+				raise
+		finally:
+			if lock is not None:
+				lock.release()
+
+	def __get_cursor(self):
+		with self.handle_lock:
+			if self.handle is None or self.pid != os.getpid():
+				# a forked worker process can't use the handle of its parent
+				self.handle = duckdb.connect(database=self.database, read_only=False)
+				self.pid = os.getpid()
+				self.local = threading.local()
+				if self.on_connect is not None:
+					self.on_connect(self.handle)
+
+			cursor = getattr(self.local, 'cursor', None)
+			if cursor is None:
+				cursor = self.local.cursor = self.handle.cursor()
+			return cursor
+
+	def __rollback(self, cursor):
+		try:
+			cursor.rollback()
+		except duckdb.Error:
+			# there was no active transaction
+			pass
+
+	def __report_wait(self, name, wait):
+		with self.stats_lock:
+			calls, total, longest = self.wait_stats.get(name, (0, 0.0, 0.0))
+			self.wait_stats[name] = (calls + 1, total + wait, max(longest, wait))
+		logger.debug('%s waited %.1f ms for the database', name, wait * 1000)
+
+
+# Columns by which the rows of each of the STAGED_TABLES are sorted when they are published.
+# This way the rows of each gene of a file are stored together, so that the min/max
+# statistics (zone maps) of the row groups let DuckDB skip the other files and genes.
+CLUSTER_KEYS = {
+	'genes': 'file_hash, gene_set_id, gene_hgnc',
+	'variants': 'file_hash, gene_set_id, gene_hgnc, gene_variation',
+	'annotations': 'file_hash, gene_set_id, gene_hgnc, gene_variation, variation_annotation',
+	'genotypes': 'file_hash, gene_set_id, gene_hgnc, gene_variation',
+	'info_values': 'file_hash, gene_set_id, gene_hgnc, gene_variation, key, value_index',
+}
+
+# Storage of the parsed data of the files (the PARTITIONED_TABLES), set by the storage option.
+# With duckdb it is kept in tables of the database. With parquet each file (and gene set)
+# has a hive-partitioned Parquet directory per table (see get_partition), read through
+# views with the names of the tables, so that the database holds only the metadata
+# and a file is deleted by removing its directories.
+STORAGE_DUCKDB = 'duckdb'
+STORAGE_PARQUET = 'parquet'
+STORAGE = CONFIG.get('storage', STORAGE_DUCKDB)
+
+PARQUET_FOLDER = 'data/parquet'
+
+# Tables of the parsed data that are stored in Parquet files by the parquet storage,
+# in the order of their foreign keys
+PARTITIONED_TABLES = ('variants', 'annotations', 'genotypes', 'info_values')
+
+# Partition with an empty Parquet file of each table, which gives the views
+# their columns before any file is published
+EMPTY_PARTITION = ('none', 0)
+
+DATA_TABLES_SCHEMA = """
+	CREATE TABLE IF NOT EXISTS variants (
+		file_hash VARCHAR(40) NOT NULL,
+		gene_set_id UINTEGER NOT NULL,
+		gene_hgnc VARCHAR NOT NULL,
+		gene_variation UINTEGER NOT NULL,
+
+		-- start of standard VCF-fields
+		chrom VARCHAR,
+		pos LONG,
+		id VARCHAR,
+		ref VARCHAR,
+		alt VARCHAR[],
+		qual DOUBLE,
+		filter VARCHAR[],
+		info JSON,
+		format VARCHAR,
+
+		-- start of additional PyVCF fields
+		start_pos UBIGINT,
+		end_pos UBIGINT,
+		alleles VARCHAR[],
+		affected_start UBIGINT,
+		affected_end UBIGINT,
+		var_type VARCHAR,
+		var_subtype VARCHAR,
+
+		-- start of cohort statistics, computed from the genotypes (see genotypes.get_cohort_stats)
+		an UINTEGER,
+		ac UINTEGER,
+		af DOUBLE,
+		het_count UINTEGER,
+		hom_ref_count UINTEGER,
+		hom_alt_count UINTEGER,
+		called_count UINTEGER,
+		call_rate DOUBLE,
+
+		PRIMARY KEY (file_hash, gene_set_id, gene_hgnc, gene_variation),
+		FOREIGN KEY(file_hash, gene_set_id, gene_hgnc) REFERENCES genes(file_hash, gene_set_id, gene_hgnc),
+	);
+
+	-- databases created before the cohort statistics were computed
+	ALTER TABLE variants ADD COLUMN IF NOT EXISTS an UINTEGER;
+	ALTER TABLE variants ADD COLUMN IF NOT EXISTS ac UINTEGER;
+	ALTER TABLE variants ADD COLUMN IF NOT EXISTS af DOUBLE;
+	ALTER TABLE variants ADD COLUMN IF NOT EXISTS het_count UINTEGER;
+	ALTER TABLE variants ADD COLUMN IF NOT EXISTS hom_ref_count UINTEGER;
+	ALTER TABLE variants ADD COLUMN IF NOT EXISTS hom_alt_count UINTEGER;
+	ALTER TABLE variants ADD COLUMN IF NOT EXISTS called_count UINTEGER;
+	ALTER TABLE variants ADD COLUMN IF NOT EXISTS call_rate DOUBLE;
+
+	CREATE TABLE IF NOT EXISTS annotations (
+		file_hash VARCHAR(40) NOT NULL,
+		gene_set_id UINTEGER NOT NULL,
+		gene_hgnc VARCHAR NOT NULL,
+		gene_variation UINTEGER NOT NULL,
+		variation_annotation UINTEGER NOT NULL,
+		
+		-- start of snpEff annotation fields
+		alt VARCHAR,
+		effect VARCHAR,
+		impact VARCHAR,
+		gene VARCHAR,
+		gene_id VARCHAR,
+		feature_type VARCHAR,
+		feature_id VARCHAR,
+		transcript_biotype VARCHAR,
+		rank_to_total VARCHAR,
+		hgvs_dna VARCHAR,
+		hgvs_protein VARCHAR,
+		cdna_pos_to_cdna_len VARCHAR,
+		cds_pos_to_cds_len VARCHAR,
+		prot_pos_to_prot_len VARCHAR,
+		distance_to_feature VARCHAR,
+		note VARCHAR,
+
+		-- start of the integer parts of the "position / total" fields above, for range queries
+		rank UINTEGER,
+		rank_total UINTEGER,
+		cdna_pos UINTEGER,
+		cdna_len UINTEGER,
+		cds_pos UINTEGER,
+		cds_len UINTEGER,
+		prot_pos UINTEGER,
+		prot_len UINTEGER,
+		distance INTEGER,
+
+		PRIMARY KEY (file_hash, gene_set_id, gene_hgnc, gene_variation, variation_annotation),
+		FOREIGN KEY(file_hash, gene_set_id, gene_hgnc, gene_variation) REFERENCES variants(file_hash, gene_set_id, gene_hgnc, gene_variation),
+	);
+
+	-- databases created before the positions of the annotations were parsed
+	ALTER TABLE annotations ADD COLUMN IF NOT EXISTS rank UINTEGER;
+	ALTER TABLE annotations ADD COLUMN IF NOT EXISTS rank_total UINTEGER;
+	ALTER TABLE annotations ADD COLUMN IF NOT EXISTS cdna_pos UINTEGER;
+	ALTER TABLE annotations ADD COLUMN IF NOT EXISTS cdna_len UINTEGER;
+	ALTER TABLE annotations ADD COLUMN IF NOT EXISTS cds_pos UINTEGER;
+	ALTER TABLE annotations ADD COLUMN IF NOT EXISTS cds_len UINTEGER;
+	ALTER TABLE annotations ADD COLUMN IF NOT EXISTS prot_pos UINTEGER;
+	ALTER TABLE annotations ADD COLUMN IF NOT EXISTS prot_len UINTEGER;
+	ALTER TABLE annotations ADD COLUMN IF NOT EXISTS distance INTEGER;
+
+	-- Genotypes of all samples of each variant, in the compact form from genotypes.py:
+	-- ploidy int8 allele codes per sample and a bit per sample for phased and missing.
+	CREATE TABLE IF NOT EXISTS genotypes (
+		file_hash VARCHAR(40) NOT NULL,
+		gene_set_id UINTEGER NOT NULL,
+		gene_hgnc VARCHAR NOT NULL,
+		gene_variation UINTEGER NOT NULL,
+		ploidy UTINYINT NOT NULL,
+		alleles BLOB NOT NULL,
+		phased BLOB NOT NULL,
+		missing BLOB NOT NULL,
+
+		PRIMARY KEY (file_hash, gene_set_id, gene_hgnc, gene_variation),
+		FOREIGN KEY(file_hash, gene_set_id, gene_hgnc, gene_variation) REFERENCES variants(file_hash, gene_set_id, gene_hgnc, gene_variation),
+	);
+
+	-- Values of the INFO fields of each variant with a type from the ##INFO header of the file
+	-- (or from the VCF specification), a row per value of the field, so that they can be filtered
+	-- without parsing JSON. Flags have a single row without a value. The fields of unknown keys
+	-- are kept in variants.info instead.
+	CREATE TABLE IF NOT EXISTS info_values (
+		file_hash VARCHAR(40) NOT NULL,
+		gene_set_id UINTEGER NOT NULL,
+		gene_hgnc VARCHAR NOT NULL,
+		gene_variation UINTEGER NOT NULL,
+		key VARCHAR NOT NULL,
+		value_index USMALLINT NOT NULL,
+		number_value DOUBLE,
+		string_value VARCHAR,
+
+		FOREIGN KEY(file_hash, gene_set_id, gene_hgnc, gene_variation) REFERENCES variants(file_hash, gene_set_id, gene_hgnc, gene_variation),
+	);
+"""
+
+
+def get_partition(table, file_hash, gene_set_id):
+	return os.path.join(PARQUET_FOLDER, table, 'file_hash={}'.format(file_hash), 'gene_set_id={}'.format(gene_set_id))
+
+
+def __is_partitioned(table):
+	return STORAGE == STORAGE_PARQUET and table in PARTITIONED_TABLES
+
+
+def __parquet_scan(table):
+	"""
+	Returns a query of the rows of all partitions of the table, with the columns
+	in the order of the table. The partitions of other files are skipped
+	by the queries that filter on file_hash and gene_set_id.
+	"""
+	return """
+	SELECT file_hash, gene_set_id, * EXCLUDE (file_hash, gene_set_id)
+	FROM read_parquet(
+		'{}/*/*/*.parquet',
+		hive_partitioning = true,
+		hive_types = {{'file_hash': VARCHAR, 'gene_set_id': UINTEGER}},
+		union_by_name = true
+	)
+	""".format(os.path.join(PARQUET_FOLDER, table))
+
+
+def __get_table_type(db, table):
+	types = db.execute(
+		"SELECT table_type FROM information_schema.tables WHERE table_schema = 'main' AND table_name = ?",
+		(table,)).fetchall()
+	return types[0][0] if types else None
+
+
+def __create_parquet_storage(db):
+	"""
+	Moves the rows of the PARTITIONED_TABLES to their Parquet partitions (sorted by
+	the CLUSTER_KEYS) and replaces the tables with views of the partitions.
+	"""
+	for table in PARTITIONED_TABLES:
+		empty_partition = get_partition(table, *EMPTY_PARTITION)
+		os.makedirs(empty_partition, exist_ok=True)
+		db.execute("COPY (SELECT * EXCLUDE (file_hash, gene_set_id) FROM {} LIMIT 0) TO '{}' (FORMAT PARQUET)".format(
+			table, os.path.join(empty_partition, 'empty.parquet')))
+		db.execute("""
+		COPY (SELECT * FROM {} ORDER BY {}) TO '{}'
+		(FORMAT PARQUET, PARTITION_BY (file_hash, gene_set_id), OVERWRITE_OR_IGNORE)
+		""".format(table, CLUSTER_KEYS[table], os.path.join(PARQUET_FOLDER, table)))
+
+	db.begin()
+	for table in reversed(PARTITIONED_TABLES):
+		db.execute('DROP TABLE {}'.format(table))
+	for table in PARTITIONED_TABLES:
+		db.execute('CREATE VIEW {} AS {}'.format(table, __parquet_scan(table)))
+	db.commit()
+
+
+def __create_duckdb_storage(db):
+	"""
+	Replaces the views of the parquet storage with the PARTITIONED_TABLES
+	and moves the rows of the Parquet partitions to them.
+	"""
+	db.begin()
+	for table in PARTITIONED_TABLES:
+		db.execute('ALTER VIEW {0} RENAME TO {0}_parquet'.format(table))
+	db.execute(DATA_TABLES_SCHEMA)
+	for table in PARTITIONED_TABLES:
+		db.execute('INSERT INTO {0} SELECT * FROM {0}_parquet ORDER BY {1}'.format(table, CLUSTER_KEYS[table]))
+		db.execute('DROP VIEW {}_parquet'.format(table))
+	db.commit()
+	shutil.rmtree(PARQUET_FOLDER, ignore_errors=True)
+
+
+def __create_schema(db):
 	db.execute(
 	"""
 	CREATE SEQUENCE IF NOT EXISTS gene_sets_id_seq START 1;
@@ -50,15 +392,26 @@ with __lock.write:
 		FOREIGN KEY(gene_set_id) REFERENCES gene_sets(id)
 	);
 
+	CREATE SEQUENCE IF NOT EXISTS tasks_id_seq START 1;
+
+	-- Checkpoints of the ingestion of a file, so that it can be resumed
+	-- and genes added to the gene set later can be loaded on their own.
+	-- The annotated and gene_loaded stages are saved once per gene.
 	CREATE TABLE IF NOT EXISTS tasks (
 		id UINTEGER PRIMARY KEY,
 		created_at TIMESTAMP, 
 		file_hash VARCHAR(40) NOT NULL,
 		gene_set_id UINTEGER NOT NULL,
+		stage VARCHAR(32),
+		gene_hgnc VARCHAR,
 
 		FOREIGN KEY(file_hash, gene_set_id) REFERENCES files(hash, gene_set_id)
 	);
 
+	-- databases created before the tasks table was used
+	ALTER TABLE tasks ADD COLUMN IF NOT EXISTS stage VARCHAR(32);
+	ALTER TABLE tasks ADD COLUMN IF NOT EXISTS gene_hgnc VARCHAR;
+
 	CREATE TABLE IF NOT EXISTS genes (
 		file_hash VARCHAR(40) NOT NULL,
 		gene_set_id UINTEGER NOT NULL,
@@ -68,184 +421,1069 @@ with __lock.write:
 		FOREIGN KEY(file_hash, gene_set_id) REFERENCES files(hash, gene_set_id)
 	);
 
-	CREATE TABLE IF NOT EXISTS variants (
+	-- Lookups of a gene across the files (e.g. get_files_with_gene and get_chromosome_for_gene).
+	-- The queries of the other tables filter on the file and the gene, so that they
+	-- only scan the row groups of the gene of the file (see CLUSTER_KEYS).
+	CREATE INDEX IF NOT EXISTS genes_gene_hgnc_idx ON genes (gene_hgnc);
+
+	-- Sample names from the header of each file, in the order of the sample columns
+	CREATE TABLE IF NOT EXISTS samples (
 		file_hash VARCHAR(40) NOT NULL,
 		gene_set_id UINTEGER NOT NULL,
-		gene_hgnc VARCHAR NOT NULL,
-		gene_variation UINTEGER NOT NULL,
+		sample_index UINTEGER NOT NULL,
+		name VARCHAR NOT NULL,
 
-		-- start of standard VCF-fields
-		chrom VARCHAR,
-		pos LONG,
-		id VARCHAR,
-		ref VARCHAR,
-		alt VARCHAR[],
-		qual DOUBLE,
-		filter VARCHAR[],
-		info JSON,
-		format VARCHAR,
+		PRIMARY KEY (file_hash, gene_set_id, sample_index),
+		FOREIGN KEY(file_hash, gene_set_id) REFERENCES files(hash, gene_set_id)
+	);
 
-		-- start of additional PyVCF fields
-		start_pos UBIGINT,
-		end_pos UBIGINT,
-		alleles VARCHAR[],
-		affected_start UBIGINT,
-		affected_end UBIGINT,
-		var_type VARCHAR,
-		var_subtype VARCHAR,
+	-- INFO fields added by SnpEff (ANN, LOF, NMD) to each variant, shared by all files.
+	-- Without a primary key, so that the index doesn't have to be kept in memory.
+	CREATE TABLE IF NOT EXISTS annotation_cache (
+		genome VARCHAR NOT NULL,
+		snpeff_version VARCHAR NOT NULL,
+		chrom VARCHAR NOT NULL,
+		pos UINTEGER NOT NULL,
+		ref VARCHAR NOT NULL,
+		alt VARCHAR NOT NULL,
+		annotation VARCHAR NOT NULL,
+		last_used TIMESTAMP NOT NULL
+	);
 
-		PRIMARY KEY (file_hash, gene_set_id, gene_hgnc, gene_variation),
-		FOREIGN KEY(file_hash, gene_set_id, gene_hgnc) REFERENCES genes(file_hash, gene_set_id, gene_hgnc),
+	-- header lines added by SnpEff, used when all variants of a file are cached
+	CREATE TABLE IF NOT EXISTS annotation_cache_headers (
+		genome VARCHAR NOT NULL,
+		snpeff_version VARCHAR NOT NULL,
+		header VARCHAR NOT NULL,
+
+		PRIMARY KEY (genome, snpeff_version)
 	);
 
-	CREATE TABLE IF NOT EXISTS annotations (
+	CREATE SEQUENCE IF NOT EXISTS jobs_id_seq START 1;
+
+	-- Queue of the files waiting to be processed, see jobs.JobScheduler
+	CREATE TABLE IF NOT EXISTS jobs (
+		id UINTEGER PRIMARY KEY,
+		file_hash VARCHAR(40) NOT NULL,
+		gene_set_id UINTEGER NOT NULL,
+		path VARCHAR NOT NULL,
+		-- jobs with lower priority values run first
+		priority UBIGINT NOT NULL,
+		memory_gb UINTEGER NOT NULL,
+		status VARCHAR(32) NOT NULL,
+		error VARCHAR,
+		created_at TIMESTAMP NOT NULL,
+		started_at TIMESTAMP,
+		finished_at TIMESTAMP
+	);
+
+	-- Chunked uploads that are not complete yet, see uploads.py
+	CREATE TABLE IF NOT EXISTS uploads (
+		id VARCHAR(32) PRIMARY KEY,
+		filename VARCHAR NOT NULL,
+		size UBIGINT NOT NULL,
+		-- the hash given by the client, checked when the upload is complete
+		sha256 VARCHAR(64),
+		gene_set_id UINTEGER NOT NULL,
+		created_at TIMESTAMP NOT NULL
+	);
+
+	-- Progress of the stages of the processing of each file, see progress.ProgressReporter
+	CREATE TABLE IF NOT EXISTS progress (
+		file_hash VARCHAR(40) NOT NULL,
+		gene_set_id UINTEGER NOT NULL,
+		stage VARCHAR(32) NOT NULL,
+		unit VARCHAR(32) NOT NULL,
+		done UBIGINT NOT NULL,
+		total UBIGINT,
+		started_at TIMESTAMP NOT NULL,
+		updated_at TIMESTAMP NOT NULL,
+		finished_at TIMESTAMP,
+
+		PRIMARY KEY (file_hash, gene_set_id, stage)
+	);
+
+	-- Summaries of the data of each file for the pages, saved when it's published
+	-- (see save_summaries), so that the pages don't aggregate all the annotations of the file.
+	-- Totals of the file
+	CREATE TABLE IF NOT EXISTS file_summaries (
+		file_hash VARCHAR(40) NOT NULL,
+		gene_set_id UINTEGER NOT NULL,
+		genes UBIGINT NOT NULL,
+		variations UBIGINT NOT NULL,
+		effects UBIGINT NOT NULL,
+
+		PRIMARY KEY (file_hash, gene_set_id)
+	);
+
+	-- Number of variants and of annotations of each impact per gene (and its chromosome)
+	CREATE TABLE IF NOT EXISTS gene_summaries (
+		file_hash VARCHAR(40) NOT NULL,
+		gene_set_id UINTEGER NOT NULL,
+		chrom VARCHAR,
+		gene_hgnc VARCHAR NOT NULL,
+		variants UBIGINT NOT NULL,
+		high_impact UBIGINT NOT NULL,
+		moderate_impact UBIGINT NOT NULL,
+		low_impact UBIGINT NOT NULL,
+		modifiers UBIGINT NOT NULL
+	);
+
+	-- Number of annotations per gene, transcript biotype, impact and effect
+	CREATE TABLE IF NOT EXISTS gene_effects (
 		file_hash VARCHAR(40) NOT NULL,
 		gene_set_id UINTEGER NOT NULL,
 		gene_hgnc VARCHAR NOT NULL,
-		gene_variation UINTEGER NOT NULL,
-		variation_annotation UINTEGER NOT NULL,
-		
-		-- start of snpEff annotation fields
-		alt VARCHAR,
-		effect VARCHAR,
-		impact VARCHAR,
-		gene VARCHAR,
-		gene_id VARCHAR,
-		feature_type VARCHAR,
-		feature_id VARCHAR,
 		transcript_biotype VARCHAR,
-		rank_to_total VARCHAR,
-		hgvs_dna VARCHAR,
-		hgvs_protein VARCHAR,
-		cdna_pos_to_cdna_len VARCHAR,
-		cds_pos_to_cds_len VARCHAR,
-		prot_pos_to_prot_len VARCHAR,
-		distance_to_feature VARCHAR,
-		note VARCHAR,
+		impact VARCHAR,
+		effect VARCHAR,
+		count UBIGINT NOT NULL
+	);
 
-		PRIMARY KEY (file_hash, gene_set_id, gene_hgnc, gene_variation, variation_annotation),
-		FOREIGN KEY(file_hash, gene_set_id, gene_hgnc, gene_variation) REFERENCES variants(file_hash, gene_set_id, gene_hgnc, gene_variation),
+	-- Migrations of the data (not of the schema) that ran on this database
+	CREATE TABLE IF NOT EXISTS migrations (
+		name VARCHAR PRIMARY KEY,
+		applied_at TIMESTAMP NOT NULL
+	);
+
+	CREATE TABLE IF NOT EXISTS annotation_cache_stats (
+		genome VARCHAR NOT NULL,
+		snpeff_version VARCHAR NOT NULL,
+		hits UBIGINT NOT NULL,
+		misses UBIGINT NOT NULL,
+		evictions UBIGINT NOT NULL,
+		-- the number of annotations in the cache, so that it isn't counted on every save
+		entries UBIGINT,
+
+		PRIMARY KEY (genome, snpeff_version)
 	);
+
+	-- databases created before the entries were counted
+	ALTER TABLE annotation_cache_stats ADD COLUMN IF NOT EXISTS entries UBIGINT;
 	"""
 	)
-	db.close()
 
+	if db.execute('SELECT count(*) FROM annotation_cache_stats WHERE entries IS NULL').fetchone()[0]:
+		db.execute("""
+		UPDATE annotation_cache_stats s
+		SET entries = (
+			SELECT count(*)
+			FROM annotation_cache c
+			WHERE c.genome = s.genome AND c.snpeff_version = s.snpeff_version
+		)
+		WHERE entries IS NULL
+		""")
+
+	# the storage option may have changed since the database was created
+	storage_type = __get_table_type(db, 'variants')
+	if STORAGE == STORAGE_PARQUET:
+		if storage_type != 'VIEW':
+			db.execute(DATA_TABLES_SCHEMA)
+			__create_parquet_storage(db)
+	elif storage_type == 'VIEW':
+		__create_duckdb_storage(db)
+	else:
+		db.execute(DATA_TABLES_SCHEMA)
+
+
+__connections = ConnectionManager(DATABASE, on_connect=__create_schema)
+atexit.register(__connections.close)
+
+
+def get_wait_stats():
+	"""
+	Returns the number of calls and the total and maximum time (in seconds)
+	they waited for the database, per function of this module.
+	"""
+	return __connections.get_wait_stats()
+
+
+# Ingestion stages saved in the tasks table
+STAGE_ANNOTATED = 'annotated'
+STAGE_GENE_LOADED = 'gene_loaded'
+
+INSERT_TASK_QUERY = """
+INSERT INTO tasks (id, created_at, file_hash, gene_set_id, stage, gene_hgnc)
+VALUES (nextval('tasks_id_seq'), ?, ?, ?, ?, ?)
+"""
+
+# The parsed data of each ingestion is saved in a separate database in this folder
+# until the ingestion finishes (see create_staging_database)
+STAGING_FOLDER = 'data/staging'
+
+# Tables with the parsed data of the files, in the order of their foreign keys
+STAGED_TABLES = ('genes', 'variants', 'annotations', 'genotypes', 'info_values')
+
+# Number of buffered variant and annotation rows after which GeneDataLoader writes to the database
+LOADER_BATCH_ROWS = 1000000
+
+# Number of buffered genotype bytes after which GeneDataLoader writes to the database
+LOADER_BATCH_GENOTYPE_BYTES = 256 * 1024 * 1024
 
 INSERT_VARIANTS_QUERY = """
 INSERT INTO variants
-SELECT
-	'{}' AS file_hash,
-	'{}' AS gene_set_id,
-	'{}' AS gene_hgnc,
-	gene_variation,
-	chrom,
-	pos,
-	id,
-	ref,
-	str_split(alt, ',') AS alt,
-	qual,
-	str_split(filter, ',') AS filter,
-	info,
-	format,
-	start_pos,
-	end_pos,
-	str_split(alleles, ',') AS alleles,
-	affected_start,
-	affected_end,
-	var_type,
-	var_subtype
-FROM {}
+SELECT ? AS file_hash, ? AS gene_set_id, *
+FROM variants_arrow
 """
 
 INSERT_ANNOTATIONS_QUERY = """
 INSERT INTO annotations
-SELECT
-	'{}' AS file_hash,
-	'{}' AS gene_set_id,
-	'{}' AS gene_hgnc,
-	gene_variation,
-	variation_annotation,
-	alt,
-	effect,
-	impact,
-	gene,
-	gene_id,
-	feature_type,
-	feature_id,
-	transcript_biotype,
-	rank_to_total,
-	hgvs_dna,
-	hgvs_protein,
-	cdna_pos_to_cdna_len,
-	cds_pos_to_cds_len,
-	prot_pos_to_prot_len,
-	distance_to_feature,
-	note
-FROM {}
+SELECT ? AS file_hash, ? AS gene_set_id, *
+FROM annotations_arrow
 """
 
+INSERT_GENOTYPES_QUERY = """
+INSERT INTO genotypes
+SELECT ? AS file_hash, ? AS gene_set_id, *
+FROM genotypes_arrow
+"""
+
+INSERT_INFO_VALUES_QUERY = """
+INSERT INTO info_values
+SELECT ? AS file_hash, ? AS gene_set_id, *
+FROM info_values_arrow
+"""
+
+
+def variants_arrow_table(gene, variants):
+	"""
+	Converts a variants dataframe (as returned by vcf_processing.iter_vcf_chunks)
+	to an Arrow table with the columns of the variants table (without file_hash and gene_set_id).
+	"""
+	strings = lambda column: pa.array(variants[column], pa.string(), from_pandas=True)
+	integers = lambda column, type: pa.array(variants[column], type, from_pandas=True)
+	lists = lambda column: pa.array(variants[column], pa.list_(pa.string()), from_pandas=True)
+
+	return pa.table({
+		'gene_hgnc': pa.array([gene] * len(variants), pa.string()),
+		'gene_variation': pa.array(variants.index, pa.uint32()),
+		'chrom': strings('chrom'),
+		'pos': integers('pos', pa.int64()),
+		'id': strings('id'),
+		'ref': strings('ref'),
+		'alt': lists('alt'),
+		'qual': integers('qual', pa.float64()),
+		'filter': lists('filter'),
+		'info': pa.array([json.dumps(info) for info in variants['info']], pa.string()),
+		'format': strings('format'),
+		'start_pos': integers('start_pos', pa.uint64()),
+		'end_pos': integers('end_pos', pa.uint64()),
+		'alleles': lists('alleles'),
+		'affected_start': integers('affected_start', pa.uint64()),
+		'affected_end': integers('affected_end', pa.uint64()),
+		'var_type': strings('var_type'),
+		'var_subtype': strings('var_subtype'),
+		'an': integers('an', pa.uint32()),
+		'ac': integers('ac', pa.uint32()),
+		'af': integers('af', pa.float64()),
+		'het_count': integers('het_count', pa.uint32()),
+		'hom_ref_count': integers('hom_ref_count', pa.uint32()),
+		'hom_alt_count': integers('hom_alt_count', pa.uint32()),
+		'called_count': integers('called_count', pa.uint32()),
+		'call_rate': integers('call_rate', pa.float64()),
+	})
+
+
+# the columns of the annotations table after gene_hgnc, so that chunks without any
+# annotations (whose string columns pandas can't type) concatenate with the others
+ANNOTATIONS_ARROW_SCHEMA = pa.schema(
+	[('gene_variation', pa.uint32()), ('variation_annotation', pa.uint32())]
+	+ [(column, pa.string()) for column in (
+		'alt', 'effect', 'impact', 'gene', 'gene_id', 'feature_type', 'feature_id', 'transcript_biotype',
+		'rank_to_total', 'hgvs_dna', 'hgvs_protein', 'cdna_pos_to_cdna_len', 'cds_pos_to_cds_len',
+		'prot_pos_to_prot_len', 'distance_to_feature', 'note')]
+	+ [(column, pa.uint32()) for column in (
+		'rank', 'rank_total', 'cdna_pos', 'cdna_len', 'cds_pos', 'cds_len', 'prot_pos', 'prot_len')]
+	+ [('distance', pa.int32())])
+
+
+def annotations_arrow_table(gene, annotations):
+	"""
+	Converts an annotations dataframe (as returned by vcf_processing.iter_vcf_chunks)
+	to an Arrow table with the columns of the annotations table (without file_hash and gene_set_id).
+	"""
+	table = pa.Table.from_pandas(annotations, schema=ANNOTATIONS_ARROW_SCHEMA, preserve_index=False)
+	return table.add_column(0, 'gene_hgnc', pa.array([gene] * len(annotations), pa.string()))
+
+
+def genotypes_arrow_table(gene, genotypes):
+	"""
+	Converts a genotypes dataframe (as returned by vcf_processing.iter_vcf_chunks)
+	to an Arrow table with the columns of the genotypes table (without file_hash and gene_set_id).
+	"""
+	return pa.table({
+		'gene_hgnc': pa.array([gene] * len(genotypes), pa.string()),
+		'gene_variation': pa.array(genotypes.index, pa.uint32()),
+		'ploidy': pa.array(genotypes['ploidy'], pa.uint8()),
+		'alleles': pa.array(genotypes['alleles'], pa.binary()),
+		'phased': pa.array(genotypes['phased'], pa.binary()),
+		'missing': pa.array(genotypes['missing'], pa.binary()),
+	})
+
 
-def save_gene_data(file_hash, gene_set_id, gene, variants, annotations):
-	with __lock.write:
-		db = duckdb.connect(database=DATABASE, read_only=False)
-		db.execute('INSERT INTO genes (file_hash, gene_set_id, gene_hgnc) VALUES (?, ?, ?)', (file_hash, gene_set_id, gene))
+def info_values_arrow_table(gene, info_values):
+	"""
+	Converts an info_values dataframe (as returned by vcf_processing.iter_vcf_chunks)
+	to an Arrow table with the columns of the info_values table (without file_hash and gene_set_id).
+	"""
+	return pa.table({
+		'gene_hgnc': pa.array([gene] * len(info_values), pa.string()),
+		'gene_variation': pa.array(info_values.index, pa.uint32()),
+		'key': pa.array(info_values['key'], pa.string()),
+		'value_index': pa.array(info_values['value_index'], pa.uint16()),
+		'number_value': pa.array(info_values['number_value'], pa.float64(), from_pandas=True),
+		'string_value': pa.array(info_values['string_value'], pa.string(), from_pandas=True),
+	})
 
-		# add index inplace as a new column and rename it gene_variation
-		variants.reset_index(inplace=True)
-		variants.rename({'index': 'gene_variation'}, axis=1, inplace=True)
 
-		# join array values as csv, because duckdb doesn't parse them properly
-		# so we need to split them manually
-		variants['alt'] = variants['alt'].apply(lambda alt: ','.join(str(a) for a in alt))
-		variants['filter'] = variants['filter'].apply(lambda filter: ','.join(filter))
-		variants['alleles'] = variants['alleles'].apply(lambda alleles: ','.join(str(a) for a in alleles))
-		variants['info'] = variants['info'].apply(lambda info: json.dumps(info))
+def get_staging_database(file_hash, gene_set_id):
+	return os.path.join(STAGING_FOLDER, '{}_{}.duckdb'.format(file_hash, gene_set_id))
 
-		db.register('variants_df', variants)
-		db.register('annotations_df', annotations)
 
-		insert_variants_query = INSERT_VARIANTS_QUERY.format(file_hash, gene_set_id, gene, 'variants_df')
-		db.execute(insert_variants_query)
+def __attach_query(path):
+	return "ATTACH '{}' AS staging".format(path.replace("'", "''"))
 
-		insert_annotations_query = INSERT_ANNOTATIONS_QUERY.format(file_hash, gene_set_id, gene, 'annotations_df')
-		db.execute(insert_annotations_query)
 
-		# When we register the dataframes, duckdb would keep references to them.
-		# We unregister them so that the memory can be freed.
-		db.unregister('variants_df')
-		db.unregister('annotations_df')
+def create_staging_database(file_hash, gene_set_id):
+	"""
+	Creates the staging database of the ingestion of a file for a gene set (unless it
+	already exists from an interrupted ingestion), with empty copies of the STAGED_TABLES
+	and a table for the gene_loaded checkpoints. The parsed data is saved there
+	(see save_genes), so that the serving database is not slowed down by the writes,
+	and moved to it at once by publish_staging_database.
+	"""
+	os.makedirs(STAGING_FOLDER, exist_ok=True)
+	with __connections.write() as db:
+		db.execute(__attach_query(get_staging_database(file_hash, gene_set_id)))
+		try:
+			for table in STAGED_TABLES:
+				db.execute('CREATE TABLE IF NOT EXISTS staging.{0} AS SELECT * FROM {0} LIMIT 0'.format(table))
+			db.execute("""
+			CREATE TABLE IF NOT EXISTS staging.checkpoints AS
+			SELECT created_at, file_hash, gene_set_id, stage, gene_hgnc FROM tasks LIMIT 0
+			""")
+		finally:
+			db.execute('DETACH staging')
+
+
+def __connect_staging(file_hash, gene_set_id):
+	"""
+	Returns a connection to the staging database of the file, or None if it doesn't exist.
+	"""
+	path = get_staging_database(file_hash, gene_set_id)
+	if not os.path.exists(path):
+		return None
+	return duckdb.connect(database=path, read_only=False)
+
+
+def __remove_staging_database(file_hash, gene_set_id):
+	path = get_staging_database(file_hash, gene_set_id)
+	for file in (path, path + '.wal'):
+		if os.path.exists(file):
+			os.remove(file)
+
+
+def __write_partition(db, table, file_hash, gene_set_id):
+	"""
+	Writes the rows of the table from the attached staging database to a new Parquet file
+	in the partition of the file (the genes loaded later are added in separate files).
+	The file becomes visible only when it's complete. Returns the paths of the written files.
+	"""
+	if not db.execute('SELECT count(*) FROM staging.{}'.format(table)).fetchone()[0]:
+		return []
+
+	partition = get_partition(table, file_hash, gene_set_id)
+	os.makedirs(partition, exist_ok=True)
+	path = os.path.join(partition, '{}.parquet'.format(uuid.uuid4().hex))
+	db.execute("COPY (SELECT * EXCLUDE (file_hash, gene_set_id) FROM staging.{} ORDER BY {}) TO '{}' (FORMAT PARQUET)".format(
+		table, CLUSTER_KEYS[table], path + '.tmp'))
+	os.replace(path + '.tmp', path)
+	return [path]
+
+
+SUMMARY_TABLES = ('file_summaries', 'gene_summaries', 'gene_effects')
+
+# Migration of the data saved before the summaries (see save_missing_summaries)
+MIGRATION_SUMMARIES = 'summaries'
+
+# Migration of the files processed before the checkpoints (see save_missing_checkpoints)
+MIGRATION_CHECKPOINTS = 'checkpoints'
+
+
+def __save_summaries(db, file_hash, gene_set_id):
+	for table in SUMMARY_TABLES:
+		db.execute('DELETE FROM {} WHERE file_hash = ? AND gene_set_id = ?'.format(table), (file_hash, gene_set_id))
+
+	db.execute("""
+	INSERT INTO file_summaries
+	SELECT
+		?, ?,
+		COUNT(DISTINCT gene_hgnc) AS genes,
+		COUNT(DISTINCT {g: gene_hgnc, v: gene_variation}) AS variations,
+		COUNT(*) AS effects
+	FROM annotations
+	WHERE file_hash = ?
+	  AND gene_set_id = ?
+	  AND effect NOT IN ('intergenic_region')
+	""", (file_hash, gene_set_id) * 2)
+	db.execute("""
+	INSERT INTO gene_summaries
+	SELECT
+		v.file_hash,
+		v.gene_set_id,
+		chrom,
+		v.gene_hgnc,
+		COUNT(DISTINCT v.gene_variation) AS variants,
+		SUM(CASE impact WHEN 'HIGH' THEN 1 ELSE 0 END) AS high_impact,
+		SUM(CASE impact WHEN 'MODERATE' THEN 1 ELSE 0 END) AS moderate_impact,
+		SUM(CASE impact WHEN 'LOW' THEN 1 ELSE 0 END) AS low_impact,
+		SUM(CASE impact WHEN 'MODIFIER' THEN 1 ELSE 0 END) AS modifiers
+	FROM variants v
+	JOIN annotations a ON v.file_hash = a.file_hash AND v.gene_set_id = a.gene_set_id AND v.gene_hgnc = a.gene_hgnc AND v.gene_variation = a.gene_variation
+	WHERE v.file_hash = ?
+	  AND v.gene_set_id = ?
+	  AND a.file_hash = ?
+	  AND a.gene_set_id = ?
+	  AND effect NOT IN ('intergenic_region')
+	GROUP BY 1, 2, 3, 4
+	""", (file_hash, gene_set_id) * 2)
+	db.execute("""
+	INSERT INTO gene_effects
+	SELECT file_hash, gene_set_id, gene_hgnc, transcript_biotype, impact, effect, COUNT(*) AS count
+	FROM annotations
+	WHERE file_hash = ?
+	  AND gene_set_id = ?
+	  AND effect NOT IN ('intergenic_region')
+	GROUP BY 1, 2, 3, 4, 5, 6
+	""", (file_hash, gene_set_id))
+
+
+def save_summaries(file_hash, gene_set_id):
+	"""
+	Saves the summaries of the data of the file for the pages (the SUMMARY_TABLES),
+	replacing the previous ones. The data of a file only changes when it's published
+	(see publish_staging_database), which saves them as well.
+	"""
+	with __connections.write() as db:
+		db.begin()
+		__save_summaries(db, file_hash, gene_set_id)
+		db.commit()
+
+
+def publish_staging_database(file_hash, gene_set_id, status='processed'):
+	"""
+	Moves the data (sorted by the CLUSTER_KEYS) and the checkpoints from the staging database
+	of the file to the serving database and sets the status of the file, all in one transaction,
+	so a failed ingestion doesn't leave anything half-written. The summaries of the file
+	are rebuilt in the same transaction (see save_summaries). With the parquet storage
+	the PARTITIONED_TABLES are written to the partitions of the file instead, and removed
+	if the transaction fails. Removes the staging database.
+	"""
+	path = get_staging_database(file_hash, gene_set_id)
+	with __connections.write() as db:
+		if not os.path.exists(path):
+			db.begin()
+			__save_summaries(db, file_hash, gene_set_id)
+			db.execute('UPDATE files SET status = ? WHERE hash = ? AND gene_set_id = ?', (status, file_hash, gene_set_id))
+			db.commit()
+			return
+
+		db.execute(__attach_query(path) + ' (READ_ONLY)')
+		partition_files = []
+		try:
+			db.begin()
+			for table in STAGED_TABLES:
+				if __is_partitioned(table):
+					partition_files += __write_partition(db, table, file_hash, gene_set_id)
+				else:
+					db.execute('INSERT INTO {0} SELECT * FROM staging.{0} ORDER BY {1}'.format(table, CLUSTER_KEYS[table]))
+			db.execute("""
+			INSERT INTO tasks (id, created_at, file_hash, gene_set_id, stage, gene_hgnc)
+			SELECT nextval('tasks_id_seq'), * FROM staging.checkpoints
+			""")
+			__save_summaries(db, file_hash, gene_set_id)
+			db.execute('UPDATE files SET status = ? WHERE hash = ? AND gene_set_id = ?', (status, file_hash, gene_set_id))
+			db.commit()
+		except BaseException:
+			db.rollback()
+			for file in partition_files:
+				os.remove(file)
+			raise
+		finally:
+			db.execute('DETACH staging')
+
+	__remove_staging_database(file_hash, gene_set_id)
+
+
+def save_missing_summaries(force=False):
+	"""
+	Saves the summaries of the processed files that don't have them, i.e. the files
+	processed before the summaries were saved when publishing. Runs only once per
+	database (recorded in the migrations table), unless force is set.
+	Returns the number of summarized files.
+	"""
+	with __connections.read() as db:
+		if not force and db.execute('SELECT 1 FROM migrations WHERE name = ?', (MIGRATION_SUMMARIES,)).fetchone():
+			return 0
+		files = db.execute("""
+		SELECT hash, gene_set_id
+		FROM files
+		WHERE status = 'processed'
+		  AND NOT EXISTS (
+			SELECT 1
+			FROM file_summaries s
+			WHERE s.file_hash = files.hash AND s.gene_set_id = files.gene_set_id
+		  )
+		""").fetchall()
+
+	for file_hash, gene_set_id in files:
+		save_summaries(file_hash, gene_set_id)
+
+	with __connections.write() as db:
+		db.execute(
+			'INSERT INTO migrations (name, applied_at) VALUES (?, ?) ON CONFLICT DO NOTHING',
+			(MIGRATION_SUMMARIES, datetime.now()))
+	return len(files)
+
+
+def save_genes(
+		file_hash,
+		gene_set_id,
+		genes,
+		variants_tables,
+		annotations_tables,
+		genotypes_tables=(),
+		info_values_tables=(),
+		loaded_genes=()):
+	"""
+	Saves the given genes and their variants, annotations, genotypes and INFO values (as lists of Arrow tables,
+	see variants_arrow_table, annotations_arrow_table, genotypes_arrow_table and info_values_arrow_table)
+	to the staging database of the file (see create_staging_database) in a single transaction.
+	A gene_loaded checkpoint is saved in the same transaction for each of loaded_genes.
+	"""
+	db = __connect_staging(file_hash, gene_set_id)
+	try:
+		db.begin()
+		if genes:
+			db.executemany(
+				'INSERT INTO genes (file_hash, gene_set_id, gene_hgnc) VALUES (?, ?, ?)',
+				[(file_hash, gene_set_id, gene) for gene in genes])
+		if variants_tables:
+			db.register('variants_arrow', pa.concat_tables(variants_tables))
+			db.register('annotations_arrow', pa.concat_tables(annotations_tables))
+			db.execute(INSERT_VARIANTS_QUERY, (file_hash, gene_set_id))
+			db.execute(INSERT_ANNOTATIONS_QUERY, (file_hash, gene_set_id))
+			db.unregister('variants_arrow')
+			db.unregister('annotations_arrow')
+		if genotypes_tables:
+			db.register('genotypes_arrow', pa.concat_tables(genotypes_tables))
+			db.execute(INSERT_GENOTYPES_QUERY, (file_hash, gene_set_id))
+			db.unregister('genotypes_arrow')
+		if info_values_tables:
+			db.register('info_values_arrow', pa.concat_tables(info_values_tables))
+			db.execute(INSERT_INFO_VALUES_QUERY, (file_hash, gene_set_id))
+			db.unregister('info_values_arrow')
+		if loaded_genes:
+			now = datetime.now()
+			db.executemany(
+				'INSERT INTO checkpoints (created_at, file_hash, gene_set_id, stage, gene_hgnc) VALUES (?, ?, ?, ?, ?)',
+				[(now, file_hash, gene_set_id, STAGE_GENE_LOADED, gene) for gene in loaded_genes])
+		db.commit()
+	finally:
 		db.close()
 
 
+class GeneDataLoader:
+	"""
+	Buffers the parsed genes of a file as Arrow tables and writes them
+	to the staging database of the file in large batches, each in a single transaction.
+	Call finish_gene once all chunks of a gene are added, so that it is
+	checkpointed with the batch that completes it.
+	Call flush at the end to write the remaining buffered data and
+	publish_staging_database to make the data visible.
+	If on_saved is given, it is called with the number of rows saved by each batch.
+	"""
+
+	def __init__(self, file_hash, gene_set_id, batch_rows=LOADER_BATCH_ROWS, on_saved=None):
+		create_staging_database(file_hash, gene_set_id)
+		self.file_hash = file_hash
+		self.gene_set_id = gene_set_id
+		self.batch_rows = batch_rows
+		self.on_saved = on_saved
+		self.genes = []
+		self.variants = []
+		self.annotations = []
+		self.genotypes = []
+		self.info_values = []
+		self.finished_genes = []
+		self.rows = 0
+		self.genotype_bytes = 0
+
+	def add_gene(self, gene):
+		self.genes.append(gene)
+
+	def add(self, gene, variants, annotations, genotypes=None, info_values=None):
+		"""
+		Adds a (chunk of) variants, annotations, genotypes and INFO values for a gene, which was added with add_gene.
+		"""
+		self.variants.append(variants_arrow_table(gene, variants))
+		self.annotations.append(annotations_arrow_table(gene, annotations))
+		self.rows += len(variants) + len(annotations)
+		if info_values is not None and len(info_values):
+			self.info_values.append(info_values_arrow_table(gene, info_values))
+			self.rows += len(info_values)
+		if genotypes is not None and len(genotypes):
+			self.genotypes.append(genotypes_arrow_table(gene, genotypes))
+			self.genotype_bytes += self.genotypes[-1].nbytes
+		if self.rows >= self.batch_rows or self.genotype_bytes >= LOADER_BATCH_GENOTYPE_BYTES:
+			self.flush()
+
+	def finish_gene(self, gene):
+		self.finished_genes.append(gene)
+
+	def flush(self):
+		if not self.genes and not self.variants and not self.finished_genes:
+			return
+
+		save_genes(
+			self.file_hash,
+			self.gene_set_id,
+			self.genes,
+			self.variants,
+			self.annotations,
+			self.genotypes,
+			self.info_values,
+			loaded_genes=self.finished_genes)
+		if self.on_saved is not None:
+			self.on_saved(self.rows)
+
+		self.genes = []
+		self.variants = []
+		self.annotations = []
+		self.genotypes = []
+		self.info_values = []
+		self.finished_genes = []
+		self.rows = 0
+		self.genotype_bytes = 0
+
+
+def save_checkpoints(file_hash, gene_set_id, stage, genes):
+	if not genes:
+		return
+
+	with __connections.write() as db:
+		now = datetime.now()
+		db.executemany(INSERT_TASK_QUERY, [(now, file_hash, gene_set_id, stage, gene) for gene in genes])
+
+
+def get_checkpoints(file_hash, gene_set_id):
+	"""
+	Returns the checkpoints of the file, including the ones of
+	the genes that were saved in its staging database.
+	"""
+	query = 'SELECT stage, gene_hgnc FROM {} WHERE file_hash = ? AND gene_set_id = ?'
+	with __connections.read() as db:
+		checkpoints = db.execute(query.format('tasks'), (file_hash, gene_set_id)).fetch_df().to_dict('records')
+
+	staging = __connect_staging(file_hash, gene_set_id)
+	if staging is not None:
+		checkpoints += staging.execute(query.format('checkpoints'), (file_hash, gene_set_id)).fetch_df().to_dict('records')
+		staging.close()
+	return checkpoints
+
+
+def save_missing_checkpoints():
+	"""
+	Migrates the files ingested before the checkpoints were saved, so that processing them
+	again (e.g. after adding a gene to their gene set) only loads the missing genes:
+	the genes of the processed files without any checkpoints get annotated and gene_loaded checkpoints,
+	and the partially saved genes of the unprocessed files (those without a gene_loaded checkpoint),
+	which were written directly to the serving database, are deleted.
+	Runs only once per database (recorded in the migrations table).
+	Returns the number of checkpointed genes.
+	"""
+	with __connections.write() as db:
+		if db.execute('SELECT 1 FROM migrations WHERE name = ?', (MIGRATION_CHECKPOINTS,)).fetchone():
+			return 0
+
+		genes = db.execute("""
+		INSERT INTO tasks (id, created_at, file_hash, gene_set_id, stage, gene_hgnc)
+		SELECT nextval('tasks_id_seq'), ?, g.file_hash, g.gene_set_id, s.stage, g.gene_hgnc
+		FROM genes g
+		JOIN files f ON f.hash = g.file_hash AND f.gene_set_id = g.gene_set_id
+		CROSS JOIN (VALUES (?), (?)) s(stage)
+		WHERE f.status = 'processed'
+		  AND NOT EXISTS (
+			SELECT 1
+			FROM tasks t
+			WHERE t.file_hash = g.file_hash AND t.gene_set_id = g.gene_set_id
+		  )
+		""", (datetime.now(), STAGE_ANNOTATED, STAGE_GENE_LOADED)).fetchone()[0] // 2
+
+		# one statement per table, as the foreign keys don't allow deleting the rows
+		# of a table and the ones they reference in the same transaction
+		for table in reversed(STAGED_TABLES):
+			# the partitions only get the data of the finished genes (see publish_staging_database)
+			if __is_partitioned(table):
+				continue
+			db.execute("""
+			DELETE FROM {} d
+			WHERE EXISTS (
+				SELECT 1
+				FROM files f
+				WHERE f.hash = d.file_hash AND f.gene_set_id = d.gene_set_id AND f.status != 'processed'
+			  )
+			  AND NOT EXISTS (
+				SELECT 1
+				FROM tasks t
+				WHERE t.file_hash = d.file_hash AND t.gene_set_id = d.gene_set_id
+				  AND t.stage = ? AND t.gene_hgnc = d.gene_hgnc
+			  )
+			""".format(table), (STAGE_GENE_LOADED,))
+
+		db.execute(
+			'INSERT INTO migrations (name, applied_at) VALUES (?, ?)',
+			(MIGRATION_CHECKPOINTS, datetime.now()))
+		return genes
+
+
+def delete_unfinished_genes(file_hash, gene_set_id):
+	"""
+	Deletes the data of the genes of a file that were partially saved to its staging database
+	before the ingestion was interrupted, i.e. those without a gene_loaded checkpoint.
+	The serving database only gets whole genes, when the staging database is published
+	(see publish_staging_database and, for the files ingested before, save_missing_checkpoints).
+	"""
+	staging = __connect_staging(file_hash, gene_set_id)
+	if staging is None:
+		return
+
+	unfinished = """
+	gene_hgnc NOT IN (
+		SELECT gene_hgnc
+		FROM checkpoints
+		WHERE file_hash = ? AND gene_set_id = ? AND stage = ?
+	)
+	"""
+	params = (file_hash, gene_set_id, file_hash, gene_set_id, STAGE_GENE_LOADED)
+	for table in reversed(STAGED_TABLES):
+		query = 'DELETE FROM {} WHERE file_hash = ? AND gene_set_id = ? AND {}'.format(table, unfinished)
+		staging.execute(query, params)
+	staging.close()
+
+
+def get_cached_annotations(genome, snpeff_version, keys):
+	"""
+	Takes a dataframe of variant keys (chrom, pos, ref, alt) and returns a list
+	of the cached annotation of each of them, with None for the variants that are not cached.
+	The last use time of the found annotations is updated by touch_cached_annotations.
+	"""
+	keys = keys.assign(i=np.arange(len(keys)))
+	with __connections.read() as db:
+		db.register('cache_keys', keys)
+		found = db.execute(
+			"""
+			SELECT k.i, c.annotation
+			FROM cache_keys k
+			JOIN annotation_cache c
+				ON c.chrom = k.chrom AND c.pos = k.pos AND c.ref = k.ref AND c.alt = k.alt
+			WHERE c.genome = ? AND c.snpeff_version = ?
+			""",
+			(genome, snpeff_version)).fetch_df()
+		db.unregister('cache_keys')
+
+	annotations = [None] * len(keys)
+	for i, annotation in zip(found['i'], found['annotation']):
+		annotations[i] = annotation
+	return annotations
+
+
+def touch_cached_annotations(genome, snpeff_version, keys):
+	"""
+	Updates the last use time of the cached annotations of a dataframe of variant keys (chrom, pos, ref, alt),
+	so that they are evicted after the ones that weren't used since.
+	"""
+	if not len(keys):
+		return
+
+	with __connections.write() as db:
+		db.register('cache_keys', keys)
+		db.execute(
+			"""
+			UPDATE annotation_cache c
+			SET last_used = ?
+			FROM cache_keys k
+			WHERE c.genome = ? AND c.snpeff_version = ?
+				AND c.chrom = k.chrom AND c.pos = k.pos AND c.ref = k.ref AND c.alt = k.alt
+			""",
+			(datetime.now(), genome, snpeff_version))
+		db.unregister('cache_keys')
+
+
+def __add_cache_entries(db, genome, snpeff_version, entries):
+	db.execute(
+		"""
+		INSERT INTO annotation_cache_stats (genome, snpeff_version, hits, misses, evictions, entries)
+		VALUES (?, ?, 0, 0, 0, ?)
+		ON CONFLICT (genome, snpeff_version) DO UPDATE SET entries = entries + excluded.entries
+		""",
+		(genome, snpeff_version, entries))
+
+
+def save_cached_annotations(genome, snpeff_version, annotations, max_entries=None):
+	"""
+	Saves a dataframe of variant keys (chrom, pos, ref, alt) and their annotations to the cache.
+	If the cache has more than max_entries annotations after that, the least recently used ones are evicted.
+	Returns the number of evicted annotations.
+	"""
+	annotations = annotations.drop_duplicates(['chrom', 'pos', 'ref', 'alt'])
+	with __connections.write() as db:
+		db.register('new_annotations', annotations)
+		inserted = db.execute(
+			"""
+			INSERT INTO annotation_cache
+			SELECT ?, ?, n.chrom, n.pos, n.ref, n.alt, n.annotation, ?
+			FROM new_annotations n
+			WHERE NOT EXISTS (
+				SELECT 1
+				FROM annotation_cache c
+				WHERE c.genome = ? AND c.snpeff_version = ?
+					AND c.chrom = n.chrom AND c.pos = n.pos AND c.ref = n.ref AND c.alt = n.alt
+			)
+			""",
+			(genome, snpeff_version, datetime.now(), genome, snpeff_version)).fetchone()[0]
+		db.unregister('new_annotations')
+		__add_cache_entries(db, genome, snpeff_version, inserted)
+
+		evicted = 0
+		if max_entries is not None:
+			size = db.execute('SELECT sum(entries) FROM annotation_cache_stats').fetchone()[0]
+			if size > max_entries:
+				evicted = size - max_entries
+				# the evicted annotations may be of any genome and SnpEff version
+				removed = db.execute(
+					"""
+					DELETE FROM annotation_cache
+					WHERE rowid IN (SELECT rowid FROM annotation_cache ORDER BY last_used LIMIT ?)
+					RETURNING genome, snpeff_version
+					""",
+					(evicted,)).fetchall()
+				db.executemany(
+					'UPDATE annotation_cache_stats SET entries = entries - ? WHERE genome = ? AND snpeff_version = ?',
+					[(count, removed_genome, removed_version) for (removed_genome, removed_version), count in Counter(removed).items()])
+		return evicted
+
+
+def get_cached_annotation_header(genome, snpeff_version):
+	with __connections.read() as db:
+		query = 'SELECT header FROM annotation_cache_headers WHERE genome = ? AND snpeff_version = ?'
+		row = db.execute(query, (genome, snpeff_version)).fetchone()
+		return row[0] if row else None
+
+
+def save_cached_annotation_header(genome, snpeff_version, header):
+	with __connections.write() as db:
+		db.execute(
+			'INSERT OR REPLACE INTO annotation_cache_headers (genome, snpeff_version, header) VALUES (?, ?, ?)',
+			(genome, snpeff_version, header))
+
+
+def update_annotation_cache_stats(genome, snpeff_version, hits, misses, evictions):
+	with __connections.write() as db:
+		db.execute(
+			"""
+			INSERT INTO annotation_cache_stats (genome, snpeff_version, hits, misses, evictions, entries)
+			VALUES (?, ?, ?, ?, ?, 0)
+			ON CONFLICT (genome, snpeff_version) DO UPDATE SET
+				hits = hits + excluded.hits,
+				misses = misses + excluded.misses,
+				evictions = evictions + excluded.evictions
+			""",
+			(genome, snpeff_version, hits, misses, evictions))
+
+
+def get_annotation_cache_stats():
+	with __connections.read() as db:
+		query = """
+		SELECT s.genome,
+			   s.snpeff_version,
+			   s.hits,
+			   s.misses,
+			   s.evictions,
+			   s.hits / greatest(s.hits + s.misses, 1) AS hit_rate,
+			   s.entries
+		FROM annotation_cache_stats s
+		ORDER BY s.genome, s.snpeff_version
+		"""
+		stats = db.execute(query).fetch_df().to_dict('records')
+		return stats
+
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+
+JOB_ACTIVE_STATUSES = (JOB_QUEUED, JOB_RUNNING)
+
+
+def save_job(file_hash, gene_set_id, path, priority, memory_gb):
+	with __connections.write() as db:
+		query = """
+		INSERT INTO jobs (id, file_hash, gene_set_id, path, priority, memory_gb, status, created_at)
+		VALUES (nextval('jobs_id_seq'), ?, ?, ?, ?, ?, ?, ?)
+		RETURNING id
+		"""
+		job_id = db.execute(
+			query,
+			(file_hash, gene_set_id, path, priority, memory_gb, JOB_QUEUED, datetime.now())).fetchone()[0]
+		return job_id
+
+
+def get_job(id):
+	with __connections.read() as db:
+		query = """
+		SELECT j.*,
+			   CASE WHEN j.status = ? THEN (
+				   SELECT count(*) + 1
+				   FROM jobs q
+				   WHERE q.status = ? AND (q.priority < j.priority OR (q.priority = j.priority AND q.id < j.id))
+			   ) END AS queue_position
+		FROM jobs j
+		WHERE j.id = ?
+		"""
+		jobs = db.execute(query, (JOB_QUEUED, JOB_QUEUED, id)).fetch_df().to_dict('records')
+		job = jobs[0] if jobs else None
+		return job
+
+
+def get_jobs(statuses=JOB_ACTIVE_STATUSES):
+	"""
+	Returns the jobs with the given statuses, in the order in which they will run,
+	with the queue_position of the queued ones (as get_job).
+	"""
+	with __connections.read() as db:
+		query = """
+		SELECT *,
+			   CASE WHEN status = ? THEN row_number() OVER (PARTITION BY status ORDER BY priority, id) END AS queue_position
+		FROM jobs
+		WHERE status IN ({})
+		ORDER BY priority, id
+		""".format(','.join(['?'] * len(statuses)))
+		jobs = db.execute(query, [JOB_QUEUED] + list(statuses)).fetch_df().to_dict('records')
+		return jobs
+
+
+def get_active_job(file_hash, gene_set_id):
+	with __connections.read() as db:
+		query = 'SELECT * FROM jobs WHERE file_hash = ? AND gene_set_id = ? AND status IN (?, ?)'
+		jobs = db.execute(query, [file_hash, gene_set_id] + list(JOB_ACTIVE_STATUSES)).fetch_df().to_dict('records')
+		job = jobs[0] if jobs else None
+		return job
+
+
+def update_job_status(id, status, error=None):
+	with __connections.write() as db:
+		if status == JOB_RUNNING:
+			db.execute('UPDATE jobs SET status = ?, started_at = ? WHERE id = ?', (status, datetime.now(), id))
+		elif status == JOB_QUEUED:
+			db.execute('UPDATE jobs SET status = ?, started_at = NULL WHERE id = ?', (status, id))
+		else:
+			db.execute(
+				'UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?',
+				(status, error, datetime.now(), id))
+
+
+def requeue_running_jobs():
+	"""
+	Puts the jobs that were running when the application stopped back in the queue.
+	"""
+	with __connections.write() as db:
+		db.execute('UPDATE jobs SET status = ?, started_at = NULL WHERE status = ?', (JOB_QUEUED, JOB_RUNNING))
+
+
+def save_progress(file_hash, gene_set_id, stage, unit, done, total, started_at, updated_at, finished_at):
+	with __connections.write() as db:
+		db.execute(
+			"""
+			INSERT OR REPLACE INTO progress
+				(file_hash, gene_set_id, stage, unit, done, total, started_at, updated_at, finished_at)
+			VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+			""",
+			(file_hash, gene_set_id, stage, unit, done, total, started_at, updated_at, finished_at))
+
+
+def get_progress(file_hash, gene_set_id):
+	with __connections.read() as db:
+		query = """
+		SELECT stage, unit, done, total, started_at, updated_at, finished_at
+		FROM progress
+		WHERE file_hash = ? AND gene_set_id = ?
+		"""
+		cursor = db.execute(query, (file_hash, gene_set_id))
+		columns = [column[0] for column in cursor.description]
+		# not through pandas, so that the missing totals and times stay None
+		stages = [dict(zip(columns, row)) for row in cursor.fetchall()]
+		return stages
+
+
+def delete_progress(file_hash, gene_set_id):
+	with __connections.write() as db:
+		db.execute('DELETE FROM progress WHERE file_hash = ? AND gene_set_id = ?', (file_hash, gene_set_id))
+
+
+def save_upload(id, filename, size, sha256, gene_set_id):
+	with __connections.write() as db:
+		db.execute(
+			'INSERT INTO uploads (id, filename, size, sha256, gene_set_id, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+			(id, filename, size, sha256, gene_set_id, datetime.now()))
+
+
+def get_upload(id):
+	with __connections.read() as db:
+		uploads = db.execute('SELECT * FROM uploads WHERE id = ?', (id,)).fetch_df().to_dict('records')
+		upload = uploads[0] if uploads else None
+		return upload
+
+
+def delete_upload(id):
+	with __connections.write() as db:
+		db.execute('DELETE FROM uploads WHERE id = ?', (id,))
+
+
+def get_file_by_hash(sha):
+	"""
+	Returns any of the files with the given hash (uploaded for any gene set).
+	"""
+	with __connections.read() as db:
+		files = db.execute('SELECT * FROM files WHERE hash = ? LIMIT 1', (sha,)).fetch_df().to_dict('records')
+		file = files[0] if files else None
+		return file
+
+
 def get_file(sha, gene_set_id):
-	with __lock.read:
-		db = duckdb.connect(database=DATABASE, read_only=True)
+	with __connections.read() as db:
 		query = 'SELECT * FROM files WHERE hash = ? AND gene_set_id = ?'
 		files = db.execute(query, (sha, gene_set_id)).fetch_df().to_dict('records')
 		file = files[0] if files else None
-		db.close()
 		return file
 
 
 def save_file(filename, sha, path, genome_ref, gene_set_id, created_at, status='unprocessed'):
-	with __lock.write:
-		db = duckdb.connect(database=DATABASE, read_only=False)
+	with __connections.write() as db:
 		db.execute(
 			'INSERT INTO files (hash, name, path, genome_ref, created_at, status, gene_set_id) VALUES (?, ?, ?, ?, ?, ?, ?)',
 			(sha, filename, path, genome_ref, created_at, status, gene_set_id))
-		db.close()
 
 
 def update_file_status(sha, gene_set_id, status):
-	with __lock.write:
-		db = duckdb.connect(database=DATABASE, read_only=False)
+	with __connections.write() as db:
 		db.execute('UPDATE files SET status=? WHERE hash = ? AND gene_set_id = ?', (status, sha, gene_set_id))
-		db.close()
 
 
 def get_files():
-	with __lock.read:
-		db = duckdb.connect(database=DATABASE, read_only=True)
+	with __connections.read() as db:
 		query = """
 		SELECT f.hash,
 			   f.name,
@@ -260,16 +1498,38 @@ def get_files():
 		JOIN gene_sets g ON g.id = f.gene_set_id
 		"""
 		files =  db.execute(query).fetch_df().to_dict('records')
-		db.close()
 		return files
 
 
+def get_files_with_gene(gene_hgnc):
+	"""
+	Returns the files (and gene sets) with saved variants of the gene.
+	"""
+	with __connections.read() as db:
+		query = """
+		SELECT f.hash, f.name, f.gene_set_id, s.name AS gene_set_name
+		FROM genes g
+		JOIN files f ON f.hash = g.file_hash AND f.gene_set_id = g.gene_set_id
+		JOIN gene_sets s ON s.id = g.gene_set_id
+		WHERE g.gene_hgnc = ?
+		ORDER BY f.created_at
+		"""
+		return db.execute(query, (gene_hgnc,)).fetch_df().to_dict('records')
+
+
 def get_chromosome_for_gene(gene_hgnc):
-	with __lock.read:
-		db = duckdb.connect(database=DATABASE, read_only=True)
-		chroms =  db.execute('SELECT chrom FROM variants WHERE gene_hgnc = ? LIMIT 1', (gene_hgnc,)).fetchone()
+	with __connections.read() as db:
+		summary = db.execute('SELECT chrom FROM gene_summaries WHERE gene_hgnc = ? AND chrom IS NOT NULL LIMIT 1', (gene_hgnc,)).fetchone()
+		if summary is not None:
+			return summary[0]
+
+		# find a file with the gene first, so that only its rows of the gene are scanned
+		gene = db.execute('SELECT file_hash, gene_set_id FROM genes WHERE gene_hgnc = ? LIMIT 1', (gene_hgnc,)).fetchone()
+		if gene is None:
+			return None
+		query = 'SELECT chrom FROM variants WHERE file_hash = ? AND gene_set_id = ? AND gene_hgnc = ? LIMIT 1'
+		chroms = db.execute(query, (gene[0], gene[1], gene_hgnc)).fetchone()
 		chrom = chroms[0] if chroms else None
-		db.close()
 		return chrom
 
 
@@ -277,59 +1537,199 @@ def __in_filter(column, values):
 	return '  AND {} IN ({})'.format(column, ','.join(['?']*len(values)))
 
 
-def get_variants(sha, gene_set_id, gene_hgnc, effects=None, impacts=None, biotypes=None, feature_types=None):
-	with __lock.read:
-		db = duckdb.connect(database=DATABASE, read_only=True)
-		variants_df = None
-		query = """
-		SELECT DISTINCT v.gene_variation, start_pos, end_pos, ref, a.alt, var_type, var_subtype
-		FROM variants v
-		JOIN annotations a ON v.file_hash = a.file_hash AND v.gene_hgnc = a.gene_hgnc AND v.gene_variation = a.gene_variation
-		WHERE v.file_hash = ?
-		    AND v.gene_set_id = ?
-			AND v.gene_hgnc = ?
-        """
-
-		if effects:
-			query += __in_filter('effect', effects)
-		if impacts:
-			query += __in_filter('impact', impacts)
-		if biotypes:
-			query += __in_filter('transcript_biotype', biotypes)
-		if feature_types:
-			query += __in_filter('feature_type', feature_types)
-
-		params = [sha, gene_set_id, gene_hgnc] + [v for p in [effects, impacts, biotypes, feature_types] for v in p if p]
-
-		variants_df =  db.execute(query, params).fetch_df()
+def info_filter(info_filters, alias='v'):
+	"""
+	Returns the SQL conditions (and their params) that keep only the variants (of the
+	variants or annotations table aliased as alias) with a value of each of the given
+	numeric INFO fields in a range. info_filters is a list of (key, min_value, max_value)
+	tuples, where either of the bounds can be None. Multi-value fields match if any of
+	their values does.
+	"""
+	query = ''
+	params = []
+	for key, min_value, max_value in info_filters or []:
+		query += """
+		AND EXISTS (
+			SELECT 1
+			FROM info_values i
+			WHERE i.file_hash = {alias}.file_hash
+			  AND i.gene_set_id = {alias}.gene_set_id
+			  AND i.gene_hgnc = {alias}.gene_hgnc
+			  AND i.gene_variation = {alias}.gene_variation
+			  AND i.key = ?
+			  AND i.number_value IS NOT NULL
+		""".format(alias=alias)
+		params.append(key)
+		if min_value is not None:
+			query += '  AND i.number_value >= ?'
+			params.append(min_value)
+		if max_value is not None:
+			query += '  AND i.number_value <= ?'
+			params.append(max_value)
+		query += ')'
+	return query, params
+
+
+# columns by which the variants can be sorted (see get_variants)
+VARIANT_SORT_COLUMNS = ('start_pos', 'end_pos', 'af', 'ac', 'het_count', 'hom_alt_count', 'call_rate')
+
+
+def get_variants(
+		sha,
+		gene_set_id,
+		gene_hgnc,
+		effects=None,
+		impacts=None,
+		biotypes=None,
+		feature_types=None,
+		min_af=None,
+		max_af=None,
+		min_call_rate=None,
+		info_filters=None,
+		rank=None,
+		min_prot_pos=None,
+		max_prot_pos=None,
+		max_distance=None,
+		sort='start_pos',
+		descending=False,
+		after=None,
+		limit=None):
+	"""
+	Returns the variants of the gene with an annotation matching the given filters.
+	min_af, max_af and min_call_rate filter on the cohort statistics of the variants
+	and info_filters on the values of numeric INFO fields (see info_filter).
+	rank (of the exon or intron), min_prot_pos, max_prot_pos and max_distance
+	(to the feature, in either direction) filter on the positions of the annotations.
+
+	The variants are sorted by the sort column (one of VARIANT_SORT_COLUMNS, with the
+	missing values last) and then by gene_variation. A page of at most limit variants
+	is read after the (sort_key, gene_variation) cursor given as after, which is
+	taken from the last variant of the previous page.
+	"""
+	if sort not in VARIANT_SORT_COLUMNS:
+		raise ValueError('Cannot sort the variants by {}'.format(sort))
+
+	annotation_query = ''
+	annotation_params = []
+	for column, values in [('effect', effects), ('impact', impacts), ('transcript_biotype', biotypes), ('feature_type', feature_types)]:
+		if values:
+			annotation_query += __in_filter(column, values)
+			annotation_params += values
+	if rank is not None:
+		annotation_query += '  AND rank = ?'
+		annotation_params.append(rank)
+	if min_prot_pos is not None:
+		annotation_query += '  AND prot_pos >= ?'
+		annotation_params.append(min_prot_pos)
+	if max_prot_pos is not None:
+		annotation_query += '  AND prot_pos <= ?'
+		annotation_params.append(max_prot_pos)
+	if max_distance is not None:
+		annotation_query += '  AND distance BETWEEN ? AND ?'
+		annotation_params += [-max_distance, max_distance]
+
+	# the missing statistics are sorted last in both directions
+	sort_key = "coalesce(CAST(v.{} AS DOUBLE), '{}'::DOUBLE)".format(sort, '-inf' if descending else 'inf')
+	query = """
+	SELECT
+		v.gene_variation, start_pos, end_pos, ref, alt, var_type, var_subtype,
+		an, ac, af, het_count, hom_ref_count, hom_alt_count, called_count, call_rate,
+		{sort_key} AS sort_key
+	FROM variants v
+	WHERE v.file_hash = ?
+	  AND v.gene_set_id = ?
+	  AND v.gene_hgnc = ?
+	  AND EXISTS (
+		SELECT 1
+		FROM annotations a
+		WHERE a.file_hash = ?
+		  AND a.gene_set_id = ?
+		  AND a.gene_hgnc = ?
+		  AND a.gene_variation = v.gene_variation
+		{annotation_filter}
+	  )
+	""".format(sort_key=sort_key, annotation_filter=annotation_query)
+	params = [sha, gene_set_id, gene_hgnc] * 2 + annotation_params
+
+	if min_af is not None:
+		query += '  AND af >= ?'
+		params.append(min_af)
+	if max_af is not None:
+		query += '  AND af <= ?'
+		params.append(max_af)
+	if min_call_rate is not None:
+		query += '  AND call_rate >= ?'
+		params.append(min_call_rate)
+
+	info_query, info_params = info_filter(info_filters)
+	query += info_query
+	params += info_params
+
+	if after is not None:
+		after_sort_key, after_variation = after
+		query += '  AND ({sort_key} {op} ? OR ({sort_key} = ? AND v.gene_variation {op} ?))'.format(
+			sort_key=sort_key, op='<' if descending else '>')
+		params += [after_sort_key, after_sort_key, after_variation]
+
+	direction = 'DESC' if descending else 'ASC'
+	query += ' ORDER BY sort_key {0}, v.gene_variation {0}'.format(direction)
+	if limit is not None:
+		query += ' LIMIT ?'
+		params.append(limit)
+
+	with __connections.read() as db:
+		variants_df = db.execute(query, params).fetch_df()
 		# convert 0-based index to 1-based and half-open interval, i.e [) to closed, i.e. []
 		variants_df['start_pos'] += 1
-		db.close()
 		return variants_df
 
 
+def get_variants_extent(sha, gene_set_id, gene_hgnc):
+	"""
+	Returns the number of variants of the gene and the positions (1-based)
+	of the first and the last of them.
+	"""
+	query = """
+	SELECT count(*) AS count, min(start_pos) + 1 AS start_pos, max(end_pos) AS end_pos
+	FROM variants
+	WHERE file_hash = ?
+	  AND gene_set_id = ?
+	  AND gene_hgnc = ?
+	"""
+	with __connections.read() as db:
+		return db.execute(query, (sha, gene_set_id, gene_hgnc)).fetch_df().to_dict('records')[0]
+
+
 def delete_file(sha, gene_set_id):
-	with __lock.write:
-		db = duckdb.connect(database=DATABASE, read_only=False)
-		db.execute('DELETE FROM annotations WHERE file_hash = ? AND gene_set_id = ?', (sha, gene_set_id))
-		db.execute('DELETE FROM variants WHERE file_hash = ? AND gene_set_id = ?', (sha, gene_set_id))
-		db.execute('DELETE FROM genes WHERE file_hash = ? AND gene_set_id = ?', (sha, gene_set_id))
+	with __connections.write() as db:
+		for table in reversed(STAGED_TABLES):
+			if not __is_partitioned(table):
+				db.execute('DELETE FROM {} WHERE file_hash = ? AND gene_set_id = ?'.format(table), (sha, gene_set_id))
 		db.execute('DELETE FROM tasks WHERE file_hash = ? AND gene_set_id = ?', (sha, gene_set_id))
+		db.execute('DELETE FROM jobs WHERE file_hash = ? AND gene_set_id = ?', (sha, gene_set_id))
+		db.execute('DELETE FROM progress WHERE file_hash = ? AND gene_set_id = ?', (sha, gene_set_id))
+		db.execute('DELETE FROM samples WHERE file_hash = ? AND gene_set_id = ?', (sha, gene_set_id))
+		for table in SUMMARY_TABLES:
+			db.execute('DELETE FROM {} WHERE file_hash = ? AND gene_set_id = ?'.format(table), (sha, gene_set_id))
 		db.execute('DELETE FROM files WHERE hash = ? AND gene_set_id = ?', (sha, gene_set_id))
-		db.close()
+	__remove_staging_database(sha, gene_set_id)
+	if STORAGE == STORAGE_PARQUET:
+		for table in PARTITIONED_TABLES:
+			partition = get_partition(table, sha, gene_set_id)
+			shutil.rmtree(partition, ignore_errors=True)
+			# the partitions of the file for other gene sets are in the same folder
+			if os.path.isdir(os.path.dirname(partition)) and not os.listdir(os.path.dirname(partition)):
+				os.rmdir(os.path.dirname(partition))
 
 
 def get_gene_sets():
-	with __lock.read:
-		db = duckdb.connect(database=DATABASE, read_only=True)
+	with __connections.read() as db:
 		gene_sets =  db.execute('SELECT * FROM gene_sets').fetch_df().to_dict('records')
-		db.close()
 		return gene_sets
 
 
 def save_gene_set(name, description, genes):
-	with __lock.write:
-		db = duckdb.connect(database=DATABASE, read_only=False)
+	with __connections.write() as db:
 		cursor = db.cursor()
 		insert_gene_set_query = """
 		INSERT INTO gene_sets (id, name, description, created_at)
@@ -341,57 +1741,45 @@ def save_gene_set(name, description, genes):
 		VALUES (nextval('gene_set_members_id_seq'), ?, currval('gene_sets_id_seq'))
 		"""
 		db.executemany(insert_gene_query, [[gene] for gene in genes])
-		db.close()
 
 
 def delete_gene_set(id):
-	with __lock.write:
-		db = duckdb.connect(database=DATABASE, read_only=False)
+	with __connections.write() as db:
 		db.execute('DELETE FROM gene_set_members WHERE gene_set_id = ?', (id,))
 		db.execute('DELETE FROM gene_sets WHERE id = ?', (id,))
-		db.close()
 
 
 def get_gene_set_by_id(id):
-	with __lock.read:
-		db = duckdb.connect(database=DATABASE, read_only=True)
+	with __connections.read() as db:
 		query = 'SELECT * FROM gene_sets WHERE id = ?'
 		gene_sets = db.execute(query, (id,)).fetch_df().to_dict('records')
 		gene_set = gene_sets[0] if gene_sets else None
-		db.close()
 		return gene_set
 
 
 def get_genes_for_gene_set(id):
-	with __lock.read:
-		db = duckdb.connect(database=DATABASE, read_only=True)
+	with __connections.read() as db:
 		query = 'SELECT * FROM gene_set_members WHERE gene_set_id = ?'
 		genes = db.execute(query, (id,)).fetch_df().to_dict('records')
-		db.close()
 		return genes
 
 
 def save_gene_set_member(name, gene_set_id):
-	with __lock.write:
-		db = duckdb.connect(database=DATABASE, read_only=False)
+	with __connections.write() as db:
 		query = """
 		INSERT INTO gene_set_members (id, name, gene_set_id)
 		VALUES (nextval('gene_set_members_id_seq'), ?, ?)
 		"""
 		db.execute(query, (name, gene_set_id))
-		db.close()
 
 
 def delete_gene_set_member(id):
-	with __lock.write:
-		db = duckdb.connect(database=DATABASE, read_only=False)
+	with __connections.write() as db:
 		db.execute('DELETE FROM gene_set_members WHERE id = ?', (id,))
-		db.close()
 
 
 def get_variant(file_hash, gene_set_id, gene_hgnc, variant_id):
-	with __lock.read:
-		db = duckdb.connect(database=DATABASE, read_only=True)
+	with __connections.read() as db:
 		query = """
 		SELECT *
 		FROM variants
@@ -407,13 +1795,11 @@ def get_variant(file_hash, gene_set_id, gene_hgnc, variant_id):
 			variant = variants[0]
 			# convert 0-based index to 1-based and half-open interval, i.e [) to closed, i.e. []
 			variant['start_pos'] += 1
-		db.close()
 		return variant
 
 
 def get_variant_annotations(file_hash, gene_set_id, gene_hgnc, variant_id):
-	with __lock.read:
-		db = duckdb.connect(database=DATABASE, read_only=True)
+	with __connections.read() as db:
 		query = """
 		SELECT *
 		FROM annotations
@@ -423,13 +1809,11 @@ def get_variant_annotations(file_hash, gene_set_id, gene_hgnc, variant_id):
 		  AND gene_variation = ?
 		"""
 		annotations = db.execute(query, (file_hash, gene_set_id, gene_hgnc, variant_id)).fetch_df().to_dict('records')
-		db.close()
 		return annotations
 
 
 def get_variant_annotation(file_hash, gene_set_id, gene_hgnc, variant_id, annotation_id):
-	with __lock.read:
-		db = duckdb.connect(database=DATABASE, read_only=True)
+	with __connections.read() as db:
 		query = """
 		SELECT *
 		FROM annotations
@@ -442,13 +1826,11 @@ def get_variant_annotation(file_hash, gene_set_id, gene_hgnc, variant_id, annota
 		"""
 		annotations = db.execute(query, (file_hash, gene_set_id, gene_hgnc, variant_id, annotation_id)).fetch_df().to_dict('records')
 		annotation = annotations[0] if annotations else None
-		db.close()
 		return annotation
 
 
 def get_transcripts_for_variant(file_hash, gene_set_id, gene_hgnc, variation_id):
-	with __lock.read:
-		db = duckdb.connect(database=DATABASE, read_only=True)
+	with __connections.read() as db:
 		query = """
 		SELECT feature_id
 		FROM annotations
@@ -459,13 +1841,72 @@ def get_transcripts_for_variant(file_hash, gene_set_id, gene_hgnc, variation_id)
 		  AND feature_type = 'transcript'
 		"""
 		genes = db.execute(query, (file_hash, gene_hgnc, gene_hgnc, variation_id)).fetch_df().to_dict('records')
-		db.close()
 		return genes
 
 
+def save_samples(file_hash, gene_set_id, names):
+	with __connections.write() as db:
+		db.begin()
+		db.execute('DELETE FROM samples WHERE file_hash = ? AND gene_set_id = ?', (file_hash, gene_set_id))
+		if names:
+			db.executemany(
+				'INSERT INTO samples (file_hash, gene_set_id, sample_index, name) VALUES (?, ?, ?, ?)',
+				[(file_hash, gene_set_id, i, name) for i, name in enumerate(names)])
+		db.commit()
+
+
+def get_samples(file_hash, gene_set_id):
+	with __connections.read() as db:
+		query = 'SELECT name FROM samples WHERE file_hash = ? AND gene_set_id = ? ORDER BY sample_index'
+		samples = [row[0] for row in db.execute(query, (file_hash, gene_set_id)).fetchall()]
+		return samples
+
+
+def get_genotypes(file_hash, gene_set_id, gene_hgnc, variations=None, first_sample=0, last_sample=None):
+	"""
+	Returns a dataframe with the ploidy and the compact genotypes (see the genotypes table)
+	of the given variants of the gene (a list of gene_variation ids, a slice of them or None for all),
+	ordered by gene_variation. Only the part of the genotypes of the samples from first_sample
+	to last_sample (exclusive) is read. The phased and missing bits start from the byte of first_sample.
+	"""
+	query = """
+	SELECT
+		gene_variation,
+		ploidy,
+		array_slice(alleles, ? * ploidy + 1, ? * ploidy) AS alleles,
+		array_slice(phased, ? + 1, ?) AS phased,
+		array_slice(missing, ? + 1, ?) AS missing
+	FROM genotypes
+	WHERE file_hash = ?
+	  AND gene_set_id = ?
+	  AND gene_hgnc = ?
+	"""
+	if last_sample is None:
+		last_sample = len(get_samples(file_hash, gene_set_id))
+	first_byte = first_sample // 8
+	last_byte = (last_sample + 7) // 8
+	params = [first_sample, last_sample, first_byte, last_byte, first_byte, last_byte, file_hash, gene_set_id, gene_hgnc]
+
+	if isinstance(variations, slice):
+		if variations.start is not None:
+			query += '  AND gene_variation >= ?'
+			params.append(variations.start)
+		if variations.stop is not None:
+			query += '  AND gene_variation < ?'
+			params.append(variations.stop)
+	elif variations is not None and len(variations) == 0:
+		query += '  AND FALSE'
+	elif variations is not None:
+		query += __in_filter('gene_variation', variations)
+		params += [int(variation) for variation in variations]
+	query += ' ORDER BY gene_variation'
+
+	with __connections.read() as db:
+		genotypes = db.execute(query, params).fetch_df()
+		return genotypes
+
+
 def read_query(query, params):
-	with __lock.read:
-		db = duckdb.connect(database=DATABASE, read_only=True)
+	with __connections.read() as db:
 		df = db.execute(query, params).fetch_df()
-		db.close()
 		return df
\ No newline at end of file
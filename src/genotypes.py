@@ -0,0 +1,210 @@
+import numpy as np
+import pandas as pd
+
+from collections import namedtuple
+
+
+# Allele codes of the genotype matrix, besides the allele indexes (0 for REF, 1 for the first ALT, ...)
+MISSING_ALLELE = -1
+# Used for the samples with a lower ploidy than the other samples of the variant,
+# e.g. the haploid calls of males on chromosome X
+NO_ALLELE = -2
+
+# The fast parsing handles GTs with single-digit alleles of up to two sets (e.g. 0, 1|0, ./.)
+MAX_FAST_GT_LENGTH = 3
+
+DIGITS = (ord('0'), ord('9'))
+DOT = ord('.')
+PHASED = ord('|')
+UNPHASED = ord('/')
+
+GENOTYPE_COLUMNS = ['ploidy', 'alleles', 'phased', 'missing']
+
+# Cohort statistics of each variant, computed from the genotypes of all samples:
+# the number of called alleles (an), of ALT alleles (ac) and the ALT allele frequency (af),
+# the numbers of heterozygous, homozygous REF and homozygous ALT (incl. hemizygous) samples,
+# the number of samples with a complete call and the fraction of such samples (call_rate)
+COUNT_STATS_COLUMNS = ['an', 'ac', 'het_count', 'hom_ref_count', 'hom_alt_count', 'called_count']
+STATS_COLUMNS = ['an', 'ac', 'af', 'het_count', 'hom_ref_count', 'hom_alt_count', 'called_count', 'call_rate']
+
+Genotypes = namedtuple('Genotypes', ['variations', 'samples', 'alleles', 'phased', 'missing'])
+Genotypes.__doc__ = """
+Genotypes of a gene: alleles is a variations x samples x ploidy int8 array of allele codes,
+phased and missing are variations x samples boolean arrays.
+"""
+
+
+def __get_gts(fmt, samples):
+    gts = samples.split('\t')
+    if fmt != 'GT':
+        # GT is always the first field
+        gts = [call.split(':', 1)[0] for call in gts]
+    return gts
+
+
+def __is_allele(chars):
+    return ((chars >= DIGITS[0]) & (chars <= DIGITS[1])) | (chars == DOT)
+
+
+def __parse_gts_fast(gts):
+    """
+    Parses the GTs at once with numpy, if all of them are short (see MAX_FAST_GT_LENGTH).
+    Returns None otherwise.
+    """
+    if max(map(len, gts)) > MAX_FAST_GT_LENGTH:
+        return None
+
+    chars = np.array(gts, dtype='S{}'.format(MAX_FAST_GT_LENGTH)).view(np.uint8).reshape(len(gts), MAX_FAST_GT_LENGTH)
+    haploid = chars[:, 1] == 0
+    diploid = (chars[:, 1] == PHASED) | (chars[:, 1] == UNPHASED)
+    valid = __is_allele(chars[:, 0]) \
+        & ((haploid & (chars[:, 2] == 0)) | (diploid & __is_allele(chars[:, 2])))
+    if not valid.all():
+        return None
+
+    ploidy = 1 if haploid.all() else 2
+    allele_chars = chars[:, 0:ploidy * 2:2]
+    alleles = np.where(allele_chars == DOT, MISSING_ALLELE, allele_chars.astype(np.int16) - DIGITS[0]).astype(np.int8)
+    if ploidy == 2:
+        alleles[haploid, 1] = NO_ALLELE
+    return alleles, chars[:, 1] == PHASED
+
+
+def __parse_gts(gts):
+    ploidy = 1
+    split_gts = []
+    for gt in gts:
+        split_gt = gt.replace('|', '/').split('/')
+        ploidy = max(ploidy, len(split_gt))
+        split_gts.append(split_gt)
+
+    alleles = np.full((len(gts), ploidy), NO_ALLELE, dtype=np.int8)
+    for i, split_gt in enumerate(split_gts):
+        codes = [MISSING_ALLELE if allele in ('.', '') else int(allele) for allele in split_gt]
+        if max(codes) > np.iinfo(np.int8).max:
+            raise ValueError('Allele index {} does not fit in the genotype matrix'.format(max(codes)))
+        alleles[i, :len(codes)] = codes
+
+    phased = np.array(['|' in gt for gt in gts], dtype=bool)
+    return alleles, phased
+
+
+def parse_genotypes(formats, samples, index):
+    """
+    Parses the sample columns of VCF records (a string with the tab-separated
+    calls of all samples per record) into a dataframe with the given index and
+    the ploidy and the compact genotypes of each record as bytes:
+    - alleles - the int8 allele codes of all samples, ploidy per sample
+    - phased - a bit per sample (packed with numpy.packbits)
+    - missing - a bit per sample, for the calls without any called allele
+    Records without samples or GT are left out.
+    """
+    rows = []
+    row_index = []
+    for i, fmt, record_samples in zip(index, formats, samples):
+        if record_samples is None or fmt is None or not fmt.startswith('GT'):
+            continue
+
+        gts = __get_gts(fmt, record_samples)
+        parsed = __parse_gts_fast(gts)
+        if parsed is None:
+            parsed = __parse_gts(gts)
+        alleles, phased = parsed
+        missing = (alleles < 0).all(axis=1)
+
+        rows.append((alleles.shape[1], alleles.tobytes(), np.packbits(phased).tobytes(), np.packbits(missing).tobytes()))
+        row_index.append(i)
+
+    return pd.DataFrame(rows, index=row_index, columns=GENOTYPE_COLUMNS)
+
+
+def __get_ploidy_stats(alleles):
+    """
+    Computes the count statistics of the variants from a variants x samples x ploidy
+    array of allele codes. Returns a dict of column to array with a value per variant.
+    """
+    present = alleles != NO_ALLELE
+    called_alleles = alleles >= 0
+    called = (called_alleles | ~present).all(axis=2) & present.any(axis=2)
+
+    first = alleles[:, :, 0]
+    homozygous = called & ((alleles == first[:, :, np.newaxis]) | ~present).all(axis=2)
+
+    return {
+        'an': called_alleles.sum(axis=(1, 2)),
+        'ac': (alleles > 0).sum(axis=(1, 2)),
+        'het_count': (called & ~homozygous).sum(axis=1),
+        'hom_ref_count': (homozygous & (first == 0)).sum(axis=1),
+        'hom_alt_count': (homozygous & (first > 0)).sum(axis=1),
+        'called_count': called.sum(axis=1),
+    }
+
+
+def get_cohort_stats(genotypes):
+    """
+    Computes the STATS_COLUMNS of each variant from a genotypes dataframe
+    (as returned by parse_genotypes) and returns them as a dataframe with the same index.
+    The genotypes of the variants with the same ploidy are processed as one matrix.
+    """
+    stats = pd.DataFrame(index=genotypes.index, columns=COUNT_STATS_COLUMNS, dtype='UInt32')
+    sample_count = 0
+
+    for ploidy, rows in genotypes.groupby('ploidy'):
+        alleles = np.frombuffer(b''.join(rows['alleles']), dtype=np.int8).reshape(len(rows), -1, ploidy)
+        sample_count = alleles.shape[1]
+        for column, values in __get_ploidy_stats(alleles).items():
+            stats.loc[rows.index, column] = values
+
+    stats['af'] = (stats['ac'] / stats['an'].where(stats['an'] > 0)).astype('Float64')
+    stats['call_rate'] = (stats['called_count'] / max(sample_count, 1)).astype('Float64')
+    return stats[STATS_COLUMNS]
+
+
+def __unpack_bits(packed, first_bit, count):
+    bits = np.unpackbits(np.frombuffer(packed, dtype=np.uint8))
+    return bits[first_bit:first_bit + count].astype(bool)
+
+
+def get_sample_range(sample_names, samples=None):
+    """
+    Returns the indexes of the given samples (names, indexes or a slice of indexes,
+    all of them by default) and the range of the indexes [first, last) that covers them.
+    """
+    if samples is None:
+        sample_indexes = np.arange(len(sample_names))
+    elif isinstance(samples, slice):
+        sample_indexes = np.arange(len(sample_names))[samples]
+    else:
+        positions = {name: i for i, name in enumerate(sample_names)}
+        sample_indexes = np.array([positions[sample] if isinstance(sample, str) else sample for sample in samples], dtype=np.int64)
+
+    first_sample = int(sample_indexes.min()) if len(sample_indexes) else 0
+    last_sample = int(sample_indexes.max()) + 1 if len(sample_indexes) else 0
+    return sample_indexes, first_sample, last_sample
+
+
+def decode_genotypes(rows, sample_names, sample_indexes, first_sample, last_sample):
+    """
+    Returns the Genotypes of the given samples from the rows of the genotypes table
+    with the bytes of the samples from first_sample to last_sample (see get_sample_range).
+    """
+    relative_indexes = sample_indexes - first_sample
+    ploidy = int(rows['ploidy'].max()) if len(rows) else 1
+    alleles = np.full((len(rows), len(sample_indexes), ploidy), NO_ALLELE, dtype=np.int8)
+    phased = np.zeros((len(rows), len(sample_indexes)), dtype=bool)
+    missing = np.ones((len(rows), len(sample_indexes)), dtype=bool)
+
+    first_bit = first_sample % 8
+    sample_count = last_sample - first_sample
+    for i, row in enumerate(rows.itertuples(index=False)):
+        row_alleles = np.frombuffer(row.alleles, dtype=np.int8).reshape(sample_count, row.ploidy)
+        alleles[i, :, :row.ploidy] = row_alleles[relative_indexes]
+        phased[i] = __unpack_bits(row.phased, first_bit, sample_count)[relative_indexes]
+        missing[i] = __unpack_bits(row.missing, first_bit, sample_count)[relative_indexes]
+
+    return Genotypes(
+        rows['gene_variation'].to_numpy(),
+        [sample_names[i] for i in sample_indexes],
+        alleles,
+        phased,
+        missing)
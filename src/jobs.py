@@ -0,0 +1,123 @@
+import os
+import threading
+import traceback
+
+import db
+import utils
+from config import CONFIG
+from tasks import parse
+from vcf_processing import ProcessingCancelledException
+
+
+# The genes of each job are written to a separate file, so that jobs of the same gene set can run at once
+GENES_FILE = 'data/genes_job_{}.csv'
+
+
+class JobScheduler:
+    """
+    Runs the processing of the uploaded files in the background.
+    The jobs are queued in the database and started in the order of their priority
+    (smaller files first), as long as at most max_running_jobs are running and the memory
+    reserved by the running jobs (snpeff_heap_gb each) fits in memory_gb.
+    The jobs of a file run one at a time, since they share its intermediary files.
+    Queued jobs and the jobs that were running when the application stopped
+    are started again by start.
+    """
+
+    def __init__(self, max_running_jobs=1, memory_gb=None):
+        self.max_running_jobs = max_running_jobs
+        self.memory_gb = memory_gb
+        self.lock = threading.Lock()
+        # job id to the event that cancels it
+        self.running = {}
+        # hashes of the files being processed, which share their intermediary files
+        self.running_files = set()
+        self.reserved_memory_gb = 0
+
+    def start(self):
+        db.requeue_running_jobs()
+        self.__dispatch()
+
+    def submit(self, path, file_hash, gene_set_id):
+        """
+        Queues the processing of the file for the gene set and returns the id of the job.
+        If the file is already queued or being processed for the gene set, returns the id of that job.
+        """
+        with self.lock:
+            job = db.get_active_job(file_hash, gene_set_id)
+            if job:
+                return job['id']
+
+            job_id = db.save_job(
+                file_hash,
+                gene_set_id,
+                path,
+                os.path.getsize(path),
+                CONFIG.get('snpeff_heap_gb', 25))
+
+        self.__dispatch()
+        return job_id
+
+    def cancel(self, job_id):
+        """
+        Cancels the job. A running job stops at the next check and keeps
+        its checkpoints, so it continues from them if the file is submitted again.
+        Returns False if the job is not queued or running.
+        """
+        with self.lock:
+            job = db.get_job(job_id)
+            if not job or job['status'] not in db.JOB_ACTIVE_STATUSES:
+                return False
+
+            if job_id in self.running:
+                self.running[job_id].set()
+            else:
+                db.update_job_status(job_id, db.JOB_CANCELLED)
+            return True
+
+    def __fits(self, job):
+        if not self.running:
+            # a job that needs more than the whole limit still runs on its own
+            return True
+        if len(self.running) >= self.max_running_jobs:
+            return False
+        return self.memory_gb is None or self.reserved_memory_gb + job['memory_gb'] <= self.memory_gb
+
+    def __dispatch(self):
+        with self.lock:
+            for job in db.get_jobs([db.JOB_QUEUED]):
+                # a file is processed by one job at a time, the others wait for it to finish
+                if job['file_hash'] in self.running_files:
+                    continue
+                # the jobs start strictly in order, so that large files are not starved by small ones
+                if not self.__fits(job):
+                    break
+
+                cancelled = threading.Event()
+                self.running[job['id']] = cancelled
+                self.running_files.add(job['file_hash'])
+                self.reserved_memory_gb += job['memory_gb']
+                db.update_job_status(job['id'], db.JOB_RUNNING)
+
+                th = threading.Thread(target=self.__run, args=(job, cancelled), daemon=True)
+                th.start()
+
+    def __run(self, job, cancelled):
+        genes_file = GENES_FILE.format(job['id'])
+        try:
+            utils.save_genes_to_file(db.get_genes_for_gene_set(job['gene_set_id']), genes_file)
+            parse(job['path'], genes_file, job['gene_set_id'], cancelled=cancelled, vcf_sha=job['file_hash'])
+            db.update_job_status(job['id'], db.JOB_DONE)
+        except ProcessingCancelledException:
+            db.update_job_status(job['id'], db.JOB_CANCELLED)
+        except Exception as e:
+            traceback.print_exc()
+            db.update_job_status(job['id'], db.JOB_FAILED, str(e))
+        finally:
+            if os.path.exists(genes_file):
+                os.remove(genes_file)
+            with self.lock:
+                del self.running[job['id']]
+                self.running_files.discard(job['file_hash'])
+                self.reserved_memory_gb -= job['memory_gb']
+            self.__dispatch()
@@ -0,0 +1,136 @@
+import time
+import threading
+
+from datetime import datetime
+
+import db
+from bgzf import open_compressed
+
+
+# Stages of the processing of a file, in the order in which they run
+STAGE_READING = 'reading'
+STAGE_ANNOTATING = 'annotating'
+STAGE_SPLITTING = 'splitting'
+STAGE_INDEXING = 'indexing'
+STAGE_PARSING = 'parsing'
+STAGE_LOADING = 'loading'
+
+STAGES = [STAGE_READING, STAGE_ANNOTATING, STAGE_SPLITTING, STAGE_INDEXING, STAGE_PARSING, STAGE_LOADING]
+
+# Minimum number of seconds between two saves of the progress of a stage
+SAVE_INTERVAL = 1.0
+
+# Number of lines read between two reports of the read bytes
+READ_REPORT_LINES = 1000
+
+
+class ProgressReporter:
+    """
+    Keeps track of how much of each stage of the processing of a file is done
+    and saves it to the database (at most once every SAVE_INTERVAL seconds per stage),
+    so that it can be shown while the file is processed. Thread-safe.
+    """
+
+    def __init__(self, file_hash, gene_set_id):
+        self.file_hash = file_hash
+        self.gene_set_id = gene_set_id
+        self.stages = {}
+        self.saved_at = {}
+        self.lock = threading.Lock()
+        db.delete_progress(file_hash, gene_set_id)
+
+    def __save(self, stage):
+        self.saved_at[stage] = time.monotonic()
+        db.save_progress(self.file_hash, self.gene_set_id, stage, **self.stages[stage])
+
+    def start(self, stage, unit, total=None):
+        """
+        Starts the stage, or adds total to the total of the stage if it has already started.
+        """
+        with self.lock:
+            if stage in self.stages:
+                if total is not None:
+                    self.stages[stage]['total'] = (self.stages[stage]['total'] or 0) + total
+            else:
+                now = datetime.now()
+                self.stages[stage] = {
+                    'unit': unit,
+                    'done': 0,
+                    'total': total,
+                    'started_at': now,
+                    'updated_at': now,
+                    'finished_at': None,
+                }
+            self.__save(stage)
+
+    def advance(self, stage, n=1):
+        with self.lock:
+            self.stages[stage]['done'] += n
+            self.stages[stage]['updated_at'] = datetime.now()
+            if time.monotonic() - self.saved_at.get(stage, 0) >= SAVE_INTERVAL:
+                self.__save(stage)
+
+    def finish(self, stage):
+        with self.lock:
+            if stage in self.stages:
+                self.stages[stage]['finished_at'] = self.stages[stage]['updated_at'] = datetime.now()
+                self.__save(stage)
+
+
+class NoProgress:
+    """
+    Ignores the progress, for processing that is not reported.
+    """
+
+    def start(self, stage, unit, total=None):
+        pass
+
+    def advance(self, stage, n=1):
+        pass
+
+    def finish(self, stage):
+        pass
+
+
+NO_PROGRESS = NoProgress()
+
+
+def read_lines(file, progress=NO_PROGRESS, stage=STAGE_READING):
+    """
+    Yields the lines of the given (plain, gzipped or BGZF-compressed) file and
+    reports the number of bytes read from the disk as progress of the stage.
+    """
+    with open(file, 'rb') as raw:
+        lines = open_compressed(raw) if file.endswith('.gz') else raw
+        with lines:
+            reported = 0
+            for i, line in enumerate(lines, 1):
+                yield line
+                if i % READ_REPORT_LINES == 0:
+                    position = raw.tell()
+                    progress.advance(stage, position - reported)
+                    reported = position
+            progress.advance(stage, raw.tell() - reported)
+
+
+def get_progress(file_hash, gene_set_id):
+    """
+    Returns the progress of the stages of the processing of the file with
+    the rate (units per second) and the estimated number of seconds until
+    the end of each stage (None if the total is not known).
+    """
+    stages = db.get_progress(file_hash, gene_set_id)
+    for stage in stages:
+        end = stage['finished_at'] or datetime.now()
+        elapsed = max((end - stage['started_at']).total_seconds(), 0)
+        stage['elapsed'] = elapsed
+        stage['rate'] = stage['done'] / elapsed if elapsed > 0 else None
+
+        stage['eta'] = None
+        if stage['finished_at'] is not None:
+            stage['eta'] = 0
+        elif stage['total'] is not None and stage['rate']:
+            stage['eta'] = max(stage['total'] - stage['done'], 0) / stage['rate']
+
+    stages.sort(key=lambda stage: STAGES.index(stage['stage']))
+    return stages
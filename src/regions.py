@@ -0,0 +1,183 @@
+import os
+import gzip
+import bisect
+import pysam
+
+from collections import defaultdict
+
+from bgzf import open_vcf
+from bgzf import get_index_file
+from config import CONFIG
+
+
+GENCODE_GTF = 'data/gencode.v40.annotation.sorted.gtf.gz'
+
+# The reference genome used by the GENCODE annotation
+GENCODE_GENOME_REFERENCE = 'GRCh38'
+
+
+def __normalize_chromosome(chrom):
+    if chrom.startswith('chr'):
+        return chrom[3:]
+    return chrom
+
+
+def __merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def get_gene_regions(genes, flank=0, gtf_file=GENCODE_GTF):
+    """
+    Looks up the coordinates of the given genes (HGNC names) in the GENCODE GTF
+    and returns a dict that maps each chromosome (without the 'chr' prefix)
+    to a sorted list of disjoint [start, end] intervals (1-based, closed),
+    extended with the given flank on both sides.
+    Also returns the set of genes that were not found in the GTF.
+    """
+    gene_names = {gene.encode('utf-8') for gene in genes}
+    intervals = defaultdict(list)
+    found = set()
+
+    with gzip.open(gtf_file, 'rb') as gtf:
+        for line in gtf:
+            if line.startswith(b'#'):
+                continue
+
+            fields = line.split(b'\t', 9)
+            if fields[2] != b'gene':
+                continue
+
+            name_start = fields[8].find(b'gene_name "')
+            if name_start == -1:
+                continue
+            name_start += len(b'gene_name "')
+            name = fields[8][name_start:fields[8].find(b'"', name_start)]
+            if name not in gene_names:
+                continue
+
+            found.add(name)
+            chrom = __normalize_chromosome(fields[0].decode('utf-8'))
+            start = max(int(fields[3]) - flank, 1)
+            end = int(fields[4]) + flank
+            intervals[chrom].append((start, end))
+
+    missing = {name.decode('utf-8') for name in gene_names - found}
+    regions = {chrom: __merge_intervals(chrom_intervals) for chrom, chrom_intervals in intervals.items()}
+    return regions, missing
+
+
+def __in_regions(regions, starts, chrom, pos):
+    chrom_regions = regions.get(chrom)
+    if not chrom_regions:
+        return False
+    i = bisect.bisect_right(starts[chrom], pos) - 1
+    return i >= 0 and pos <= chrom_regions[i][1]
+
+
+def is_indexed(vcf_file):
+    return get_index_file(vcf_file) is not None
+
+
+def __open_indexed(vcf_file):
+    return pysam.TabixFile(
+        vcf_file,
+        index=get_index_file(vcf_file),
+        threads=CONFIG.get('decompression_threads', 1))
+
+
+def __write_indexed_records_in_regions(vcf_file, regions, out):
+    with __open_indexed(vcf_file) as tbx:
+        for line in tbx.header:
+            out.write(line + '\n')
+
+        # The contigs of the index are in the order of the file, so the records stay sorted
+        # as in the input (sorting the chromosome names would put e.g. 10 before 2).
+        for contig in tbx.contigs:
+            chrom = __normalize_chromosome(contig)
+            if chrom not in regions:
+                continue
+            for start, end in regions[chrom]:
+                for record in tbx.fetch(contig, start - 1, end):
+                    # Only keep records which start in the region,
+                    # so that records spanning two regions are not duplicated.
+                    pos = int(record.split('\t', 2)[1])
+                    if start <= pos <= end:
+                        out.write(record + '\n')
+
+
+def __write_streamed_records_in_regions(vcf_file, regions, out):
+    starts = {chrom: [start for start, _ in chrom_regions] for chrom, chrom_regions in regions.items()}
+
+    with open_vcf(vcf_file, 'rt') as vcf:
+        for line in vcf:
+            if line.startswith('#'):
+                out.write(line)
+                continue
+
+            chrom, pos, _ = line.split('\t', 2)
+            if __in_regions(regions, starts, __normalize_chromosome(chrom), int(pos)):
+                out.write(line)
+
+
+def create_vcf_file_for_regions(vcf_file, regions, dest_file):
+    """
+    Writes the header and the records of the given VCF that start in any of the given regions
+    (as returned by get_gene_regions) to dest_file.
+    Uses the tabix or CSI index of the VCF if there is one, otherwise streams the whole file.
+    """
+    with open(dest_file, 'w') as out:
+        if is_indexed(vcf_file):
+            __write_indexed_records_in_regions(vcf_file, regions, out)
+        else:
+            __write_streamed_records_in_regions(vcf_file, regions, out)
+    return dest_file
+
+
+def split_vcf_by_chromosome(vcf_file, dest_dir):
+    """
+    Splits the given VCF into one VCF per chromosome in dest_dir (each with the full header).
+    Returns the paths of the new files in the order in which the chromosomes appear in the input.
+    Uses the tabix or CSI index of the VCF if there is one, otherwise streams the whole file.
+    """
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+
+    shard_path = lambda i: os.path.join(dest_dir, '{}.vcf'.format(i))
+    shards = []
+
+    if is_indexed(vcf_file):
+        with __open_indexed(vcf_file) as tbx:
+            for contig in tbx.contigs:
+                shards.append(shard_path(len(shards)))
+                with open(shards[-1], 'w') as out:
+                    for line in tbx.header:
+                        out.write(line + '\n')
+                    for record in tbx.fetch(contig):
+                        out.write(record + '\n')
+        return shards
+
+    header_lines = []
+    outputs = {}
+    with open_vcf(vcf_file, 'rt') as vcf:
+        for line in vcf:
+            if line.startswith('#'):
+                header_lines.append(line)
+                continue
+
+            chrom = line[:line.index('\t')]
+            if chrom not in outputs:
+                shards.append(shard_path(len(shards)))
+                outputs[chrom] = open(shards[-1], 'w')
+                outputs[chrom].writelines(header_lines)
+            outputs[chrom].write(line)
+
+    for out in outputs.values():
+        out.close()
+
+    return shards
@@ -0,0 +1,154 @@
+import os
+import gzip
+import tempfile
+import atexit
+import threading
+
+from subprocess import PIPE
+from subprocess import DEVNULL
+from subprocess import Popen
+
+from progress import NO_PROGRESS, read_lines
+
+
+# A record that is sent after the records of each file. SnpEff annotates
+# records in order, so once it comes back all records of the file are annotated.
+SENTINEL_CHROM = b'polymorpheus_end_of_input'
+SENTINEL_RECORD = SENTINEL_CHROM + b'\t1\t.\tA\t.\t.\t.\t.\n'
+
+MINIMAL_HEADER = [
+    b'##fileformat=VCFv4.2\n',
+    b'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n',
+]
+
+
+class SnpEffServerException(Exception):
+    pass
+
+
+class SnpEffServer:
+    """
+    A long-lived SnpEff process which keeps the genome database loaded
+    and annotates the VCF records that are streamed to its stdin.
+    The process is started on the first use and restarted if it fails.
+    """
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.process = None
+        self.snpeff_header_lines = []
+        self.lock = threading.Lock()
+
+    def __read_until_sentinel(self):
+        lines = []
+        while line := self.process.stdout.readline():
+            if line.startswith(SENTINEL_CHROM + b'\t'):
+                return lines
+            lines.append(line)
+        raise SnpEffServerException('SnpEff exited with code {}'.format(self.process.wait()))
+
+    def __start(self):
+        self.process = Popen(self.cmd, stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+        self.process.stdin.writelines(MINIMAL_HEADER)
+        self.process.stdin.write(SENTINEL_RECORD)
+        self.process.stdin.flush()
+
+        # Keep the header lines added by SnpEff (e.g. the ANN definition)
+        # so that they can be added to the header of every annotated file.
+        output_header = self.__read_until_sentinel()
+        self.snpeff_header_lines = [
+            line for line in output_header
+            if line.startswith(b'##') and line not in MINIMAL_HEADER
+        ]
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def __send_records(self, file, progress):
+        try:
+            for line in read_lines(file, progress):
+                if not line.startswith(b'#') and line.strip():
+                    self.process.stdin.write(line)
+            self.process.stdin.write(SENTINEL_RECORD)
+            self.process.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            # the reader notices that the process has died
+            pass
+
+    def __annotate_to(self, file, output, progress):
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self.__start()
+
+            header_lines = []
+            with gzip.open(file, 'rb') if file.endswith('.gz') else open(file, 'rb') as vcf_file:
+                for line in vcf_file:
+                    header_lines.append(line)
+                    if not line.startswith(b'##'):
+                        break
+
+            output.writelines(header_lines[:-1])
+            output.writelines(self.snpeff_header_lines)
+            output.write(header_lines[-1])
+
+            writer = threading.Thread(target=self.__send_records, args=(file, progress))
+            writer.start()
+            try:
+                while line := self.process.stdout.readline():
+                    if line.startswith(SENTINEL_CHROM + b'\t'):
+                        break
+                    output.write(line)
+                else:
+                    raise SnpEffServerException('SnpEff exited with code {}'.format(self.process.wait()))
+            except BaseException:
+                # the output of the process is out of sync now, so it will be restarted
+                self.stop()
+                raise
+            finally:
+                writer.join()
+
+    def annotate(self, file, progress=NO_PROGRESS):
+        """
+        Annotates the given VCF (plain or gzipped) and yields
+        the lines of the annotated VCF (as bytes).
+        The bytes read from the VCF are reported to progress.
+        The whole output is written to a temporary file (next to the VCF) before
+        it's yielded, so the server isn't kept locked by a consumer that stops reading.
+        """
+        fd, output_file = tempfile.mkstemp(
+            prefix=os.path.basename(file) + '.', suffix='.snpeff', dir=os.path.dirname(file) or None)
+        try:
+            with os.fdopen(fd, 'wb') as output:
+                self.__annotate_to(file, output, progress)
+            with open(output_file, 'rb') as output:
+                yield from output
+        finally:
+            os.remove(output_file)
+
+
+__servers = {}
+__servers_lock = threading.Lock()
+
+
+def get_server(ref_genome, cmd):
+    """
+    Returns the SnpEff server for the given genome reference,
+    creating it (with the given command) if needed.
+    """
+    with __servers_lock:
+        if ref_genome not in __servers:
+            __servers[ref_genome] = SnpEffServer(cmd)
+        return __servers[ref_genome]
+
+
+def stop_servers():
+    with __servers_lock:
+        for server in __servers.values():
+            server.stop()
+        __servers.clear()
+
+
+atexit.register(stop_servers)
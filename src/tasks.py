@@ -1,15 +1,26 @@
 import os
-import pysam
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
 from datetime import datetime
 from vcf_processing import create_annotated_vcf_files_for_genes
-from vcf_processing import parse_vcf
+from vcf_processing import get_annotated_vcf_files_for_genes
+from vcf_processing import split_annotated_vcf_file
+from vcf_processing import iter_vcf_chunks
 from vcf_processing import get_header_lines
+from vcf_processing import get_sample_names
 from vcf_processing import validate_vcf_version
 from vcf_processing import validate_and_get_genome_reference
-from vcf_processing import create_filtered_vcf_file
+from vcf_processing import write_vcf_chunks
+from vcf_processing import read_vcf_chunks
+from vcf_processing import ProcessingCancelledException
 
-from db import get_file, save_file, save_gene_data, update_file_status
-from utils import sha256sum, get_data_dir
+from config import CONFIG
+from progress import ProgressReporter, NO_PROGRESS, STAGE_PARSING, STAGE_LOADING
+from regions import get_gene_regions, GENCODE_GENOME_REFERENCE
+from db import get_file, save_file, save_samples, GeneDataLoader
+from db import get_checkpoints, save_checkpoints, delete_unfinished_genes, publish_staging_database
+from db import STAGE_ANNOTATED, STAGE_GENE_LOADED
+from utils import sha256sum, read_genes_file, get_annotated_vcf_file
 
 
 def __get_snpeff_genome_reference(genome_reference):
@@ -20,44 +31,147 @@ def __get_snpeff_genome_reference(genome_reference):
     return genome_reference
 
 
-def parse(vcf_file, genes_file, gene_set_id):
-    vcf_sha = sha256sum(vcf_file)
+def __check_cancelled(cancelled):
+    if cancelled is not None and cancelled.is_set():
+        raise ProcessingCancelledException('The processing was cancelled')
+
+
+def __ingest_genes(loader, gene_to_vcf, cancelled=None, progress=NO_PROGRESS):
+    for gene in gene_to_vcf:
+        __check_cancelled(cancelled)
+        # parse the variants in chunks, so that large genes
+        # don't have to be loaded in memory at once
+        loader.add_gene(gene)
+        for variants, annotations, genotypes, info_values in iter_vcf_chunks(gene_to_vcf[gene]):
+            progress.advance(STAGE_PARSING, len(variants))
+            loader.add(gene, variants, annotations, genotypes, info_values)
+        loader.finish_gene(gene)
+
+
+def __ingest_genes_in_parallel(loader, gene_to_vcf, jobs, cancelled=None, progress=NO_PROGRESS):
+    """
+    Parses the per-gene VCFs in a pool of worker processes.
+    The workers write the parsed chunks to files, which are read one chunk at a time,
+    and the parsed data is written to the database only from this process.
+    """
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(write_vcf_chunks, gene_to_vcf[gene]): gene for gene in gene_to_vcf}
+
+        for future in as_completed(futures):
+            if cancelled is not None and cancelled.is_set():
+                executor.shutdown(wait=True, cancel_futures=True)
+                # the chunks of the genes that were parsed but not loaded
+                for parsed in futures:
+                    if parsed.done() and not parsed.cancelled() and parsed.exception() is None and os.path.exists(parsed.result()):
+                        os.remove(parsed.result())
+                __check_cancelled(cancelled)
+
+            gene = futures[future]
+            loader.add_gene(gene)
+            for variants, annotations, genotypes, info_values in read_vcf_chunks(future.result()):
+                progress.advance(STAGE_PARSING, len(variants))
+                loader.add(gene, variants, annotations, genotypes, info_values)
+            loader.finish_gene(gene)
+
+
+def __get_gene_regions(genes, genome_reference):
+    """
+    Returns the regions of the given genes,
+    or None if the whole VCF should be annotated.
+    """
+    if not CONFIG.get('gene_regions_only', False):
+        return None
+
+    if not genome_reference.startswith(GENCODE_GENOME_REFERENCE) and genome_reference != 'hg38':
+        print('Gene regions are only available for {}. Annotating the whole VCF'.format(GENCODE_GENOME_REFERENCE))
+        return None
+
+    regions, missing = get_gene_regions(genes, CONFIG.get('gene_region_flank', 0))
+    if missing:
+        print('Genes not found in the GENCODE annotation: ' + ', '.join(sorted(missing)))
+    return regions
+
+
+def parse(vcf_file, genes_file, gene_set_id, jobs=None, cancelled=None, vcf_sha=None):
+    """
+    Annotates the VCF and saves the variants of the genes from genes_file to the database.
+    Only the genes that are not already saved for the gene set are processed, so this
+    also resumes interrupted parses and loads the genes added to the gene set later.
+    The annotated VCF is kept per file hash, so other gene sets don't have to annotate it again.
+    If the cancelled event (a threading.Event) is set, the parsing stops with
+    ProcessingCancelledException, keeping the checkpoints saved until then.
+    vcf_sha is the SHA-256 of the file, if it is already known (e.g. computed while it was uploaded).
+    """
+    if jobs is None:
+        jobs = CONFIG.get('ingestion_jobs', 1)
+
+    if vcf_sha is None:
+        vcf_sha = sha256sum(vcf_file)
 
     existing_row = get_file(vcf_sha, gene_set_id)
 
-    if existing_row and existing_row['status'] == 'processed':
-        data_dir = get_data_dir(vcf_file)
-        print('Already parsed. Reading annotated per-gene VCFs from ' + data_dir)
-    else:
-        header = get_header_lines(vcf_file)
-        validate_vcf_version(header)
-        genome_reference = validate_and_get_genome_reference(header)
-        snpeff_ref = __get_snpeff_genome_reference(genome_reference)
-
-        if not existing_row:
-            print('Saving file hash')
-            save_file(
-                os.path.basename(vcf_file),
-                vcf_sha,
-                vcf_file,
-                genome_reference,
-                gene_set_id,
-                datetime.now())
+    header = get_header_lines(vcf_file)
+    validate_vcf_version(header)
+    genome_reference = validate_and_get_genome_reference(header)
+    snpeff_ref = __get_snpeff_genome_reference(genome_reference)
+
+    if not existing_row:
+        print('Saving file hash')
+        save_file(
+            os.path.basename(vcf_file),
+            vcf_sha,
+            vcf_file,
+            genome_reference,
+            gene_set_id,
+            datetime.now())
+
+    save_samples(vcf_sha, gene_set_id, get_sample_names(vcf_file))
+
+    progress = ProgressReporter(vcf_sha, gene_set_id)
+    genes = read_genes_file(genes_file)
+    checkpoints = get_checkpoints(vcf_sha, gene_set_id)
+    annotated_genes = {checkpoint['gene_hgnc'] for checkpoint in checkpoints if checkpoint['stage'] == STAGE_ANNOTATED}
+    loaded_genes = {checkpoint['gene_hgnc'] for checkpoint in checkpoints if checkpoint['stage'] == STAGE_GENE_LOADED}
+
+    genes_to_annotate = [gene for gene in genes if gene not in annotated_genes]
+    annotated_vcf = get_annotated_vcf_file(vcf_sha)
+    if genes_to_annotate and os.path.exists(annotated_vcf):
+        print('Splitting the annotated VCF from ' + annotated_vcf)
+        split_annotated_vcf_file(annotated_vcf, vcf_file, genes_to_annotate, progress)
+    elif genes_to_annotate:
+        regions = __get_gene_regions(genes_to_annotate, genome_reference)
 
         print('Annotating the VCF')
-        gene_to_vcf = create_annotated_vcf_files_for_genes(vcf_file, snpeff_ref, genes_file)
-        print('Parsing the data and saving it to the database')
-        for gene in gene_to_vcf:
-            gene_vcf = gene_to_vcf[gene].name
-
-            filtered_vcf = create_filtered_vcf_file(gene_vcf)
-
-            variants, annotations = parse_vcf(gene_vcf)
-            save_gene_data(vcf_sha, gene_set_id, gene, variants, annotations)
-
-            # create a tabix index for the vcf and filtered vcf
-            # and compress them with gzip
-            pysam.tabix_index(gene_vcf, preset='vcf', force=True)
-            pysam.tabix_index(filtered_vcf, preset='vcf', force=True)
-        update_file_status(vcf_sha, gene_set_id, 'processed')
-    print('Processed ' + vcf_file)
\ No newline at end of file
+        create_annotated_vcf_files_for_genes(
+            vcf_file,
+            snpeff_ref,
+            genes_to_annotate,
+            regions=regions,
+            shards=CONFIG.get('snpeff_shards', 1),
+            # the annotation of only some regions can't be reused for other genes
+            annotated_vcf=annotated_vcf if regions is None else None,
+            cancelled=cancelled,
+            progress=progress)
+    __check_cancelled(cancelled)
+    save_checkpoints(vcf_sha, gene_set_id, STAGE_ANNOTATED, genes_to_annotate)
+
+    # remove the data of the genes that were being saved when the previous run was interrupted
+    delete_unfinished_genes(vcf_sha, gene_set_id)
+    if loaded_genes:
+        print('Skipping {} already saved genes'.format(len(loaded_genes)))
+    gene_to_vcf = get_annotated_vcf_files_for_genes(vcf_file, [gene for gene in genes if gene not in loaded_genes])
+
+    print('Parsing the data and saving it to the database')
+    progress.start(STAGE_PARSING, 'variants')
+    progress.start(STAGE_LOADING, 'rows')
+    loader = GeneDataLoader(vcf_sha, gene_set_id, on_saved=lambda rows: progress.advance(STAGE_LOADING, rows))
+    if jobs > 1:
+        __ingest_genes_in_parallel(loader, gene_to_vcf, jobs, cancelled, progress)
+    else:
+        __ingest_genes(loader, gene_to_vcf, cancelled, progress)
+    progress.finish(STAGE_PARSING)
+    loader.flush()
+    # the genes are saved to a staging database and only become visible here, all at once
+    publish_staging_database(vcf_sha, gene_set_id)
+    progress.finish(STAGE_LOADING)
+    print('Processed ' + vcf_file)
@@ -0,0 +1,138 @@
+import os
+import uuid
+import hashlib
+import threading
+
+import db
+
+
+def get_upload_path(upload_dir, sha, filename):
+    """
+    Returns the path of an uploaded file. The name starts with the hash of the file,
+    so that an upload doesn't replace another file with the same name that a job still reads.
+    """
+    return os.path.join(upload_dir, '{}_{}'.format(sha, filename))
+
+
+class UploadException(Exception):
+    pass
+
+
+class UploadOffsetException(UploadException):
+    """
+    Raised when a chunk doesn't start where the received data ends.
+    """
+
+    def __init__(self, offset):
+        super().__init__('The upload continues from offset {}'.format(offset))
+        self.offset = offset
+
+
+class ChunkedUploads:
+    """
+    Receives files in chunks. If the connection drops, the upload continues with the
+    chunk at the offset where the received data ends. The SHA-256 of the file is computed
+    while the chunks arrive, so the file doesn't have to be read again.
+    """
+
+    def __init__(self, upload_dir, chunk_size=1024*1024):
+        self.upload_dir = upload_dir
+        self.chunk_size = chunk_size
+        # upload id to the hash of the received data
+        self.hashes = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def __get_part_path(self, upload_id):
+        return os.path.join(self.upload_dir, upload_id + '.part')
+
+    def __get_lock(self, upload_id):
+        with self.lock:
+            return self.locks.setdefault(upload_id, threading.Lock())
+
+    def __get_upload(self, upload_id):
+        upload = db.get_upload(upload_id)
+        if not upload or not os.path.exists(self.__get_part_path(upload_id)):
+            raise UploadException('Unknown upload ' + upload_id)
+        return upload
+
+    def __get_hash(self, upload_id):
+        if upload_id not in self.hashes:
+            # e.g. after a restart, the received data is hashed again
+            h = hashlib.sha256()
+            with open(self.__get_part_path(upload_id), 'rb') as part:
+                while chunk := part.read(self.chunk_size):
+                    h.update(chunk)
+            self.hashes[upload_id] = h
+        return self.hashes[upload_id]
+
+    def create(self, filename, size, gene_set_id, sha256=None):
+        """
+        Starts an upload and returns its id.
+        If sha256 is given, the hash of the uploaded file is checked against it.
+        """
+        upload_id = uuid.uuid4().hex
+        if not os.path.exists(self.upload_dir):
+            os.makedirs(self.upload_dir)
+
+        open(self.__get_part_path(upload_id), 'wb').close()
+        db.save_upload(upload_id, filename, size, sha256, gene_set_id)
+        self.hashes[upload_id] = hashlib.sha256()
+        return upload_id
+
+    def get_offset(self, upload_id):
+        self.__get_upload(upload_id)
+        return os.path.getsize(self.__get_part_path(upload_id))
+
+    def append(self, upload_id, offset, stream):
+        """
+        Appends the data from the stream, which should start at the given offset of the file.
+        Returns the offset at which the next chunk should start.
+        """
+        upload = self.__get_upload(upload_id)
+        part_path = self.__get_part_path(upload_id)
+
+        with self.__get_lock(upload_id):
+            received = os.path.getsize(part_path)
+            if offset != received:
+                raise UploadOffsetException(received)
+
+            h = self.__get_hash(upload_id)
+            with open(part_path, 'ab') as part:
+                while chunk := stream.read(self.chunk_size):
+                    if received + len(chunk) > upload['size']:
+                        raise UploadException('The uploaded data is larger than the size of the file')
+                    part.write(chunk)
+                    h.update(chunk)
+                    received += len(chunk)
+
+            return received
+
+    def complete(self, upload_id):
+        """
+        Moves the uploaded file next to the other uploads (see get_upload_path) once all of its data is received.
+        Returns the path and the SHA-256 of the file and the upload.
+        """
+        upload = self.__get_upload(upload_id)
+        part_path = self.__get_part_path(upload_id)
+
+        with self.__get_lock(upload_id):
+            received = os.path.getsize(part_path)
+            if received != upload['size']:
+                raise UploadOffsetException(received)
+
+            sha = self.__get_hash(upload_id).hexdigest()
+            self.hashes.pop(upload_id)
+            db.delete_upload(upload_id)
+
+            if upload['sha256'] and upload['sha256'] != sha:
+                os.remove(part_path)
+                raise UploadException('The hash of the uploaded file does not match the given hash')
+
+            path = get_upload_path(self.upload_dir, sha, upload['filename'])
+            os.replace(part_path, path)
+
+        with self.lock:
+            self.locks.pop(upload_id, None)
+
+        return path, sha, upload
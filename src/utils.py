@@ -16,15 +16,37 @@ def sha256sum(filename):
     return h.hexdigest()
 
 
+def save_and_hash(stream, filename, chunk_size=1024*1024):
+    """
+    Writes the stream to the file and returns its SHA-256,
+    computed while it is written instead of reading the file again.
+    """
+    h = hashlib.sha256()
+    with open(filename, 'wb') as f:
+        while chunk := stream.read(chunk_size):
+            h.update(chunk)
+            f.write(chunk)
+    return h.hexdigest()
+
+
 def get_data_dir(file):
     dir_name = os.path.basename(file)
     return 'data/intermediary/{}'.format(dir_name)
 
 
+def get_annotated_vcf_file(sha):
+    return 'data/annotated/{}.vcf.gz'.format(sha)
+
+
 def get_genes_from_file(file):
     return [gene.decode('utf-8').rstrip() for gene in file]
 
 
+def read_genes_file(file):
+    with open(file, 'r') as f:
+        return [gene.rstrip() for gene in f if gene.strip()]
+
+
 def save_genes_to_file(genes, file):
     with open(file, 'w') as f:
         f.writelines(gene['name'] + '\n' for gene in genes)
\ No newline at end of file
@@ -3,22 +3,43 @@ import shlex
 import re
 import csv
 import gzip
-import vcf
+import pickle
+import shutil
+import tempfile
+import functools
+import threading
 import pandas as pd
 import numpy as np
 
 from subprocess import PIPE
+from subprocess import DEVNULL
 from subprocess import Popen
+from concurrent.futures import ThreadPoolExecutor
+from pysam.libcbgzf import BGZFile
 
 from enum import Enum
+from collections import OrderedDict
 
+from bgzf import open_vcf
 from config import CONFIG
+from genotypes import parse_genotypes
+from genotypes import get_cohort_stats
+from regions import create_vcf_file_for_regions
+from regions import split_vcf_by_chromosome
+from snpeff_server import get_server
+from annotation_cache import annotate_with_cache
+from progress import NO_PROGRESS, read_lines
+from progress import STAGE_READING, STAGE_ANNOTATING, STAGE_SPLITTING, STAGE_INDEXING
+from vcf_writer import IndexedVcfWriter
 
 import utils
 
 
 ACCEPTED_REFERENCE_GENOMES = ('GRCh38', 'GRCh37', 'hg19', 'hg38')
 
+# Number of annotated records between two reports of the progress
+PROGRESS_REPORT_RECORDS = 10000
+
 
 class VCF_COLUMNS(Enum):
     CHROM  = 0
@@ -98,159 +119,732 @@ class ANN_COLUMNS(Enum):
     NOTE = 15
 
 
-class VCFParsingException(Exception):
-    pass
+# The "position / total" ANN fields, which are also split into integer columns
+ANN_POSITION_COLUMNS = {
+    'rank_to_total': ('rank', 'rank_total'),
+    'cdna_pos_to_cdna_len': ('cdna_pos', 'cdna_len'),
+    'cds_pos_to_cds_len': ('cds_pos', 'cds_len'),
+    'prot_pos_to_prot_len': ('prot_pos', 'prot_len'),
+}
 
 
-def __construct_pipe(*args):
-    if len(args) == 0:
-        return
+class VCFParsingException(Exception):
+    pass
 
-    p1 = Popen(args[0], stdout=PIPE)
-    if len(args) == 1:
-        return p1
 
-    p2 = None
-    for arg in args[1:]:
-        p2 = Popen(arg, stdin=p1.stdout, stdout=PIPE)
-        p1.stdout.close()
-        p1 = p2
+class ProcessingCancelledException(Exception):
+    pass
 
-    return p2
-    
 
-def __get_annotation_cmd(file, ref_genome):
+def __get_snpeff_path():
     snpeff_path = os.path.join(CONFIG['snpEff_path'], 'snpEff.jar')
     if not os.path.isabs(snpeff_path):
          snpeff_path = os.path.join(os.getcwd(), snpeff_path)
-    cmd = "java -Xmx25g -jar {} ann -noStats {} {}".format(snpeff_path, ref_genome, file)
-    return shlex.split(cmd)
+    return snpeff_path
 
 
-def __get_filter_by_genes_cmd(gene_names_file):
-    snpsift = os.path.join(CONFIG['snpEff_path'], 'SnpSift.jar')
-    cmd = "java -jar {} filter -s {} \"ANN[0].GENE in SET[0]\"".format(snpsift, gene_names_file)
+def __get_annotation_cmd(file, ref_genome, heap_gb=None):
+    if heap_gb is None:
+        heap_gb = CONFIG.get('snpeff_heap_gb', 25)
+    snpeff_path = __get_snpeff_path()
+    cmd = "java -Xmx{}g -jar {} ann -noStats {} {}".format(heap_gb, snpeff_path, ref_genome, file)
     return shlex.split(cmd)
 
 
-def __get_gene_HGNC(vcf_line):
-    if match := re.search(r"ANN\=.*?\|.*?\|.*?\|(.*?)\|", vcf_line):
-        return match.group(1)
+def __get_genes_set(genes):
+    return {gene.strip().encode('utf-8') for gene in genes if gene.strip()}
 
 
-def create_annotated_vcf_files_for_genes(file, ref_genome, gene_names_file):
+def __get_matching_genes(vcf_line, genes):
     """
-    Takes a VCF file, reference genome name and file containing one gene HGNC per line and
-    parses the VCF file to annotate it and split it into a set of annotated per-gene VCF files.
+    Returns the genes from the given set that are mentioned
+    in any of the INFO.ANN entries of the given VCF record (as bytes).
     """
-    commands = [
-        __get_annotation_cmd(file, ref_genome),
-        __get_filter_by_genes_cmd(gene_names_file)
-    ]
+    info = vcf_line.split(b'\t', VCF_COLUMNS.INFO.value + 1)[VCF_COLUMNS.INFO.value]
 
-    proc = __construct_pipe(*commands)
+    if info.startswith(b'ANN='):
+        ann_start = 4
+    else:
+        ann_start = info.find(b';ANN=')
+        if ann_start == -1:
+            return ()
+        ann_start += 5
+
+    ann_end = info.find(b';', ann_start)
+    if ann_end == -1:
+        ann_end = len(info)
+
+    matching = []
+    for entry in info[ann_start:ann_end].split(b','):
+        fields = entry.split(b'|', ANN_COLUMNS.GENE.value + 1)
+        if len(fields) > ANN_COLUMNS.GENE.value:
+            gene = fields[ANN_COLUMNS.GENE.value]
+            if gene in genes and gene not in matching:
+                matching.append(gene)
+    return matching
 
-    files = {}
+
+# Number of genes whose VCF files (two per gene) GeneVcfWriters keeps open at once
+MAX_OPEN_GENE_FILES = 100
+
+
+class GeneVcfWriters:
+    """
+    Writes the annotated records of each gene to its own VCF file.
+    Two BGZF-compressed and tabix-indexed files are written per gene:
+    one with all records and one only with the records with HIGH, MODERATE or LOW impact.
+    Only the files of the max_open_genes last written genes are kept open,
+    so that large gene sets don't run out of file descriptors.
+    """
+
+    def __init__(self, dest_dir, progress=NO_PROGRESS, max_open_genes=MAX_OPEN_GENE_FILES):
+        self.dest_dir = dest_dir
+        self.progress = progress
+        self.max_open_genes = max_open_genes
+        self.files = {}
+        self.filtered_files = {}
+        # the genes with open files, the least recently written first
+        self.open_genes = OrderedDict()
+
+    @staticmethod
+    def __is_impactful(vcf_line):
+        return b'HIGH' in vcf_line or b'MODERATE' in vcf_line or b'LOW' in vcf_line
+
+    def __open(self, gene, header_lines):
+        if not os.path.exists(self.dest_dir):
+            os.makedirs(self.dest_dir)
+
+        path = os.path.join(self.dest_dir, gene + '.vcf')
+        # TODO: add customized header that describes our filtering
+        self.files[gene] = IndexedVcfWriter(path + '.gz', header_lines)
+        self.filtered_files[gene] = IndexedVcfWriter(get_filtered_vcf_name(path + '.gz'), header_lines)
+        self.progress.advance(STAGE_SPLITTING)
+
+    def __touch(self, gene):
+        self.open_genes[gene] = None
+        self.open_genes.move_to_end(gene)
+        if len(self.open_genes) > self.max_open_genes:
+            # the records are sorted, so this is usually a gene whose region has ended
+            closed_gene, _ = self.open_genes.popitem(last=False)
+            self.files[closed_gene].suspend()
+            self.filtered_files[closed_gene].suspend()
+
+    def write(self, gene, line, header_lines):
+        if gene not in self.files:
+            self.__open(gene, header_lines)
+        self.__touch(gene)
+
+        self.files[gene].write(line)
+        if self.__is_impactful(line):
+            self.filtered_files[gene].write(line)
+
+    def close(self):
+        """
+        Closes all files and returns a dict of gene to (closed) file with all records.
+        """
+        gene_files = list(self.files.values()) + list(self.filtered_files.values())
+        self.progress.start(STAGE_INDEXING, 'indexes', len(gene_files))
+        for gene_file in gene_files:
+            gene_file.close()
+            self.progress.advance(STAGE_INDEXING)
+        self.progress.finish(STAGE_INDEXING)
+        return self.files
+
+
+def __split_annotated_vcf(lines, genes, dest_dir, annotated_file=None, progress=NO_PROGRESS):
+    """
+    Writes each annotated record from lines to the VCF files (in dest_dir)
+    of every gene from the genes set that is mentioned in its annotations.
+    If annotated_file is given, all lines are also written to it.
+    Returns a dict of gene to (closed) file.
+    """
+    writers = GeneVcfWriters(dest_dir, progress)
 
     header_lines = []
+    records = 0
 
-    while line := proc.stdout.readline():
-        line = line.decode('utf-8')
+    progress.start(STAGE_ANNOTATING, 'records')
+    progress.start(STAGE_SPLITTING, 'genes')
+    for line in lines:
+        if annotated_file is not None:
+            annotated_file.write(line)
 
-        if len(line) == 0:
+        if line.startswith(b'#'):
+            header_lines.append(line)
             continue
 
-        if line[0] == '#':
-            header_lines += line
+        for gene in __get_matching_genes(line, genes):
+            writers.write(gene.decode('utf-8'), line, header_lines)
+
+        records += 1
+        if records == PROGRESS_REPORT_RECORDS:
+            progress.advance(STAGE_ANNOTATING, records)
+            records = 0
+
+    progress.advance(STAGE_ANNOTATING, records)
+    progress.finish(STAGE_READING)
+    progress.finish(STAGE_ANNOTATING)
+    progress.finish(STAGE_SPLITTING)
+
+    return writers.close()
+
+
+def __send_vcf(file, stdin, progress):
+    try:
+        with stdin:
+            stdin.writelines(read_lines(file, progress))
+    except (BrokenPipeError, ValueError):
+        # the process has died or its output is not needed anymore
+        pass
+
+
+def __annotate(file, ref_genome, heap_gb=None, progress=NO_PROGRESS):
+    """
+    Runs SnpEff on the given VCF and yields the lines of the annotated VCF.
+    The VCF is sent to SnpEff from this process, so that the read bytes can be reported.
+    """
+    proc = Popen(__get_annotation_cmd('-', ref_genome, heap_gb), stdin=PIPE, stdout=PIPE)
+    sender = threading.Thread(target=__send_vcf, args=(file, proc.stdin, progress), daemon=True)
+    sender.start()
+    try:
+        yield from proc.stdout
+        proc.wait()
+    finally:
+        # the annotated lines are not needed anymore
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+
+def __annotate_sharded(file, ref_genome, dest_dir, shards, progress=NO_PROGRESS):
+    """
+    Splits the VCF by chromosome and runs up to the given number of SnpEff processes at once,
+    each with an equal part of the snpeff_heap_gb heap. Yields the lines of the annotated
+    shards in the order of the chromosomes in the input, with the header of the first one.
+    """
+    shards_dir = os.path.join(dest_dir, 'shards')
+    shard_files = split_vcf_by_chromosome(file, shards_dir)
+    heap_gb = max(CONFIG.get('snpeff_heap_gb', 25) // shards, 1)
+    progress.start(STAGE_READING, 'bytes', sum(os.path.getsize(shard_file) for shard_file in shard_files))
+
+    def annotate_shard(shard_file):
+        with open(shard_file + '.ann', 'wb') as annotated_shard:
+            annotated_shard.writelines(__annotate(shard_file, ref_genome, heap_gb, progress))
+
+    with ThreadPoolExecutor(max_workers=shards) as executor:
+        list(executor.map(annotate_shard, shard_files))
+
+    try:
+        for i, shard_file in enumerate(shard_files):
+            with open(shard_file + '.ann', 'rb') as annotated_shard:
+                for line in annotated_shard:
+                    if i == 0 or not line.startswith(b'#'):
+                        yield line
+    finally:
+        shutil.rmtree(shards_dir)
+
+
+def __until_cancelled(lines, cancelled):
+    try:
+        for line in lines:
+            if cancelled.is_set():
+                raise ProcessingCancelledException('The processing was cancelled')
+            yield line
+    finally:
+        lines.close()
+
+
+@functools.cache
+def __get_snpeff_version():
+    cmd = ['java', '-jar', __get_snpeff_path(), '-version']
+    output = Popen(cmd, stdout=PIPE, stderr=DEVNULL).communicate()[0]
+    return ' '.join(output.decode('utf-8').split())
+
+
+def create_annotated_vcf_files_for_genes(
+        file, ref_genome, gene_names, regions=None, shards=1, annotated_vcf=None, cancelled=None, progress=NO_PROGRESS):
+    """
+    Takes a VCF file, reference genome name and a list of gene HGNC names and
+    parses the VCF file to annotate it and split it into a set of annotated per-gene VCF files.
+    A record is written to the file of every gene in the set which is mentioned in any of its annotations.
+    If regions (as returned by regions.get_gene_regions) are given, only the records in them are annotated.
+    If shards is more than 1, the chromosomes are annotated in parallel by that many SnpEff processes.
+    Otherwise, if snpeff_server is enabled in the config, the VCF is annotated by a long-lived SnpEff process.
+    If annotation_cache is enabled in the config, only the variants that are not in the cache are annotated.
+    If annotated_vcf is given, the whole annotated VCF is also kept there (BGZF-compressed),
+    so that it can be split for other genes later with split_annotated_vcf_file.
+    If the cancelled event is set, the annotation stops with ProcessingCancelledException.
+    The progress of the stages is reported to progress (a progress.ProgressReporter).
+    """
+    genes = __get_genes_set(gene_names)
+
+    dest_dir = utils.get_data_dir(file)
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+
+    def annotate(vcf_file):
+        if shards > 1:
+            return __annotate_sharded(vcf_file, ref_genome, dest_dir, shards, progress)
+
+        progress.start(STAGE_READING, 'bytes', os.path.getsize(vcf_file))
+        if CONFIG.get('snpeff_server', False):
+            server = get_server(ref_genome, __get_annotation_cmd('-', ref_genome))
+            return server.annotate(vcf_file, progress)
+        return __annotate(vcf_file, ref_genome, progress=progress)
+
+    annotated_file = file
+    if regions is not None:
+        annotated_file = create_vcf_file_for_regions(file, regions, os.path.join(dest_dir, 'gene_regions.vcf'))
+
+    output = None
+    if annotated_vcf is not None:
+        os.makedirs(os.path.dirname(annotated_vcf), exist_ok=True)
+        # written under a temporary name, so that an interrupted annotation is never reused
+        output = BGZFile(annotated_vcf + '.part', 'wb')
+
+    if CONFIG.get('annotation_cache', False):
+        lines = annotate_with_cache(annotated_file, ref_genome, __get_snpeff_version(), annotate, dest_dir)
+    else:
+        lines = annotate(annotated_file)
+    if cancelled is not None:
+        lines = __until_cancelled(lines, cancelled)
+
+    try:
+        files = __split_annotated_vcf(lines, genes, dest_dir, annotated_file=output, progress=progress)
+    finally:
+        if output is not None:
+            output.close()
+        if annotated_file != file:
+            os.remove(annotated_file)
+
+    if output is not None:
+        os.replace(annotated_vcf + '.part', annotated_vcf)
+
+    return files
+
+
+def split_annotated_vcf_file(annotated_vcf, file, gene_names, progress=NO_PROGRESS):
+    """
+    Splits an annotated VCF kept by create_annotated_vcf_files_for_genes into the
+    per-gene VCF files of the given genes, without annotating the file again.
+    """
+    genes = __get_genes_set(gene_names)
+
+    dest_dir = utils.get_data_dir(file)
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+
+    progress.start(STAGE_READING, 'bytes', os.path.getsize(annotated_vcf))
+    return __split_annotated_vcf(read_lines(annotated_vcf, progress), genes, dest_dir, progress=progress)
 
-        # TODO: handle multiple ANN annotations with different genes
-        gene = __get_gene_HGNC(line)
 
-        if not gene:
+def get_annotated_vcf_files_for_genes(file, gene_names):
+    """
+    Returns a dict of gene to the path of its annotated VCF, for the given genes
+    for which create_annotated_vcf_files_for_genes has already written one.
+    """
+    dest_dir = utils.get_data_dir(file)
+    files = {}
+    for gene in __get_genes_set(gene_names):
+        gene = gene.decode('utf-8')
+        path = os.path.join(dest_dir, gene + '.vcf.gz')
+        if os.path.exists(path):
+            files[gene] = path
+    return files
+
+
+# Number of VCF records that are held in memory at once while parsing.
+PARSE_CHUNK_SIZE = 10000
+
+# INFO fields reserved by the VCF specification. They are used when the
+# header of the file doesn't define the type of the field.
+RESERVED_INFO_TYPES = {
+    'AA': 'String',
+    'AC': 'Integer',
+    'AF': 'Float',
+    'AN': 'Integer',
+    'BQ': 'Float',
+    'CIGAR': 'String',
+    'DB': 'Flag',
+    'DP': 'Integer',
+    'END': 'Integer',
+    'H2': 'Flag',
+    'H3': 'Flag',
+    'MQ': 'Float',
+    'MQ0': 'Integer',
+    'NS': 'Integer',
+    'SB': 'String',
+    'SOMATIC': 'Flag',
+    'VALIDATED': 'Flag',
+    '1000G': 'Flag',
+    'IMPRECISE': 'Flag',
+    'NOVEL': 'Flag',
+    'SVTYPE': 'String',
+    'SVLEN': 'Integer',
+    'CIPOS': 'Integer',
+    'CIEND': 'Integer',
+    'HOMLEN': 'Integer',
+    'HOMSEQ': 'String',
+    'BKPTID': 'String',
+    'MEINFO': 'String',
+    'METRANS': 'String',
+    'DGVID': 'String',
+    'DBVARID': 'String',
+    'DBRIPID': 'String',
+    'MATEID': 'String',
+    'PARID': 'String',
+    'EVENT': 'String',
+    'CILEN': 'Integer',
+    'DPADJ': 'Integer',
+    'CN': 'Integer',
+    'CNADJ': 'Integer',
+    'CICN': 'Integer',
+    'CICNADJ': 'Integer',
+}
+
+MISSING_VALUES = ('.', '', 'NA')
+
+INFO_VALUES_COLUMNS = ['gene_variation', 'key', 'value_index', 'number_value', 'string_value']
+
+TRANSITIONS = ('AG', 'GA', 'CT', 'TC')
+
+
+def __get_info_definitions(header_lines):
+    """
+    Returns a dict mapping each INFO field defined in the header
+    to a (Number, Type) tuple.
+    """
+    definitions = {}
+    for line in header_lines:
+        if not line.startswith('##INFO=<'):
             continue
+        match = re.search(r"ID=([^,>]+),Number=([^,>]+),Type=([^,>]+)", line)
+        if match:
+            definitions[match.group(1)] = (match.group(2), match.group(3))
+    return definitions
+
+
+def __convert_number(value):
+    """
+    Converts a malformed value of an Integer or Float INFO field: integers written as floats
+    (in case of incorrect header types) become floats, and anything that isn't a number
+    is kept as a string, so that a sloppy value doesn't stop the whole file from being parsed.
+    """
+    if value in MISSING_VALUES:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def __convert_info_values(values, info_type):
+    try:
+        if info_type == 'Integer':
+            return [int(v) if v not in MISSING_VALUES else None for v in values]
+        if info_type == 'Float':
+            return [float(v) if v not in MISSING_VALUES else None for v in values]
+    except ValueError:
+        return [__convert_number(v) for v in values]
+    return [v if v not in MISSING_VALUES else None for v in values]
 
-        if gene in files:
-            files[gene].write(line)
+
+def __parse_info(info, definitions):
+    """
+    Parses the INFO column of a VCF record into a dict, following the
+    Number and Type definitions from the header. The ANN field is returned
+    separately as a raw string, because it is parsed in bulk.
+    The fields without a definition (that aren't reserved either) are also
+    returned in a second dict, as they are stored as JSON instead of typed values.
+    """
+    parsed = {}
+    unknown = {}
+    ann = None
+
+    if info == '.':
+        return parsed, unknown, ann
+
+    for entry in info.split(';'):
+        key, sep, value = entry.partition('=')
+        if key == 'ANN':
+            ann = value
+            continue
+
+        number, info_type = definitions.get(key, (None, RESERVED_INFO_TYPES.get(key)))
+        is_unknown = info_type is None
+        if is_unknown:
+            info_type = 'String' if sep else 'Flag'
+
+        if info_type == 'Flag' or not sep:
+            parsed[key] = True
         else:
-            dest_dir = utils.get_data_dir(file)
-            if not os.path.exists(dest_dir):
-                os.makedirs(dest_dir)
-            files[gene] = open(os.path.join(dest_dir, gene + '.vcf'), 'w')
-            # TODO: add customized header that describes our filtering
-            for header_line in header_lines:
-                files[gene].write(header_line)
-            files[gene].write(line)
-
-    for file in files.values():
-        file.close()
+            values = __convert_info_values(value.split(','), info_type)
+            parsed[key] = values[0] if number == '1' else values
 
-    return files
+        if is_unknown:
+            unknown[key] = parsed[key]
 
+    return parsed, unknown, ann
 
-def __remove_key(hashmap, key):
-    del hashmap[key]
-    return hashmap
 
+def __get_info_values(infos, unknowns, index):
+    """
+    Converts the typed INFO fields of the records into a dataframe with a row
+    per value (see the info_values table): the numbers go to number_value and
+    the strings to string_value. Flags have a single row without a value.
+    """
+    rows = []
+    for i, info, unknown in zip(index, infos, unknowns):
+        for key, values in info.items():
+            if key in unknown:
+                continue
+            if values is True:
+                rows.append((i, key, 0, None, None))
+                continue
+            if not isinstance(values, list):
+                values = [values]
+            for value_index, value in enumerate(values):
+                if isinstance(value, str):
+                    rows.append((i, key, value_index, None, value))
+                else:
+                    rows.append((i, key, value_index, value, None))
+
+    info_values = pd.DataFrame(rows, columns=INFO_VALUES_COLUMNS)
+    info_values['number_value'] = info_values['number_value'].astype(float)
+    return info_values.set_index('gene_variation')
+
+
+def __get_alt_types(alts):
+    """
+    Returns the PyVCF-compatible type of each ALT allele in the given series:
+    None for missing alleles, SNV/MNV for substitutions, BND for breakends
+    and the symbolic name (e.g. DEL) for structural variants.
+    """
+    lengths = alts.str.len()
+    breakend = alts.str.contains(r'[\[\]]') \
+        | ((lengths > 1) & (alts.str.startswith('.') | alts.str.endswith('.')))
+    symbolic = ~breakend & alts.str.startswith('<') & alts.str.endswith('>')
 
-def __get_vcf_row_dict(vcf_record):
-    vcf_dict = vars(vcf_record)
-    vcf_dict['var_type'] = vcf_record.var_type
-    vcf_dict['var_subtype'] = vcf_record.var_subtype
-    return vcf_dict
+    types = np.where(lengths == 1, 'SNV', 'MNV').astype(object)
+    types = np.where(symbolic, alts.str.slice(1, -1), types)
+    types = np.where(breakend, 'BND', types)
+    types = np.where(alts == '.', None, types)
+    return pd.Series(types, index=alts.index)
 
 
-def parse_vcf(file):
+def __classify_variants(variants, is_sv, svtype, imprecise):
     """
-    Parses the given VCF file and returns two dataframes:
-    - The first one - variants dataframe - includes all colums from the VCF
-    (with the INFO column as map), but without the INFO.ANN field.
-    - The second one - annotations dataframe - contains the INFO.ANN annotations,
-    where each annotation is a separate column.
-    Note that the annotations dataframe contains indices to the row number in the
-    variants dataframe.
+    Computes var_type, var_subtype, affected_start and affected_end for all
+    variants at once. The rules are the same as the ones used by PyVCF.
+    """
+    ref_len = variants['ref'].str.len()
+    pos = variants['pos']
+    n_alts = variants['alt'].str.len()
+
+    # one row per ALT allele, indexed by the variant
+    alts = variants['alt'].explode().fillna('.')
+    alt_types = __get_alt_types(alts)
+    alt_len = alts.str.len()
+    alt_ref_len = ref_len.loc[alts.index]
+    alt_pos = pos.loc[alts.index]
+    is_substitution = alt_types.isin(('SNV', 'MNV'))
+
+    # affected region of the reference
+    starts = np.where(is_substitution & (alt_ref_len > 1), alt_pos, alt_pos - 1)
+    ends = np.where(is_substitution & (alt_ref_len > 1), alt_pos + alt_ref_len - 1, alt_pos - 1 + alt_ref_len)
+    starts = np.where((alt_types == 'MNV') & (alt_ref_len == 1), alt_pos, starts)
+    ends = np.where(alt_types == 'SNV', np.where(alt_ref_len > 1, ends, alt_pos), ends)
+    ends = np.where((alt_types == 'MNV') & (alt_ref_len == 1), alt_pos, ends)
+    affected = pd.DataFrame({'start': starts, 'end': ends}, index=alts.index).groupby(level=0)
+    affected_start = np.minimum(pos, affected['start'].min())
+    affected_end = np.maximum(pos, affected['end'].max())
+
+    is_snp = (ref_len == 1) & (alt_types == 'SNV').groupby(level=0).all() \
+        & alts.isin(('A', 'C', 'G', 'T', 'N', '*')).groupby(level=0).all()
+
+    # An indel is decided by the first ALT which is not a substitution
+    # of the same length as the REF.
+    decisive = ~is_substitution | (alt_len != alt_ref_len)
+    first_decisive = is_substitution[decisive].groupby(level=0).first() \
+        .reindex(variants.index, fill_value=False).astype(bool)
+    is_indel = ((ref_len > 1) | first_decisive) & ~is_sv
+
+    first_alt = alts.groupby(level=0).first()
+    first_alt_type = alt_types.groupby(level=0).first()
+    single_alt = n_alts == 1
+    is_transition = single_alt & (variants['ref'] + first_alt).isin(TRANSITIONS)
+    is_deletion = single_alt & (first_alt != '.') & (ref_len > first_alt.str.len())
+
+    var_type = np.select([is_snp, is_indel, is_sv], ['snp', 'indel', 'sv'], default='unknown')
+    var_subtype = np.select(
+        [
+            is_snp & is_transition,
+            is_snp & single_alt,
+            is_snp,
+            is_indel & is_deletion,
+            is_indel & single_alt,
+            is_indel,
+            is_sv & (svtype == 'BND'),
+            is_sv & ~imprecise,
+            is_sv,
+        ],
+        [
+            'ts',
+            'tv',
+            'unknown',
+            'del',
+            'ins',
+            'unknown',
+            'complex',
+            svtype,
+            first_alt_type.fillna('unknown'),
+        ],
+        default='unknown')
+
+    return var_type, var_subtype, affected_start, affected_end
+
+
+def __to_integers(values):
+    return pd.to_numeric(values, errors='coerce').astype('Int64')
+
+
+def __parse_annotations(ann_fields, first_variation):
+    """
+    Splits the raw INFO.ANN fields into an annotations dataframe,
+    with one row per annotation and one column per ANN field.
+    """
+    annotations = [ann.split(',') if ann else [] for ann in ann_fields]
+    counts = np.fromiter((len(a) for a in annotations), dtype=np.int64, count=len(annotations))
+    gene_variation = np.repeat(np.arange(first_variation, first_variation + len(annotations)), counts)
+
+    # 1-based index of each annotation within its variant
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    variation_annotation = np.arange(len(gene_variation)) - offsets + 1
+
+    field_count = len(ANN_COLUMNS)
+    rows = []
+    for ann in annotations:
+        for entry in ann:
+            fields = entry.split('|', field_count - 1)
+            fields += [''] * (field_count - len(fields))
+            rows.append(fields)
+
+    annotations_df = pd.DataFrame(rows, columns=[col.name.lower() for col in ANN_COLUMNS])
+    annotations_df.insert(0, 'gene_variation', gene_variation)
+    annotations_df.insert(1, 'variation_annotation', variation_annotation)
+
+    for column, (pos_column, total_column) in ANN_POSITION_COLUMNS.items():
+        split = annotations_df[column].str.split('/', n=1, expand=True).reindex(columns=[0, 1])
+        annotations_df[pos_column] = __to_integers(split[0])
+        annotations_df[total_column] = __to_integers(split[1])
+    annotations_df['distance'] = __to_integers(annotations_df['distance_to_feature'])
+    return annotations_df
+
+
+def __build_chunk(columns, info_definitions, first_variation):
+    chrom, pos, ids, ref, alt, qual, filters, info, fmt, samples = columns
+
+    parsed_info = [__parse_info(i, info_definitions) for i in info]
+    infos = [i for i, _, _ in parsed_info]
+    unknowns = [u for _, u, _ in parsed_info]
+
+    variants = pd.DataFrame({
+        'chrom': chrom,
+        'pos': np.array(pos, dtype=np.int64),
+        'id': [None if i == '.' else i for i in ids],
+        'ref': ref,
+        'alt': [a.split(',') for a in alt],
+        'qual': pd.to_numeric(pd.Series(qual), errors='coerce').astype(float),
+        'filter': [None if f == '.' else [] if f == 'PASS' else f.split(';') for f in filters],
+        'info': unknowns,
+        'format': [None if f in ('.', None) else f for f in fmt],
+    })
+    variants.index = pd.RangeIndex(first_variation, first_variation + len(variants))
+
+    is_sv = pd.Series([i.get('SVTYPE') is not None for i in infos], index=variants.index)
+    svtype = pd.Series([i.get('SVTYPE') for i in infos], index=variants.index, dtype=object)
+    imprecise = pd.Series([i.get('IMPRECISE') is not None for i in infos], index=variants.index)
+
+    var_type, var_subtype, affected_start, affected_end = __classify_variants(variants, is_sv, svtype, imprecise)
+
+    variants['alt'] = [[None if a == '.' else a for a in alts] for alts in variants['alt']]
+    variants['start_pos'] = variants['pos'] - 1
+    variants['end_pos'] = variants['start_pos'] + variants['ref'].str.len()
+    variants['alleles'] = [[r] + a for r, a in zip(variants['ref'], variants['alt'])]
+    variants['affected_start'] = affected_start
+    variants['affected_end'] = affected_end
+    variants['var_type'] = var_type
+    variants['var_subtype'] = var_subtype
+
+    genotypes = parse_genotypes(fmt, samples, variants.index)
+    variants = variants.join(get_cohort_stats(genotypes))
+
+    annotations = __parse_annotations([ann for _, _, ann in parsed_info], first_variation)
+    info_values = __get_info_values(infos, unknowns, variants.index)
+
+    return variants, annotations, genotypes, info_values
+
+
+def iter_vcf_chunks(file, chunk_size=PARSE_CHUNK_SIZE):
+    """
+    Streams the given VCF file and yields (variants, annotations, genotypes, info_values)
+    dataframes for every chunk of at most chunk_size records (see parse_vcf for
+    a description of the dataframes).
+    The index of the variants, genotypes and info_values dataframes (and the gene_variation column of
+    the annotations dataframe) is the number of the record in the whole file,
+    so the chunks can be saved one after another.
     """
-    reader = vcf.Reader(open(file))
-    df = pd.DataFrame([__get_vcf_row_dict(r) for r in reader])
+    header_lines = get_header_lines(file)
+    info_definitions = __get_info_definitions(header_lines)
 
-    # Get snpEff annotations as dataframe.
-    # Each row in the vcf may have multiple annotations
-    # so each annotation keeps the index to the row (like a foreign key) 
-    annotation_series = df.INFO.map(lambda info: info['ANN']).rename('ANN')
-    denorm_annotations_df = pd.DataFrame(annotation_series).explode('ANN')
-    denorm_annotations_df.reset_index(inplace=True)
+    # the fixed columns and the calls of all samples
+    column_count = len(VCF_COLUMNS) + 1
+    first_variation = 0
+    columns = [[] for _ in range(column_count)]
 
-    variation_annotation_ids = []
-    i = 0
-    prev = None
-    for variation in denorm_annotations_df['index']:
-        i += 1
-        if prev not in (None, variation):
-            i = 1
-        prev = variation
-        variation_annotation_ids.append(i)
+    with open_vcf(file, 'rt') as vcf:
+        for line in vcf:
+            if line.startswith('#'):
+                continue
 
-    denorm_annotations_df.insert(1, 'gene_variation', variation_annotation_ids)
-    annotations = denorm_annotations_df.ANN.str.split('|', expand=True)
-    annotations_df = denorm_annotations_df.drop('ANN', axis=1).merge(annotations, left_index=True, right_index=True)
+            fields = line.rstrip('\n').split('\t', len(VCF_COLUMNS))
+            fields += [None] * (column_count - len(fields))
+            for column, value in zip(columns, fields):
+                column.append(value)
 
-    # delete the raw ANN field from info
-    df['INFO'] = df['INFO'].apply(lambda info: __remove_key(info, 'ANN'))
-    # delete sample indexes as we don't need it
-    df = df.drop('_sample_indexes', axis=1)
+            if len(columns[0]) == chunk_size:
+                yield __build_chunk(columns, info_definitions, first_variation)
+                first_variation += chunk_size
+                columns = [[] for _ in range(column_count)]
 
-    # drop samples
-    # TODO: we probably will need this in order to get some useful statistics
-    # but it is hard to parse, so we can ignore it for now
-    df = df.drop('samples', axis=1)
+    if columns[0]:
+        yield __build_chunk(columns, info_definitions, first_variation)
 
-    col_names = [col.name.lower() for col in ANN_COLUMNS]
-    col_names.insert(0, 'gene_variation')
-    col_names.insert(1, 'variation_annotation')
-    annotations_df.columns = col_names
 
-    df.columns = [col + '_pos' if col in ('start', 'end') else col.lower() for col in df.columns]
+def parse_vcf(file):
+    """
+    Parses the given VCF file and returns four dataframes:
+    - The first one - variants dataframe - includes all colums from the VCF
+    (with the INFO fields not defined in the header as map), but without the INFO.ANN field and the samples.
+    - The second one - annotations dataframe - contains the INFO.ANN annotations,
+    where each annotation is a separate column.
+    - The third one - genotypes dataframe - contains the compact genotypes of all
+    samples of each variant (see genotypes.parse_genotypes), with the index of the variants dataframe.
+    - The fourth one - info_values dataframe - contains the values of the INFO fields with
+    a type from the header (or the VCF specification), a row per value, with the index of the variants dataframe.
+    Note that the annotations dataframe contains indices to the row number in the
+    variants dataframe.
+    Use iter_vcf_chunks to avoid holding the whole file in memory.
+    """
+    chunks = list(iter_vcf_chunks(file))
+    if not chunks:
+        return pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
 
-    return df, annotations_df
+    variants = pd.concat([variants for variants, _, _, _ in chunks])
+    annotations = pd.concat([annotations for _, annotations, _, _ in chunks], ignore_index=True)
+    genotypes = pd.concat([genotypes for _, _, genotypes, _ in chunks])
+    info_values = pd.concat([info_values for _, _, _, info_values in chunks])
+    return variants, annotations, genotypes, info_values
 
 
 def __get_matching_references(line, refs):
@@ -276,6 +870,19 @@ def get_header_lines(file):
     return header_lines
 
 
+def get_sample_names(file):
+    """
+    Returns the names of the samples from the #CHROM header line of the VCF.
+    """
+    with open_vcf(file, 'rt', threads=1) as vcf:
+        for line in vcf:
+            if line.startswith('#CHROM'):
+                return line.rstrip('\n').split('\t')[len(VCF_COLUMNS):]
+            if not line.startswith('#'):
+                break
+    return []
+
+
 def validate_vcf_version(header_lines):
     fileformat_line = next((l for l in header_lines if l.startswith('##fileformat')), None)
 
@@ -309,20 +916,43 @@ def validate_and_get_genome_reference(header_lines):
 
 
 def get_filtered_vcf_name(file_name):
+    if file_name.endswith('.gz'):
+        return get_filtered_vcf_name(file_name.removesuffix('.gz')) + '.gz'
     filtered = file_name.removesuffix('.vcf')
     return filtered + '_filtered.vcf'
 
 
-def create_filtered_vcf_file(vcf_file):
-    filtered_vcf_name = get_filtered_vcf_name(vcf_file)
-    filtered_vcf = open(filtered_vcf_name, 'w')
+def write_vcf_chunks(file):
+    """
+    Parses the given VCF and writes its (variants, annotations, genotypes, info_values)
+    chunks one after another to a temporary file next to it (see read_vcf_chunks),
+    so that only one chunk is in memory at a time. Returns the path of the written file.
+    This doesn't touch the database, so that it can be run in a worker process.
+    """
+    fd, path = tempfile.mkstemp(prefix=os.path.basename(file) + '.', suffix='.chunks', dir=os.path.dirname(file))
+    try:
+        with os.fdopen(fd, 'wb') as chunks:
+            for chunk in iter_vcf_chunks(file):
+                pickle.dump(chunk, chunks, protocol=pickle.HIGHEST_PROTOCOL)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
 
-    with open(vcf_file, 'r') as vcf:
-        for line in vcf:
-            if line.startswith('#') or re.search(r"HIGH|MODERATE|LOW", line):
-                filtered_vcf.write(line)
 
-    return filtered_vcf_name
+def read_vcf_chunks(path):
+    """
+    Yields the chunks written by write_vcf_chunks one at a time and removes the file.
+    """
+    try:
+        with open(path, 'rb') as chunks:
+            while True:
+                try:
+                    yield pickle.load(chunks)
+                except EOFError:
+                    return
+    finally:
+        os.remove(path)
 
 
 # create_annotated_vcf_files_for_genes("/home/me/ALL.chrX.shapeit2_integrated_snvindels_v2a_27022019.GRCh38.phased.vcf", "GRCh38.105", "/home/me/Downloads/snpEff/test_gene_names.csv")
@@ -0,0 +1,150 @@
+import os
+import struct
+
+from pysam.libcbgzf import BGZFile
+
+
+# Parameters of the tabix (TBI) binning index
+TBI_MIN_SHIFT = 14
+TBI_DEPTH = 5
+TBI_VCF_FORMAT = 2
+TBI_SEQ_COLUMN = 1
+TBI_BEGIN_COLUMN = 2
+TBI_END_COLUMN = 0
+
+
+def reg2bin(beg, end):
+    """
+    Returns the smallest bin of the tabix binning scheme which contains
+    the zero-based, half-open [beg, end) interval.
+    """
+    end -= 1
+    for level in range(TBI_DEPTH, 0, -1):
+        shift = TBI_MIN_SHIFT + 3 * (TBI_DEPTH - level)
+        if beg >> shift == end >> shift:
+            return ((1 << (3 * level)) - 1) // 7 + (beg >> shift)
+    return 0
+
+
+def get_record_interval(line):
+    """
+    Returns the chromosome and the zero-based, half-open interval
+    of the given VCF record (as bytes), the same way tabix computes it.
+    """
+    fields = line.split(b'\t', 8)
+    beg = int(fields[1]) - 1
+    end = beg + len(fields[3])
+
+    for entry in fields[7].rstrip(b'\n').split(b';'):
+        if entry.startswith(b'END='):
+            if entry[4:].isdigit() and int(entry[4:]) > beg:
+                end = int(entry[4:])
+            break
+
+    return fields[0], beg, max(end, beg + 1)
+
+
+class IndexedVcfWriter:
+    """
+    Writes a BGZF-compressed VCF and builds its tabix index while
+    the records are written, so the file doesn't have to be read again.
+    The records should be written sorted by position, with the records
+    of each chromosome next to each other.
+    The file can be closed with suspend while the writer is not used, it's
+    reopened for appending at the next write.
+    """
+
+    def __init__(self, path, header_lines):
+        self.name = path
+        self.file = BGZFile(path, 'wb')
+        # the offset of the compressed data written before the file was reopened
+        self.base_offset = 0
+        self.contigs = []
+        self.bins = {}
+        self.linear = {}
+        self.first_offsets = {}
+        self.file.write(b''.join(header_lines))
+
+    def suspend(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __tell(self):
+        # a virtual offset is the offset of the compressed block << 16 | the offset in the block,
+        # and the blocks of an appended file start from 0
+        return (self.base_offset << 16) + self.file.tell()
+
+    def write(self, line):
+        chrom, beg, end = get_record_interval(line)
+
+        if self.file is None:
+            # BGZF files can be concatenated, so the appended blocks just follow the written ones
+            self.base_offset = os.path.getsize(self.name)
+            self.file = BGZFile(self.name, 'ab')
+
+        start_offset = self.__tell()
+        self.file.write(line)
+        end_offset = self.__tell()
+
+        if not self.contigs or self.contigs[-1] != chrom:
+            if chrom in self.bins:
+                raise ValueError('{} is not sorted by chromosome'.format(self.name))
+            self.contigs.append(chrom)
+            self.bins[chrom] = {}
+            self.linear[chrom] = []
+            self.first_offsets[chrom] = start_offset
+
+        chunks = self.bins[chrom].setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == start_offset:
+            chunks[-1][1] = end_offset
+        else:
+            chunks.append([start_offset, end_offset])
+
+        linear = self.linear[chrom]
+        last_window = (end - 1) >> TBI_MIN_SHIFT
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(beg >> TBI_MIN_SHIFT, last_window + 1):
+            if linear[window] is None:
+                linear[window] = start_offset
+
+    def __write_index(self):
+        names = b''.join(contig + b'\0' for contig in self.contigs)
+        index = [
+            b'TBI\1',
+            struct.pack(
+                '<8i',
+                len(self.contigs),
+                TBI_VCF_FORMAT,
+                TBI_SEQ_COLUMN,
+                TBI_BEGIN_COLUMN,
+                TBI_END_COLUMN,
+                ord('#'),
+                0,
+                len(names)),
+            names,
+        ]
+
+        for contig in self.contigs:
+            bins = self.bins[contig]
+            index.append(struct.pack('<i', len(bins)))
+            for bin, chunks in sorted(bins.items()):
+                index.append(struct.pack('<Ii', bin, len(chunks)))
+                index.extend(struct.pack('<QQ', start, end) for start, end in chunks)
+
+            # windows without records point to the closest previous record
+            linear = self.linear[contig]
+            offset = self.first_offsets[contig]
+            index.append(struct.pack('<i', len(linear)))
+            for window_offset in linear:
+                if window_offset is not None:
+                    offset = window_offset
+                index.append(struct.pack('<Q', offset))
+
+        with BGZFile(self.name + '.tbi', 'wb') as tbi:
+            tbi.write(b''.join(index))
+
+    def close(self):
+        self.suspend()
+        self.__write_index()